@@ -1,82 +1,727 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import asyncio
+import bisect
+import csv
+import functools
+import gzip
+import inspect
 import logging
+import math
+import multiprocessing
 import random
 import sqlite3
 from datetime import datetime, timedelta
 import os
 import hashlib
+import heapq
+import json
+import queue
+import secrets
+import signal
+import sys
+import tempfile
 import threading
 import time
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, CallbackContext, Filters
-from telegram.error import BadRequest
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, CallbackContext, DispatcherHandlerStop, Filters
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.utils.request import Request
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 BOT_TOKEN = os.getenv('BOT_TOKEN', '8458068573:AAHaKHcWQZOOmTu-z2wu-7kbX8MdhonkS_M')
 ADMIN_IDS = [5207853162, 5406117718]
 CHANNEL_ID = "@sportgagarinmolodezh"
+DB_PATH = os.getenv('DB_PATH', 'giveaway.db')
+BOT_API_URL = os.getenv('BOT_API_URL') or None
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '30'))
+WORKERS = int(os.getenv('WORKERS', '8'))
+RUNTIME = os.getenv('RUNTIME', 'threaded')
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '4'))
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '30'))
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '2000'))
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', '100'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv('WRITE_BEHIND_INTERVAL_MS', '200'))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv('WRITE_BEHIND_MAX_ROWS', '500'))
+WEBHOOK_MAX_PENDING_WRITES = int(os.getenv('WEBHOOK_MAX_PENDING_WRITES', str(WRITE_BEHIND_MAX_ROWS * 10)))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '100000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+REFERRAL_CACHE_SIZE = int(os.getenv('REFERRAL_CACHE_SIZE', '50000'))
+REFERRAL_CACHE_TTL = float(os.getenv('REFERRAL_CACHE_TTL', '60'))
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '30'))
+OUTBOX_PRIVATE_RATE = float(os.getenv('OUTBOX_PRIVATE_RATE', '1'))
+OUTBOX_GROUP_RATE = float(os.getenv('OUTBOX_GROUP_RATE', str(20 / 60.0)))
+OUTBOX_SENDERS = int(os.getenv('OUTBOX_SENDERS', '4'))
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', '3'))
+LIVE_POST_INTERVAL = float(os.getenv('LIVE_POST_INTERVAL', '5'))
+LIVE_POST_REFRESH = float(os.getenv('LIVE_POST_REFRESH', '300'))
+SUB_CACHE_POSITIVE_TTL = float(os.getenv('SUB_CACHE_POSITIVE_TTL', '600'))
+SUB_CACHE_NEGATIVE_TTL = float(os.getenv('SUB_CACHE_NEGATIVE_TTL', '10'))
+SUB_CACHE_SIZE = int(os.getenv('SUB_CACHE_SIZE', '200000'))
+SUB_CHECK_WORKERS = int(os.getenv('SUB_CHECK_WORKERS', '8'))
+SUB_CHECK_TIMEOUT = float(os.getenv('SUB_CHECK_TIMEOUT', '10'))
+CAPTCHA_BACKEND = os.getenv('CAPTCHA_BACKEND', 'memory')
+CAPTCHA_TTL = float(os.getenv('CAPTCHA_TTL', '300'))
+CAPTCHA_GRACE = float(os.getenv('CAPTCHA_GRACE', '600'))
+CAPTCHA_MAX = int(os.getenv('CAPTCHA_MAX', '100000'))
+CAPTCHA_MAX_ATTEMPTS = 3
+CLUSTER_BY_REFERRAL = os.getenv('CLUSTER_BY_REFERRAL', '1') == '1'
+CLUSTER_JOIN_WINDOW = float(os.getenv('CLUSTER_JOIN_WINDOW', '0'))
+CLUSTER_EXCLUDE_SIZE = int(os.getenv('CLUSTER_EXCLUDE_SIZE', '0'))
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '50'))
+WINNER_LOOKUP_TIMEOUT = float(os.getenv('WINNER_LOOKUP_TIMEOUT', '5'))
+USER_NAME_MAX_AGE_DAYS = int(os.getenv('USER_NAME_MAX_AGE_DAYS', '30'))
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', '3600'))
+FINISH_RETRY_DELAY = float(os.getenv('FINISH_RETRY_DELAY', '60'))
+RATE_LIMIT_USER_RATE = float(os.getenv('RATE_LIMIT_USER_RATE', '1'))
+RATE_LIMIT_USER_BURST = float(os.getenv('RATE_LIMIT_USER_BURST', '5'))
+RATE_LIMIT_GLOBAL_RATE = float(os.getenv('RATE_LIMIT_GLOBAL_RATE', '300'))
+RATE_LIMIT_GLOBAL_BURST = float(os.getenv('RATE_LIMIT_GLOBAL_BURST', '600'))
+RATE_LIMIT_MAX_DEFER = float(os.getenv('RATE_LIMIT_MAX_DEFER', '2'))
+RATE_LIMIT_MAX_USERS = int(os.getenv('RATE_LIMIT_MAX_USERS', '200000'))
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', '1000'))
+LEADER_LOCK_PATH = os.getenv('LEADER_LOCK_PATH', DB_PATH + '.leader')
+EXPORT_DIR = os.getenv('EXPORT_DIR') or None
+EXPORT_GZIP_LEVEL = int(os.getenv('EXPORT_GZIP_LEVEL', '6'))
+EXPORT_DOCUMENT_LIMIT = int(os.getenv('EXPORT_DOCUMENT_LIMIT', str(50 * 1024 * 1024)))
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FINISH_LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600)
+
+LANE_CALLBACK = 0
+LANE_DM = 1
+LANE_CHANNEL = 2
+
+JOIN_OK = 'ok'
+JOIN_ALREADY = 'already'
+JOIN_BANNED = 'banned'
+JOIN_UNVERIFIED = 'unverified'
+JOIN_CLOSED = 'closed'
+JOIN_EXPIRED = 'expired'
+JOIN_SUBSCRIBE = 'subscribe'
+JOIN_ERROR = 'error'
+
+RATE_OK = 0
+RATE_DROP = 1
+RATE_NOTIFY = 2
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+GLOBAL_LEADERBOARD = 0
+
+def rebuild_referral_counts(cursor):
+    cursor.execute('DELETE FROM referral_counts')
+    cursor.execute("""INSERT INTO referral_counts (giveaway_id, referrer_id, ref_count)
+        SELECT giveaway_id, referrer_id, COUNT(*) FROM referrals GROUP BY giveaway_id, referrer_id""")
+    cursor.execute("""INSERT INTO referral_counts (giveaway_id, referrer_id, ref_count)
+        SELECT ?, referrer_id, COUNT(*) FROM referrals GROUP BY referrer_id""", (GLOBAL_LEADERBOARD,))
+
+MIGRATIONS = [
+    (1, 'secondary indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_giveaways_finish ON giveaways (is_active, auto_finish, end_date)',
+        'CREATE INDEX IF NOT EXISTS idx_users_ip_hash ON users (ip_hash, joined_date, username, first_name)',
+        'CREATE INDEX IF NOT EXISTS idx_users_banned ON users (is_banned, banned_date)',
+        'CREATE INDEX IF NOT EXISTS idx_participants_user ON participants (user_id, giveaway_id, is_valid)',
+        'CREATE INDEX IF NOT EXISTS idx_participants_valid ON participants (giveaway_id, is_valid, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id, giveaway_id, referred_id)',
+        'CREATE INDEX IF NOT EXISTS idx_verification_history_user ON verification_history (user_id, attempt_date)',
+        'CREATE INDEX IF NOT EXISTS idx_ip_addresses_count ON ip_addresses (user_count, last_seen)',
+    ]),
+    (2, 'weighted draw index', [
+        'CREATE INDEX IF NOT EXISTS idx_participants_draw ON participants (giveaway_id, is_valid, user_id, bonus_entries)',
+        'DROP INDEX IF EXISTS idx_participants_valid',
+    ]),
+    (3, 'verifiable draws', [
+        """CREATE TABLE IF NOT EXISTS draws (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, giveaway_id INTEGER NOT NULL, draw_date TEXT NOT NULL,
+            algorithm TEXT NOT NULL, nonce TEXT NOT NULL, participants_digest TEXT NOT NULL,
+            participant_count INTEGER NOT NULL, total_weight INTEGER NOT NULL, seed TEXT NOT NULL,
+            winner_count INTEGER NOT NULL, winners TEXT NOT NULL)""",
+        'CREATE INDEX IF NOT EXISTS idx_draws_giveaway ON draws (giveaway_id, id)',
+        'ALTER TABLE giveaways ADD COLUMN draw_nonce TEXT',
+        lambda cursor: cursor.executemany('UPDATE giveaways SET draw_nonce = ? WHERE id = ?',
+            [(secrets.token_hex(16), row[0]) for row in cursor.execute('SELECT id FROM giveaways').fetchall()]),
+    ]),
+    (4, 'shared captcha store', [
+        """CREATE TABLE IF NOT EXISTS captchas (
+            user_id INTEGER PRIMARY KEY, answer TEXT NOT NULL, attempts INTEGER DEFAULT 0,
+            ip_hash TEXT, expires_at REAL NOT NULL)""",
+        'CREATE INDEX IF NOT EXISTS idx_captchas_expires ON captchas (expires_at)',
+    ]),
+    (5, 'referral leaderboard', [
+        """CREATE TABLE IF NOT EXISTS referral_counts (
+            giveaway_id INTEGER NOT NULL, referrer_id INTEGER NOT NULL, ref_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (giveaway_id, referrer_id))""",
+        'CREATE INDEX IF NOT EXISTS idx_referral_counts_rank ON referral_counts (giveaway_id, ref_count DESC, referrer_id)',
+        rebuild_referral_counts,
+    ]),
+    (6, 'draw exclusions', [
+        'ALTER TABLE draws ADD COLUMN excluded TEXT',
+    ]),
+    (7, 'keyset pagination', [
+        'CREATE INDEX IF NOT EXISTS idx_participants_page ON participants (giveaway_id, is_valid, join_date, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_banned_page ON users (is_banned, banned_date, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_ip_addresses_page ON ip_addresses (user_count, ip_hash)',
+        'DROP INDEX IF EXISTS idx_users_banned',
+        'DROP INDEX IF EXISTS idx_ip_addresses_count',
+    ]),
+    (8, 'participant counters', [
+        'ALTER TABLE giveaways ADD COLUMN participant_count INTEGER NOT NULL DEFAULT 0',
+        """UPDATE giveaways SET participant_count = (SELECT COUNT(*) FROM participants p
+            WHERE p.giveaway_id = giveaways.id AND p.is_valid = 1)""",
+    ]),
+]
+
+DRAW_ALGORITHM = 'sha256-seeded-a-expj-v1'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in labels) + '}'
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = {}
+        self.gauges = {}
+
+    def set_buckets(self, name, buckets):
+        self.buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.buckets.get(name, METRICS_BUCKETS)
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(buckets, value)
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            if index < len(buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def gauge(self, name, read, kind='gauge', **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = (read, kind)
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE ' + name + ' ' + kind)
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(series[0]), series[1], series[2])) for key, series in self.histograms.items())
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(name + format_labels(labels) + ' ' + str(value))
+        for (name, labels), (counts, total, count) in histograms:
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets.get(name, METRICS_BUCKETS), counts):
+                cumulative += bucket_count
+                lines.append(name + '_bucket' + format_labels(labels + (('le', str(bound)),)) + ' ' + str(cumulative))
+            lines.append(name + '_bucket' + format_labels(labels + (('le', '+Inf'),)) + ' ' + str(count))
+            lines.append(name + '_sum' + format_labels(labels) + ' ' + repr(total))
+            lines.append(name + '_count' + format_labels(labels) + ' ' + str(count))
+        for (name, labels), (read, kind) in sorted(self.gauges.items(), key=lambda item: item[0]):
+            try:
+                value = read()
+            except Exception:
+                continue
+            declare(name, kind)
+            lines.append(name + format_labels(labels) + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.set_buckets('giveaway_finish_lag_seconds', FINISH_LAG_BUCKETS)
+
+def timed(callback, histogram, **labels):
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            metrics.observe(histogram, time.perf_counter() - started, **labels)
+    return wrapper
+
+def instrument_methods(cls, histogram, skip=()):
+    for name, method in list(vars(cls).items()):
+        if name.startswith('_') or name in skip or not inspect.isfunction(method) or inspect.isgeneratorfunction(method):
+            continue
+        setattr(cls, name, timed(method, histogram, method=name))
+
+shard = None
+
+def publish(event, *args):
+    if shard is not None and not getattr(shard.local, 'replaying', False):
+        shard.events.put((shard.index, event, args))
+
+class WriteBehindQueue:
+    def __init__(self, flush, interval_ms=WRITE_BEHIND_INTERVAL_MS, max_rows=WRITE_BEHIND_MAX_ROWS):
+        self.flush = flush
+        self.interval = interval_ms / 1000.0
+        self.max_rows = max_rows
+        self.pending = OrderedDict()
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self.thread.start()
+
+    def put(self, sql, params, key=None):
+        with self.lock:
+            if key is None:
+                self.sequence += 1
+                key = self.sequence
+            self.pending[key] = (sql, params)
+            full = len(self.pending) >= self.max_rows
+        if full:
+            self.wakeup.set()
+
+    def drain(self):
+        with self.lock:
+            items = list(self.pending.items())
+            self.pending = OrderedDict()
+        return items
+
+    def requeue(self, items):
+        with self.lock:
+            pending = OrderedDict(items)
+            for key, item in self.pending.items():
+                pending.pop(key, None)
+                pending[key] = item
+            self.pending = pending
+
+    def size(self):
+        return len(self.pending)
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.pending:
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error("Write-behind flush error: " + str(e))
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+
+class UserStatusCache:
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.ip_overrides = {}
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[user_id]
+            self.misses += 1
+            return None
+
+    def put(self, user_id, status, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            ip_hash = self.ip_overrides.pop(user_id, None)
+            if ip_hash is not None:
+                status = (status[0], status[1], ip_hash)
+            self.entries[user_id] = (time.monotonic() + self.ttl, status)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def set_ip_hash(self, user_id, ip_hash):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                banned, verified, _ = entry[1]
+                self.entries[user_id] = (entry[0], (banned, verified, ip_hash))
+                return
+            if len(self.ip_overrides) >= self.max_size:
+                self.ip_overrides.clear()
+            self.ip_overrides[user_id] = ip_hash
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.ip_overrides.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+class DisjointSet:
+    def __init__(self):
+        self.parent = {}
+        self.members = {}
+
+    def find(self, user_id):
+        parent = self.parent
+        if user_id not in parent:
+            return user_id
+        while parent[user_id] != user_id:
+            parent[user_id] = parent[parent[user_id]]
+            user_id = parent[user_id]
+        return user_id
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return root_a
+        members_a = self.members.get(root_a) or [root_a]
+        members_b = self.members.get(root_b) or [root_b]
+        if len(members_a) < len(members_b):
+            root_a, root_b, members_a, members_b = root_b, root_a, members_b, members_a
+        self.parent.setdefault(root_a, root_a)
+        self.parent[root_b] = root_a
+        members_a.extend(members_b)
+        self.members[root_a] = members_a
+        self.members.pop(root_b, None)
+        return root_a
+
+    def cluster(self, user_id):
+        members = self.members.get(self.find(user_id))
+        return list(members) if members else [user_id]
+
+    def top(self, limit, min_size):
+        clusters = [(len(members), root) for root, members in self.members.items() if len(members) >= min_size]
+        return [(root, size, list(self.members[root])) for size, root in heapq.nlargest(limit, clusters)]
+
+    def stats(self):
+        sizes = [len(members) for members in self.members.values()]
+        return {'clusters': len(sizes), 'users': sum(sizes), 'largest': max(sizes) if sizes else 0}
+
+class AccountClusters:
+    def __init__(self, by_referral=CLUSTER_BY_REFERRAL, join_window=CLUSTER_JOIN_WINDOW):
+        self.by_referral = by_referral
+        self.join_window = join_window
+        self.ip = DisjointSet()
+        self.linked = DisjointSet()
+        self.ip_owner = {}
+        self.last_join = {}
+        self.lock = threading.Lock()
+
+    def link_ip(self, user_id, ip_hash):
+        if not ip_hash:
+            return
+        with self.lock:
+            owner = self.ip_owner.setdefault(ip_hash, user_id)
+            if owner != user_id:
+                self.ip.union(owner, user_id)
+                self.linked.union(owner, user_id)
+
+    def link_referral(self, referrer_id, referred_id):
+        if not self.by_referral or not referrer_id or referrer_id == referred_id:
+            return
+        with self.lock:
+            self.linked.union(referrer_id, referred_id)
+
+    def record_join(self, giveaway_id, user_id, when):
+        if not self.join_window:
+            return
+        with self.lock:
+            previous = self.last_join.get(giveaway_id)
+            if previous and previous[1] != user_id and when - previous[0] <= self.join_window:
+                self.linked.union(previous[1], user_id)
+            self.last_join[giveaway_id] = (when, user_id)
+
+    def size(self, user_id):
+        with self.lock:
+            return len(self.ip.cluster(user_id))
+
+    def cluster(self, user_id):
+        with self.lock:
+            return self.ip.cluster(user_id)
+
+    def top(self, limit=10, min_size=2):
+        with self.lock:
+            return [(root, size, members, set(user_id for user_id in members if user_id in self.ip.parent))
+                    for root, size, members in self.linked.top(limit, min_size)]
+
+    def large_members(self, min_size):
+        with self.lock:
+            return set(user_id for members in self.ip.members.values() if len(members) >= min_size for user_id in members)
+
+    def stats(self):
+        with self.lock:
+            summary = self.ip.stats()
+            linked = self.linked.stats()
+            summary['linked_clusters'] = linked['clusters']
+            summary['linked_users'] = linked['users']
+            return summary
+
+class ThreadConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
 class Database:
-    def __init__(self, db_name='giveaway.db'):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.cursor = self.conn.cursor()
+    def __init__(self, db_name=DB_PATH):
+        self.db_name = db_name
+        self.local = threading.local()
+        self.write_lock = threading.RLock()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.status_cache = UserStatusCache()
+        self.referral_cache = UserStatusCache(REFERRAL_CACHE_SIZE, REFERRAL_CACHE_TTL)
+        self.clusters = AccountClusters()
+        self.lock_waits = 0
+        self.lock_wait_total = 0.0
+        self.lock_wait_max = 0.0
+        self.lock_wait_samples = deque(maxlen=10000)
         self.create_tables()
+        self.migrate()
+        self.write_behind = WriteBehindQueue(self.flush)
+
+    def connection(self):
+        holder = getattr(self.local, 'holder', None)
+        if holder is None:
+            conn = sqlite3.connect(self.db_name, timeout=DB_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=' + str(int(DB_BUSY_TIMEOUT * 1000)))
+            conn.set_trace_callback(count_statement)
+            holder = ThreadConnection(conn)
+            self.local.holder = holder
+            with self.connections_lock:
+                self.connections.append(conn)
+            weakref.finalize(holder, self.release, conn)
+        return holder.conn
+
+    def release(self, conn):
+        with self.connections_lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+        try:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            conn.close()
+        except:
+            pass
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    @contextmanager
+    def transaction(self, durable=False):
+        waited = time.perf_counter()
+        with self.write_lock:
+            conn = self.connection()
+            if conn.in_transaction:
+                yield conn.cursor()
+                return
+            if durable:
+                conn.execute('PRAGMA synchronous=FULL')
+            pending = None
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                self.record_lock_wait(time.perf_counter() - waited)
+                cursor = conn.cursor()
+                pending = self.apply_pending(cursor)
+                conn.execute('SAVEPOINT body')
+                try:
+                    yield cursor
+                except:
+                    conn.execute('ROLLBACK TO body')
+                    conn.execute('RELEASE body')
+                    conn.execute('COMMIT')
+                    pending = None
+                    raise
+                conn.execute('RELEASE body')
+                committed = time.perf_counter()
+                conn.execute('COMMIT')
+                pending = None
+                metrics.observe('db_commit_seconds', time.perf_counter() - committed, durable=int(durable))
+            finally:
+                if pending:
+                    self.write_behind.requeue(pending)
+                    metrics.inc('write_behind_requeued_total', len(pending))
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                if durable:
+                    conn.execute('PRAGMA synchronous=NORMAL')
+
+    def record_lock_wait(self, seconds):
+        self.lock_waits += 1
+        self.lock_wait_total += seconds
+        self.lock_wait_max = max(self.lock_wait_max, seconds)
+        self.lock_wait_samples.append(seconds)
+        metrics.observe('db_lock_wait_seconds', seconds)
+
+    def lock_stats(self):
+        with self.write_lock:
+            return {'waits': self.lock_waits, 'total': self.lock_wait_total, 'max': self.lock_wait_max,
+                    'samples': list(self.lock_wait_samples)}
+
+    def apply_pending(self, cursor):
+        write_behind = getattr(self, 'write_behind', None)
+        if write_behind is None:
+            return None
+        items = write_behind.drain()
+        for key, (sql, params) in items:
+            try:
+                cursor.execute(sql, params)
+            except Exception as e:
+                logger.error("Write-behind statement failed: " + str(e))
+        return items
+
+    def flush(self):
+        if self.write_behind.size():
+            with self.transaction():
+                pass
+
+    @contextmanager
+    def snapshot(self):
+        conn = self.connection()
+        if conn.in_transaction:
+            yield
+            return
+        conn.execute('BEGIN')
+        try:
+            yield
+        finally:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+
+    def close(self):
+        self.write_behind.stop()
+        self.flush()
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except:
+                pass
+        self.local = threading.local()
 
     def create_tables(self):
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT,
-            joined_date TEXT NOT NULL, is_verified INTEGER DEFAULT 0, verification_date TEXT,
-            verification_method TEXT, is_banned INTEGER DEFAULT 0, ban_reason TEXT,
-            banned_date TEXT, ip_hash TEXT, last_activity TEXT, verification_attempts INTEGER DEFAULT 0)""")
-
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS verification_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
-            verification_type TEXT NOT NULL, success INTEGER NOT NULL,
-            attempt_date TEXT NOT NULL, ip_hash TEXT)""")
-
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS ban_list (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
-            admin_id INTEGER, reason TEXT, ban_date TEXT NOT NULL, unban_date TEXT)""")
-
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS ip_addresses (
-            ip_hash TEXT PRIMARY KEY, user_count INTEGER DEFAULT 1,
-            first_seen TEXT NOT NULL, last_seen TEXT NOT NULL)""")
-
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS giveaways (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, description TEXT,
-            winner_count INTEGER DEFAULT 1, start_date TEXT NOT NULL, end_date TEXT NOT NULL,
-            is_active INTEGER DEFAULT 1, message_id INTEGER, channel_id TEXT,
-            auto_finish INTEGER DEFAULT 1, require_subscription INTEGER DEFAULT 0)""")
-
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS participants (
-            giveaway_id INTEGER NOT NULL, user_id INTEGER NOT NULL, join_date TEXT NOT NULL,
-            is_valid INTEGER DEFAULT 1, referred_by INTEGER, bonus_entries INTEGER DEFAULT 0,
-            PRIMARY KEY (giveaway_id, user_id))""")
-
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS referrals (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, referrer_id INTEGER NOT NULL,
-            referred_id INTEGER NOT NULL, giveaway_id INTEGER NOT NULL,
-            referral_date TEXT NOT NULL, UNIQUE(referrer_id, referred_id, giveaway_id))""")
-
-        self.conn.commit()
+        with self.transaction() as cursor:
+            cursor.execute("""CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT,
+                joined_date TEXT NOT NULL, is_verified INTEGER DEFAULT 0, verification_date TEXT,
+                verification_method TEXT, is_banned INTEGER DEFAULT 0, ban_reason TEXT,
+                banned_date TEXT, ip_hash TEXT, last_activity TEXT, verification_attempts INTEGER DEFAULT 0)""")
+
+            cursor.execute("""CREATE TABLE IF NOT EXISTS verification_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                verification_type TEXT NOT NULL, success INTEGER NOT NULL,
+                attempt_date TEXT NOT NULL, ip_hash TEXT)""")
+
+            cursor.execute("""CREATE TABLE IF NOT EXISTS ban_list (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                admin_id INTEGER, reason TEXT, ban_date TEXT NOT NULL, unban_date TEXT)""")
+
+            cursor.execute("""CREATE TABLE IF NOT EXISTS ip_addresses (
+                ip_hash TEXT PRIMARY KEY, user_count INTEGER DEFAULT 1,
+                first_seen TEXT NOT NULL, last_seen TEXT NOT NULL)""")
+
+            cursor.execute("""CREATE TABLE IF NOT EXISTS giveaways (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, description TEXT,
+                winner_count INTEGER DEFAULT 1, start_date TEXT NOT NULL, end_date TEXT NOT NULL,
+                is_active INTEGER DEFAULT 1, message_id INTEGER, channel_id TEXT,
+                auto_finish INTEGER DEFAULT 1, require_subscription INTEGER DEFAULT 0)""")
+
+            cursor.execute("""CREATE TABLE IF NOT EXISTS participants (
+                giveaway_id INTEGER NOT NULL, user_id INTEGER NOT NULL, join_date TEXT NOT NULL,
+                is_valid INTEGER DEFAULT 1, referred_by INTEGER, bonus_entries INTEGER DEFAULT 0,
+                PRIMARY KEY (giveaway_id, user_id))""")
+
+            cursor.execute("""CREATE TABLE IF NOT EXISTS referrals (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, referrer_id INTEGER NOT NULL,
+                referred_id INTEGER NOT NULL, giveaway_id INTEGER NOT NULL,
+                referral_date TEXT NOT NULL, UNIQUE(referrer_id, referred_id, giveaway_id))""")
+
+    def schema_version(self):
+        try:
+            return self.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+        except:
+            return 0
+
+    def migrate(self):
+        with self.transaction() as cursor:
+            cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_date TEXT NOT NULL)""")
+            cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+            current = cursor.fetchone()[0]
+            for version, name, steps in MIGRATIONS:
+                if version <= current:
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute('INSERT INTO schema_version (version, name, applied_date) VALUES (?, ?, ?)',
+                    (version, name, datetime.now().isoformat()))
+                logger.info("Applied migration " + str(version) + ": " + name)
+                current = version
+        return current
 
     def add_user(self, user_id, username, first_name, last_name=""):
         try:
-            self.cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-            exists = self.cursor.fetchone()
             current_time = datetime.now().isoformat()
-            if exists:
-                self.cursor.execute("UPDATE users SET username = ?, first_name = ?, last_name = ?, last_activity = ? WHERE user_id = ?",
-                    (username, first_name, last_name, current_time, user_id))
-            else:
-                self.cursor.execute("INSERT INTO users (user_id, username, first_name, last_name, joined_date, last_activity, is_verified) VALUES (?, ?, ?, ?, ?, ?, 0)",
-                    (user_id, username, first_name, last_name, current_time, current_time))
-            self.conn.commit()
+            self.write_behind.put("""INSERT INTO users (user_id, username, first_name, last_name, joined_date, last_activity, is_verified) VALUES (?, ?, ?, ?, ?, ?, 0)
+                ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name,
+                last_name = excluded.last_name, last_activity = excluded.last_activity""",
+                (user_id, username, first_name, last_name, current_time, current_time), key=('user', user_id))
             return True
         except:
             return False
@@ -84,56 +729,60 @@ class Database:
     def verify_user(self, user_id, method="captcha", ip_hash=None):
         try:
             current_time = datetime.now().isoformat()
-            self.cursor.execute("UPDATE users SET is_verified = 1, verification_date = ?, verification_method = ?, verification_attempts = verification_attempts + 1 WHERE user_id = ?",
-                (current_time, method, user_id))
-            self.cursor.execute("INSERT INTO verification_history (user_id, verification_type, success, attempt_date, ip_hash) VALUES (?, ?, 1, ?, ?)",
-                (user_id, method, current_time, ip_hash))
-            self.conn.commit()
-            self.cursor.execute('SELECT is_verified FROM users WHERE user_id = ?', (user_id,))
-            result = self.cursor.fetchone()
+            with self.transaction() as cursor:
+                cursor.execute("UPDATE users SET is_verified = 1, verification_date = ?, verification_method = ?, verification_attempts = verification_attempts + 1 WHERE user_id = ?",
+                    (current_time, method, user_id))
+                cursor.execute("INSERT INTO verification_history (user_id, verification_type, success, attempt_date, ip_hash) VALUES (?, ?, 1, ?, ?)",
+                    (user_id, method, current_time, ip_hash))
+            self.status_cache.invalidate(user_id)
+            publish('user', user_id)
+            result = self.execute('SELECT is_verified FROM users WHERE user_id = ?', (user_id,)).fetchone()
             return result and result[0] == 1
         except:
-            self.conn.rollback()
             return False
 
-    def is_verified(self, user_id):
+    def get_user_status(self, user_id):
+        status = self.status_cache.get(user_id)
+        if status is not None:
+            return status
+        generation = self.status_cache.generation
         try:
-            self.cursor.execute('SELECT is_verified FROM users WHERE user_id = ?', (user_id,))
-            result = self.cursor.fetchone()
-            return result and result[0] == 1
+            row = self.execute('SELECT is_banned, is_verified, ip_hash FROM users WHERE user_id = ?', (user_id,)).fetchone()
         except:
-            return False
+            return (False, False, None)
+        status = (row[0] == 1, row[1] == 1, row[2]) if row else (False, False, None)
+        self.status_cache.put(user_id, status, generation)
+        return status
+
+    def is_verified(self, user_id):
+        return self.get_user_status(user_id)[1]
 
     def record_verification_attempt(self, user_id, success=False, method="captcha", ip_hash=None):
         try:
             current_time = datetime.now().isoformat()
-            self.cursor.execute('UPDATE users SET verification_attempts = verification_attempts + 1 WHERE user_id = ?', (user_id,))
-            self.cursor.execute("INSERT INTO verification_history (user_id, verification_type, success, attempt_date, ip_hash) VALUES (?, ?, ?, ?, ?)",
+            self.write_behind.put('UPDATE users SET verification_attempts = verification_attempts + 1 WHERE user_id = ?', (user_id,))
+            self.write_behind.put("INSERT INTO verification_history (user_id, verification_type, success, attempt_date, ip_hash) VALUES (?, ?, ?, ?, ?)",
                 (user_id, method, 1 if success else 0, current_time, ip_hash))
-            self.conn.commit()
             return True
         except:
             return False
 
     def get_verification_info(self, user_id):
         try:
-            self.cursor.execute('SELECT is_verified, verification_date, verification_method, verification_attempts FROM users WHERE user_id = ?', (user_id,))
-            return self.cursor.fetchone()
+            return self.execute('SELECT is_verified, verification_date, verification_method, verification_attempts FROM users WHERE user_id = ?', (user_id,)).fetchone()
         except:
             return None
 
     def get_verification_history(self, user_id, limit=10):
         try:
-            self.cursor.execute("SELECT verification_type, success, attempt_date, ip_hash FROM verification_history WHERE user_id = ? ORDER BY attempt_date DESC LIMIT ?",
-                (user_id, limit))
-            return self.cursor.fetchall()
+            return self.execute("SELECT verification_type, success, attempt_date, ip_hash FROM verification_history WHERE user_id = ? ORDER BY attempt_date DESC LIMIT ?",
+                (user_id, limit)).fetchall()
         except:
             return []
 
     def update_user_activity(self, user_id):
         try:
-            self.cursor.execute('UPDATE users SET last_activity = ? WHERE user_id = ?', (datetime.now().isoformat(), user_id))
-            self.conn.commit()
+            self.write_behind.put('UPDATE users SET last_activity = ? WHERE user_id = ?', (datetime.now().isoformat(), user_id), key=('activity', user_id))
         except:
             pass
 
@@ -141,80 +790,127 @@ class Database:
         try:
             current_time = datetime.now()
             unban_date = current_time + timedelta(days=days)
-            self.cursor.execute("INSERT INTO ban_list (user_id, admin_id, reason, ban_date, unban_date) VALUES (?, ?, ?, ?, ?)",
-                (user_id, admin_id, reason, current_time.isoformat(), unban_date.isoformat()))
-            self.cursor.execute('UPDATE users SET is_banned = 1, ban_reason = ?, banned_date = ? WHERE user_id = ?',
-                (reason, current_time.isoformat(), user_id))
-            self.cursor.execute('UPDATE participants SET is_valid = 0 WHERE user_id = ?', (user_id,))
-            self.conn.commit()
+            with self.transaction(durable=True) as cursor:
+                cursor.execute("INSERT INTO ban_list (user_id, admin_id, reason, ban_date, unban_date) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, admin_id, reason, current_time.isoformat(), unban_date.isoformat()))
+                cursor.execute('UPDATE users SET is_banned = 1, ban_reason = ?, banned_date = ? WHERE user_id = ?',
+                    (reason, current_time.isoformat(), user_id))
+                cursor.execute("""UPDATE giveaways SET participant_count = participant_count - 1
+                    WHERE id IN (SELECT giveaway_id FROM participants WHERE user_id = ? AND is_valid = 1)""", (user_id,))
+                cursor.execute('UPDATE participants SET is_valid = 0 WHERE user_id = ?', (user_id,))
+            self.status_cache.invalidate(user_id)
+            publish('user', user_id)
             return True
         except:
             return False
 
     def unban_user(self, user_id):
         try:
-            self.cursor.execute('UPDATE users SET is_banned = 0, ban_reason = NULL, banned_date = NULL WHERE user_id = ?', (user_id,))
-            self.conn.commit()
+            with self.transaction() as cursor:
+                cursor.execute('UPDATE users SET is_banned = 0, ban_reason = NULL, banned_date = NULL WHERE user_id = ?', (user_id,))
+            self.status_cache.invalidate(user_id)
+            publish('user', user_id)
             return True
         except:
             return False
 
     def is_banned(self, user_id):
-        try:
-            self.cursor.execute('SELECT is_banned FROM users WHERE user_id = ?', (user_id,))
-            result = self.cursor.fetchone()
-            return result and result[0] == 1
-        except:
-            return False
+        return self.get_user_status(user_id)[0]
 
     def get_ban_info(self, user_id):
         try:
-            self.cursor.execute('SELECT ban_reason, banned_date FROM users WHERE user_id = ? AND is_banned = 1', (user_id,))
-            return self.cursor.fetchone()
+            return self.execute('SELECT ban_reason, banned_date FROM users WHERE user_id = ? AND is_banned = 1', (user_id,)).fetchone()
         except:
             return None
 
-    def get_banned_users(self):
+    def keyset_page(self, columns, source, where, params, keys, descending=False, after=None, before=None, limit=PAGE_SIZE):
+        backwards = before is not None
+        cursor = before if backwards else after
+        reverse = descending != backwards
+        clauses = [where]
+        params = list(params)
+        if cursor is not None:
+            clauses.append('(' + ', '.join(keys) + ') ' + ('<' if reverse else '>') + ' (' + ', '.join('?' * len(keys)) + ')')
+            params.extend(cursor)
+        sql = ('SELECT ' + columns + ', ' + ', '.join(keys) + ' FROM ' + source + ' WHERE ' + ' AND '.join(clauses) +
+               ' ORDER BY ' + ', '.join(key + (' DESC' if reverse else '') for key in keys) + ' LIMIT ?')
         try:
-            self.cursor.execute('SELECT user_id, username, first_name, ban_reason, banned_date FROM users WHERE is_banned = 1 ORDER BY banned_date DESC')
-            return self.cursor.fetchall()
-        except:
-            return []
+            rows = self.execute(sql, params + [limit + 1]).fetchall()
+        except Exception as e:
+            logger.error("Page query failed: " + str(e))
+            rows = []
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        width = len(keys)
+        return {'rows': [row[:-width] for row in rows],
+                'first': tuple(rows[0][-width:]) if rows else None,
+                'last': tuple(rows[-1][-width:]) if rows else None,
+                'has_prev': more if backwards else cursor is not None,
+                'has_next': cursor is not None if backwards else more}
+
+    def get_participants_page(self, giveaway_id, after=None, before=None, limit=PAGE_SIZE):
+        return self.keyset_page('p.user_id, u.username, u.first_name, u.is_banned, p.join_date',
+            'participants p LEFT JOIN users u ON p.user_id = u.user_id', 'p.giveaway_id = ? AND p.is_valid = 1', (giveaway_id,),
+            ('p.join_date', 'p.user_id'), after=after, before=before, limit=limit)
+
+    def get_banned_page(self, after=None, before=None, limit=PAGE_SIZE):
+        return self.keyset_page('user_id, username, first_name, ban_reason, banned_date', 'users', 'is_banned = 1', (),
+            ('banned_date', 'user_id'), descending=True, after=after, before=before, limit=limit)
+
+    def get_suspicious_ips_page(self, threshold=2, after=None, before=None, limit=PAGE_SIZE):
+        return self.keyset_page('ip_hash, user_count, last_seen', 'ip_addresses', 'user_count >= ?', (threshold,),
+            ('user_count', 'ip_hash'), descending=True, after=after, before=before, limit=limit)
 
     def add_ip_address(self, user_id, ip_address):
         try:
             ip_hash = hashlib.sha256(ip_address.encode()).hexdigest()[:32]
             current_time = datetime.now().isoformat()
-            self.cursor.execute('UPDATE users SET ip_hash = ? WHERE user_id = ?', (ip_hash, user_id))
-            self.cursor.execute('SELECT user_count FROM ip_addresses WHERE ip_hash = ?', (ip_hash,))
-            exists = self.cursor.fetchone()
-            if exists:
-                self.cursor.execute('UPDATE ip_addresses SET user_count = user_count + 1, last_seen = ? WHERE ip_hash = ?', (current_time, ip_hash))
-            else:
-                self.cursor.execute('INSERT INTO ip_addresses (ip_hash, user_count, first_seen, last_seen) VALUES (?, 1, ?, ?)', (ip_hash, current_time, current_time))
-            self.conn.commit()
+            self.write_behind.put('UPDATE users SET ip_hash = ? WHERE user_id = ?', (ip_hash, user_id), key=('ip_hash', user_id))
+            self.write_behind.put("""INSERT INTO ip_addresses (ip_hash, user_count, first_seen, last_seen) VALUES (?, 1, ?, ?)
+                ON CONFLICT(ip_hash) DO UPDATE SET user_count = user_count + 1, last_seen = excluded.last_seen""",
+                (ip_hash, current_time, current_time))
+            self.status_cache.set_ip_hash(user_id, ip_hash)
+            self.clusters.link_ip(user_id, ip_hash)
+            publish('ip', user_id, ip_hash)
             return ip_hash
         except:
             return None
 
-    def get_suspicious_ips(self, threshold=2):
+    def get_users_by_ips(self, ip_hashes):
+        users = {}
+        ip_hashes = list(ip_hashes)
+        if not ip_hashes:
+            return users
         try:
-            self.cursor.execute('SELECT ip_hash, user_count, last_seen FROM ip_addresses WHERE user_count >= ? ORDER BY user_count DESC', (threshold,))
-            return self.cursor.fetchall()
+            rows = self.execute('SELECT ip_hash, user_id, username, first_name, joined_date FROM users WHERE ip_hash IN (' + ','.join('?' * len(ip_hashes)) + ') ORDER BY ip_hash, joined_date',
+                ip_hashes).fetchall()
         except:
-            return []
-
-    def get_users_by_ip(self, ip_hash):
-        try:
-            self.cursor.execute('SELECT user_id, username, first_name, joined_date FROM users WHERE ip_hash = ? ORDER BY joined_date', (ip_hash,))
-            return self.cursor.fetchall()
-        except:
-            return []
+            return users
+        for row in rows:
+            users.setdefault(row[0], []).append(row[1:])
+        return users
+
+    def load_clusters(self):
+        for user_id, ip_hash in self.execute('SELECT user_id, ip_hash FROM users WHERE ip_hash IS NOT NULL'):
+            self.clusters.link_ip(user_id, ip_hash)
+        if self.clusters.by_referral:
+            for referrer_id, referred_id in self.execute('SELECT DISTINCT referrer_id, referred_id FROM referrals'):
+                self.clusters.link_referral(referrer_id, referred_id)
+        if self.clusters.join_window:
+            for giveaway_id, user_id, join_date in self.execute('SELECT giveaway_id, user_id, join_date FROM participants ORDER BY giveaway_id, join_date'):
+                try:
+                    self.clusters.record_join(giveaway_id, user_id, datetime.fromisoformat(join_date).timestamp())
+                except ValueError:
+                    pass
+        return self.clusters.stats()
 
     def check_multiple_accounts(self, user_id):
         try:
-            self.cursor.execute('SELECT user_id FROM users WHERE ip_hash = (SELECT ip_hash FROM users WHERE user_id = ?) AND user_id != ?', (user_id, user_id))
-            return [row[0] for row in self.cursor.fetchall()]
+            ip_hash = self.get_user_status(user_id)[2]
+            self.clusters.link_ip(user_id, ip_hash)
+            return [member for member in self.clusters.cluster(user_id) if member != user_id]
         except:
             return []
 
@@ -222,127 +918,1297 @@ class Database:
         try:
             start_date = datetime.now()
             end_date = start_date + timedelta(hours=hours)
-            self.cursor.execute("INSERT INTO giveaways (name, description, winner_count, start_date, end_date, is_active, channel_id, auto_finish, require_subscription) VALUES (?, ?, ?, ?, ?, 1, ?, 1, ?)",
-                (name, description, winners, start_date.isoformat(), end_date.isoformat(), channel_id, require_sub))
-            self.conn.commit()
-            return self.cursor.lastrowid
+            with self.transaction(durable=True) as cursor:
+                cursor.execute("INSERT INTO giveaways (name, description, winner_count, start_date, end_date, is_active, channel_id, auto_finish, require_subscription, draw_nonce) VALUES (?, ?, ?, ?, ?, 1, ?, 1, ?, ?)",
+                    (name, description, winners, start_date.isoformat(), end_date.isoformat(), channel_id, require_sub, secrets.token_hex(16)))
+                giveaway_id = cursor.lastrowid
+            self.referral_cache.clear()
+            publish('giveaways')
+            return giveaway_id
         except:
             return None
 
     def update_message_id(self, giveaway_id, message_id):
         try:
-            self.cursor.execute('UPDATE giveaways SET message_id = ? WHERE id = ?', (message_id, giveaway_id))
-            self.conn.commit()
+            with self.transaction() as cursor:
+                cursor.execute('UPDATE giveaways SET message_id = ? WHERE id = ?', (message_id, giveaway_id))
         except:
             pass
 
+    def credit_referral(self, cursor, giveaway_id, referrer_id, user_id, current_time):
+        if not referrer_id or referrer_id == user_id:
+            return False
+        cursor.execute('INSERT OR IGNORE INTO referrals (referrer_id, referred_id, giveaway_id, referral_date) VALUES (?, ?, ?, ?)',
+            (referrer_id, user_id, giveaway_id, current_time))
+        if cursor.rowcount != 1:
+            return False
+        cursor.executemany("""INSERT INTO referral_counts (giveaway_id, referrer_id, ref_count) VALUES (?, ?, 1)
+            ON CONFLICT(giveaway_id, referrer_id) DO UPDATE SET ref_count = ref_count + 1""",
+            [(giveaway_id, referrer_id), (GLOBAL_LEADERBOARD, referrer_id)])
+        cursor.execute('UPDATE participants SET bonus_entries = bonus_entries + 1 WHERE giveaway_id = ? AND user_id = ?',
+            (giveaway_id, referrer_id))
+        return True
+
+    def joined(self, giveaway_id, user_id, referred_by, credited, joined_at=None):
+        joined_at = time.time() if joined_at is None else joined_at
+        if credited:
+            self.referral_cache.invalidate(referred_by)
+            self.clusters.link_referral(referred_by, user_id)
+        self.clusters.record_join(giveaway_id, user_id, joined_at)
+        publish('joined', giveaway_id, user_id, referred_by, credited, joined_at)
+
     def add_participant(self, giveaway_id, user_id, referred_by=None):
         try:
             current_time = datetime.now().isoformat()
-            self.cursor.execute('INSERT INTO participants (giveaway_id, user_id, join_date, referred_by) VALUES (?, ?, ?, ?)',
-                (giveaway_id, user_id, current_time, referred_by))
-            if referred_by:
-                try:
-                    self.cursor.execute('INSERT INTO referrals (referrer_id, referred_id, giveaway_id, referral_date) VALUES (?, ?, ?, ?)',
-                        (referred_by, user_id, giveaway_id, current_time))
-                    self.cursor.execute('UPDATE participants SET bonus_entries = bonus_entries + 1 WHERE giveaway_id = ? AND user_id = ?',
-                        (giveaway_id, referred_by))
-                except:
-                    pass
-            self.conn.commit()
+            with self.transaction(durable=True) as cursor:
+                cursor.execute('INSERT INTO participants (giveaway_id, user_id, join_date, referred_by) VALUES (?, ?, ?, ?)',
+                    (giveaway_id, user_id, current_time, referred_by))
+                cursor.execute('UPDATE giveaways SET participant_count = participant_count + 1 WHERE id = ?', (giveaway_id,))
+                credited = self.credit_referral(cursor, giveaway_id, referred_by, user_id, current_time)
+            self.joined(giveaway_id, user_id, referred_by, credited)
             return True
         except:
             return False
 
+    def join_giveaway(self, giveaway_id, user_id, referred_by=None):
+        try:
+            now = datetime.now()
+            credited = False
+            with self.transaction(durable=True) as cursor:
+                giveaway = cursor.execute('SELECT * FROM giveaways WHERE id = ?', (giveaway_id,)).fetchone()
+                user = cursor.execute('SELECT is_banned, is_verified FROM users WHERE user_id = ?', (user_id,)).fetchone()
+                if user and user[0] == 1:
+                    return JOIN_BANNED, 0, giveaway
+                if not user or user[1] != 1:
+                    return JOIN_UNVERIFIED, 0, giveaway
+                if not giveaway or giveaway[6] == 0:
+                    return JOIN_CLOSED, 0, giveaway
+                if now > datetime.fromisoformat(giveaway[5]):
+                    return JOIN_EXPIRED, 0, giveaway
+                cursor.execute('INSERT OR IGNORE INTO participants (giveaway_id, user_id, join_date, referred_by) VALUES (?, ?, ?, ?)',
+                    (giveaway_id, user_id, now.isoformat(), referred_by))
+                status = JOIN_OK if cursor.rowcount == 1 else JOIN_ALREADY
+                if status == JOIN_OK:
+                    cursor.execute('UPDATE giveaways SET participant_count = participant_count + 1 WHERE id = ?', (giveaway_id,))
+                    credited = self.credit_referral(cursor, giveaway_id, referred_by, user_id, now.isoformat())
+                count = cursor.execute('SELECT participant_count FROM giveaways WHERE id = ?', (giveaway_id,)).fetchone()[0]
+            if status == JOIN_OK:
+                self.joined(giveaway_id, user_id, referred_by, credited)
+            return status, count, giveaway
+        except Exception as e:
+            logger.error("Error joining giveaway " + str(giveaway_id) + " for " + str(user_id) + ": " + str(e))
+            return JOIN_ERROR, 0, None
+
     def get_referral_count(self, user_id, giveaway_id):
         try:
-            self.cursor.execute('SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND giveaway_id = ?', (user_id, giveaway_id))
-            return self.cursor.fetchone()[0]
+            result = self.execute('SELECT ref_count FROM referral_counts WHERE giveaway_id = ? AND referrer_id = ?', (giveaway_id, user_id)).fetchone()
+            return result[0] if result else 0
         except:
             return 0
 
+    def get_user_names(self, user_ids):
+        names = {}
+        user_ids = list(user_ids)
+        try:
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                rows = self.execute('SELECT user_id, username, first_name, last_activity FROM users WHERE user_id IN (' + ','.join('?' * len(chunk)) + ')', chunk).fetchall()
+                for user_id, username, first_name, last_activity in rows:
+                    names[user_id] = (username, first_name, last_activity)
+        except:
+            pass
+        return names
+
+    def refresh_user_name(self, user_id, username, first_name):
+        self.write_behind.put('UPDATE users SET username = ?, first_name = ? WHERE user_id = ?',
+            (username, first_name, user_id), key=('name', user_id))
+
+    def get_referral_stats(self, user_id):
+        stats = self.referral_cache.get(user_id)
+        if stats is not None:
+            return stats
+        generation = self.referral_cache.generation
+        try:
+            stats = self.execute("""SELECT g.id, g.name, g.winner_count, g.end_date, g.require_subscription,
+                COALESCE(c.ref_count, 0), COALESCE(p.bonus_entries, 0)
+                FROM giveaways g
+                LEFT JOIN referral_counts c ON c.giveaway_id = g.id AND c.referrer_id = ?
+                LEFT JOIN participants p ON p.giveaway_id = g.id AND p.user_id = ?
+                WHERE g.is_active = 1 ORDER BY g.end_date""", (user_id, user_id)).fetchall()
+        except:
+            return []
+        self.referral_cache.put(user_id, stats, generation)
+        return stats
+
     def get_bonus_entries(self, user_id, giveaway_id):
         try:
-            self.cursor.execute('SELECT bonus_entries FROM participants WHERE giveaway_id = ? AND user_id = ?', (giveaway_id, user_id))
-            result = self.cursor.fetchone()
+            result = self.execute('SELECT bonus_entries FROM participants WHERE giveaway_id = ? AND user_id = ?', (giveaway_id, user_id)).fetchone()
             return result[0] if result else 0
         except:
             return 0
 
-    def get_top_referrers(self, limit=10):
+    def get_top_referrers(self, limit=10, giveaway_id=GLOBAL_LEADERBOARD):
         try:
-            self.cursor.execute("""SELECT r.referrer_id, u.username, u.first_name, COUNT(r.referred_id) as ref_count
-                FROM referrals r LEFT JOIN users u ON r.referrer_id = u.user_id
-                GROUP BY r.referrer_id ORDER BY ref_count DESC LIMIT ?""", (limit,))
-            return self.cursor.fetchall()
+            return self.execute("""SELECT c.referrer_id, u.username, u.first_name, c.ref_count
+                FROM referral_counts c LEFT JOIN users u ON c.referrer_id = u.user_id
+                WHERE c.giveaway_id = ? ORDER BY c.ref_count DESC, c.referrer_id LIMIT ?""", (giveaway_id, limit)).fetchall()
         except:
             return []
 
     def remove_participant(self, giveaway_id, user_id):
         try:
-            self.cursor.execute('UPDATE participants SET is_valid = 0 WHERE giveaway_id = ? AND user_id = ?', (giveaway_id, user_id))
-            self.conn.commit()
-            return self.cursor.rowcount > 0
+            with self.transaction() as cursor:
+                cursor.execute('UPDATE participants SET is_valid = 0 WHERE giveaway_id = ? AND user_id = ? AND is_valid = 1', (giveaway_id, user_id))
+                if cursor.rowcount == 0:
+                    return False
+                cursor.execute('UPDATE giveaways SET participant_count = participant_count - 1 WHERE id = ?', (giveaway_id,))
+                return True
         except:
             return False
 
     def get_active_giveaways(self):
         try:
-            self.cursor.execute('SELECT id, name, winner_count, end_date, require_subscription FROM giveaways WHERE is_active = 1 ORDER BY end_date')
-            return self.cursor.fetchall()
+            return self.execute('SELECT id, name, winner_count, end_date, require_subscription FROM giveaways WHERE is_active = 1 ORDER BY end_date').fetchall()
         except:
             return []
 
     def get_giveaway_info(self, giveaway_id):
         try:
-            self.cursor.execute('SELECT * FROM giveaways WHERE id = ?', (giveaway_id,))
-            return self.cursor.fetchone()
+            return self.execute('SELECT * FROM giveaways WHERE id = ?', (giveaway_id,)).fetchone()
         except:
             return None
 
-    def get_participants(self, giveaway_id, valid_only=True):
-        try:
-            if valid_only:
-                self.cursor.execute('SELECT user_id FROM participants WHERE giveaway_id = ? AND is_valid = 1', (giveaway_id,))
-            else:
-                self.cursor.execute('SELECT user_id FROM participants WHERE giveaway_id = ?', (giveaway_id,))
-            return [row[0] for row in self.cursor.fetchall()]
-        except:
-            return []
+    def iter_participant_weights(self, giveaway_id):
+        cursor = self.execute('SELECT user_id, 1 + bonus_entries FROM participants WHERE giveaway_id = ? AND is_valid = 1 ORDER BY user_id', (giveaway_id,))
+        for row in cursor:
+            yield row
 
-    def get_participants_with_info(self, giveaway_id):
-        try:
-            self.cursor.execute("SELECT p.user_id, u.username, u.first_name, u.is_banned, p.join_date FROM participants p LEFT JOIN users u ON p.user_id = u.user_id WHERE p.giveaway_id = ? AND p.is_valid = 1 ORDER BY p.join_date",
-                (giveaway_id,))
-            return self.cursor.fetchall()
-        except:
-            return []
+    def iter_export_rows(self, giveaway_id):
+        cursor = self.execute("""SELECT p.user_id, u.username, u.first_name, p.join_date, p.is_valid, p.bonus_entries,
+            p.referred_by, COALESCE(c.ref_count, 0), COALESCE(u.is_banned, 0)
+            FROM participants p LEFT JOIN users u ON u.user_id = p.user_id
+            LEFT JOIN referral_counts c ON c.giveaway_id = p.giveaway_id AND c.referrer_id = p.user_id
+            WHERE p.giveaway_id = ? ORDER BY p.user_id""", (giveaway_id,))
+        for row in cursor:
+            yield row
 
     def get_participants_count(self, giveaway_id):
         try:
-            self.cursor.execute('SELECT COUNT(*) FROM participants WHERE giveaway_id = ? AND is_valid = 1', (giveaway_id,))
-            return self.cursor.fetchone()[0]
+            row = self.execute('SELECT participant_count FROM giveaways WHERE id = ?', (giveaway_id,)).fetchone()
+            return row[0] if row else 0
         except:
             return 0
 
+    def reconcile_participant_counts(self, active_only=True):
+        try:
+            rows = self.execute("""SELECT g.id, g.participant_count,
+                (SELECT COUNT(*) FROM participants p WHERE p.giveaway_id = g.id AND p.is_valid = 1)
+                FROM giveaways g""" + (' WHERE g.is_active = 1' if active_only else '')).fetchall()
+            drift = [(giveaway_id, stored, actual) for giveaway_id, stored, actual in rows if stored != actual]
+            if drift:
+                with self.transaction() as cursor:
+                    cursor.executemany('UPDATE giveaways SET participant_count = participant_count + ? WHERE id = ?',
+                        [(actual - stored, giveaway_id) for giveaway_id, stored, actual in drift])
+            return len(rows), drift
+        except Exception as e:
+            logger.error("Error reconciling participant counts: " + str(e))
+            return 0, []
+
     def end_giveaway(self, giveaway_id):
         try:
-            self.cursor.execute('UPDATE giveaways SET is_active = 0 WHERE id = ?', (giveaway_id,))
-            self.conn.commit()
+            with self.transaction(durable=True) as cursor:
+                cursor.execute('UPDATE giveaways SET is_active = 0 WHERE id = ?', (giveaway_id,))
+            self.referral_cache.clear()
+            publish('giveaways')
             return True
         except:
             return False
 
-    def get_giveaways_to_finish(self):
+    def get_draw_nonce(self, giveaway_id):
+        with self.transaction() as cursor:
+            cursor.execute('SELECT draw_nonce FROM giveaways WHERE id = ?', (giveaway_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            if row[0]:
+                return row[0]
+            nonce = secrets.token_hex(16)
+            cursor.execute('UPDATE giveaways SET draw_nonce = ? WHERE id = ?', (nonce, giveaway_id))
+            return nonce
+
+    def record_draw(self, giveaway_id, draw):
         try:
-            current_time = datetime.now().isoformat()
-            self.cursor.execute('SELECT id FROM giveaways WHERE is_active = 1 AND auto_finish = 1 AND end_date <= ?', (current_time,))
-            return [row[0] for row in self.cursor.fetchall()]
+            with self.transaction(durable=True) as cursor:
+                cursor.execute("""INSERT INTO draws (giveaway_id, draw_date, algorithm, nonce, participants_digest, participant_count,
+                    total_weight, seed, winner_count, winners, excluded) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (giveaway_id, datetime.now().isoformat(), draw['algorithm'], draw['nonce'], draw['digest'], draw['count'],
+                     draw['total_weight'], draw['seed'], draw['winner_count'], json.dumps(draw['winners']), json.dumps(draw['excluded'])))
+                return cursor.lastrowid
+        except Exception as e:
+            logger.error("Error recording draw for giveaway " + str(giveaway_id) + ": " + str(e))
+            return None
+
+    def get_draw(self, draw_id):
+        try:
+            return self.execute("""SELECT id, giveaway_id, draw_date, algorithm, nonce, participants_digest, participant_count,
+                total_weight, seed, winner_count, winners, excluded FROM draws WHERE id = ?""", (draw_id,)).fetchone()
+        except:
+            return None
+
+    def get_last_draw_id(self, giveaway_id):
+        try:
+            row = self.execute('SELECT MAX(id) FROM draws WHERE giveaway_id = ?', (giveaway_id,)).fetchone()
+            return row[0] if row else None
+        except:
+            return None
+
+    def get_scheduled_giveaways(self):
+        try:
+            return self.execute('SELECT id, end_date FROM giveaways WHERE is_active = 1 AND auto_finish = 1').fetchall()
         except:
             return []
 
-db = Database()
-captcha_storage = {}
+def count_statement(statement):
+    metrics.inc('db_statements_total')
+
+instrument_methods(Database, 'db_method_seconds', skip=('connection', 'release', 'execute', 'transaction', 'snapshot', 'apply_pending', 'record_lock_wait', 'lock_stats', 'close',
+                                                      'credit_referral', 'joined'))
+
+def weighted_sample(rows, k, rng=random):
+    heap = []
+    rows = iter(rows)
+    if k <= 0:
+        return []
+    for user_id, weight in rows:
+        if weight <= 0:
+            continue
+        heap.append(((1.0 - rng.random()) ** (1.0 / weight), user_id))
+        if len(heap) == k:
+            break
+    heapq.heapify(heap)
+    if len(heap) == k and heap[0][0] < 1.0:
+        threshold = heap[0][0]
+        skip = math.log(1.0 - rng.random()) / math.log(threshold)
+        for user_id, weight in rows:
+            if weight <= 0:
+                continue
+            skip -= weight
+            if skip > 0:
+                continue
+            key = rng.uniform(threshold ** weight, 1.0) ** (1.0 / weight)
+            heapq.heapreplace(heap, (key, user_id))
+            threshold = heap[0][0]
+            if threshold >= 1.0:
+                break
+            skip = math.log(1.0 - rng.random()) / math.log(threshold)
+    return [user_id for key, user_id in sorted(heap, reverse=True)]
+
+def participants_digest(rows):
+    digest = hashlib.sha256()
+    count = 0
+    total_weight = 0
+    for user_id, weight in rows:
+        digest.update((str(user_id) + ":" + str(weight) + "\n").encode())
+        count += 1
+        total_weight += weight
+    return digest.hexdigest(), count, total_weight
+
+def draw_seed(digest, nonce):
+    return hashlib.sha256((DRAW_ALGORITHM + ":" + digest + ":" + nonce).encode()).hexdigest()
+
+def run_draw(rows_factory, winner_count, nonce, exclude=()):
+    exclude = set(exclude)
+    excluded = set()
+
+    def eligible():
+        for user_id, weight in rows_factory():
+            if user_id in exclude:
+                excluded.add(user_id)
+                continue
+            yield user_id, weight
+
+    digest, count, total_weight = participants_digest(eligible())
+    seed = draw_seed(digest, nonce)
+    winners = weighted_sample(eligible(), winner_count, random.Random(int(seed, 16)))
+    return {'algorithm': DRAW_ALGORITHM, 'nonce': nonce, 'digest': digest, 'count': count,
+            'total_weight': total_weight, 'seed': seed, 'winner_count': winner_count, 'winners': winners,
+            'excluded': sorted(excluded)}
+
+def draw_giveaway(database, giveaway_id, winner_count, exclude_size=CLUSTER_EXCLUDE_SIZE):
+    nonce = database.get_draw_nonce(giveaway_id)
+    exclude = database.clusters.large_members(exclude_size) if exclude_size else ()
+    with database.snapshot():
+        return run_draw(lambda: database.iter_participant_weights(giveaway_id), winner_count, nonce, exclude)
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_COLUMNS = ('user_id', 'username', 'first_name', 'join_date', 'is_valid', 'bonus_entries',
+                  'referred_by', 'referrals', 'is_banned', 'winner')
+
+def export_giveaway(database, giveaway_id, path, fmt='csv'):
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=EXPORT_GZIP_LEVEL) as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(EXPORT_COLUMNS)
+        with database.snapshot():
+            draw_id = database.get_last_draw_id(giveaway_id)
+            draw = database.get_draw(draw_id) if draw_id else None
+            winners = set(json.loads(draw[10])) if draw else set()
+            for row in database.iter_export_rows(giveaway_id):
+                row = row + (1 if row[0] in winners else 0,)
+                if writer:
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n')
+                count += 1
+    metrics.inc('export_rows_total', count, format=fmt)
+    return count
+
+class CounterReconciler:
+    def __init__(self, database, interval=RECONCILE_INTERVAL):
+        self.db = database
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.runs = 0
+        self.drift = 0
+
+    def start(self):
+        if self.interval > 0:
+            threading.Thread(target=self.run, name='reconcile', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.check()
+            self.stopped.wait(self.interval)
+
+    def check(self, active_only=True):
+        checked, drift = self.db.reconcile_participant_counts(active_only)
+        self.runs += 1
+        self.drift += len(drift)
+        for giveaway_id, stored, actual in drift:
+            logger.warning("Participant counter for giveaway " + str(giveaway_id) + " was " + str(stored) + ", actual " + str(actual))
+        return checked, drift
+
+class AsyncDatabase:
+    def __init__(self, database, workers=DB_EXECUTOR_WORKERS):
+        self.db = database
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+        return call
+
+    async def get_user_status(self, user_id):
+        status = self.db.status_cache.get(user_id)
+        if status is not None:
+            return status
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.db.get_user_status, user_id)
+
+    async def is_banned(self, user_id):
+        return (await self.get_user_status(user_id))[0]
+
+    async def is_verified(self, user_id):
+        return (await self.get_user_status(user_id))[1]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+class GiveawayScheduler:
+    def __init__(self, database):
+        self.db = database
+        self.finish = None
+        self.heap = []
+        self.deadlines = {}
+        self.condition = threading.Condition()
+        self.listeners = []
+        self.stopped = False
+        self.thread = None
+
+    def notify(self):
+        self.condition.notify()
+        for listener in self.listeners:
+            listener()
+
+    def load(self):
+        for giveaway_id, end_date in self.db.get_scheduled_giveaways():
+            self.schedule(giveaway_id, end_date)
+
+    def schedule(self, giveaway_id, end_date):
+        if isinstance(end_date, str):
+            end_date = datetime.fromisoformat(end_date)
+        deadline = end_date.timestamp()
+        with self.condition:
+            self.deadlines[giveaway_id] = deadline
+            heapq.heappush(self.heap, (deadline, giveaway_id))
+            self.notify()
+        publish('schedule', giveaway_id, deadline)
+
+    def cancel(self, giveaway_id):
+        with self.condition:
+            if self.deadlines.pop(giveaway_id, None) is not None:
+                self.notify()
+        publish('cancel', giveaway_id)
+
+    def retry(self, giveaway_id):
+        giveaway_info = self.db.get_giveaway_info(giveaway_id)
+        if not giveaway_info or not giveaway_info[6]:
+            return
+        with self.condition:
+            if giveaway_id in self.deadlines:
+                return
+            self.schedule(giveaway_id, datetime.fromtimestamp(time.time() + FINISH_RETRY_DELAY))
+        logger.warning("Giveaway " + str(giveaway_id) + " is still active, retrying in " + str(FINISH_RETRY_DELAY) + "s")
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, giveaway_id = heapq.heappop(self.heap)
+            if self.deadlines.get(giveaway_id) == deadline:
+                del self.deadlines[giveaway_id]
+                due.append(giveaway_id)
+        return due
+
+    def next_delay(self, now):
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - now)
+
+    def start(self, finish):
+        self.finish = finish
+        self.load()
+        self.thread = threading.Thread(target=self.run, name='giveaway-scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.notify()
+
+    async def run_async(self, finish, executor=None):
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self.listeners.append(lambda: loop.call_soon_threadsafe(wakeup.set))
+        self.finish = finish
+        self.load()
+        while not self.stopped:
+            wakeup.clear()
+            with self.condition:
+                now = time.time()
+                due = self.pop_due(now)
+                delay = None if due else self.next_delay(now)
+            for giveaway_id in due:
+                try:
+                    await loop.run_in_executor(executor, self.finish, giveaway_id)
+                except Exception as e:
+                    logger.error("Auto-finish error: " + str(e))
+                await loop.run_in_executor(executor, self.retry, giveaway_id)
+            if due:
+                continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def run(self):
+        while True:
+            with self.condition:
+                due = []
+                while not self.stopped:
+                    now = time.time()
+                    due = self.pop_due(now)
+                    if due:
+                        break
+                    self.condition.wait(self.next_delay(now))
+                if self.stopped:
+                    return
+            for giveaway_id in due:
+                try:
+                    self.finish(giveaway_id)
+                except Exception as e:
+                    logger.error("Auto-finish error: " + str(e))
+                self.retry(giveaway_id)
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class OutboundRequest:
+    def __init__(self, lane, chat_id, method, kwargs):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+        self.created = time.monotonic()
+
+class Outbox:
+    def __init__(self, global_rate=OUTBOX_GLOBAL_RATE, private_rate=OUTBOX_PRIVATE_RATE, group_rate=OUTBOX_GROUP_RATE, senders=OUTBOX_SENDERS):
+        self.bot = None
+        self.lanes = [deque(), deque(), deque()]
+        self.condition = threading.Condition()
+        self.global_bucket = TokenBucket(global_rate, 1.0)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_buckets = {}
+        self.in_flight = set()
+        self.senders = senders
+        self.threads = []
+        self.stopped = False
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self, bot):
+        self.bot = bot
+        for i in range(self.senders):
+            thread = threading.Thread(target=self.run, name='outbox-' + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.pending() and time.monotonic() < deadline:
+                self.condition.wait(0.1)
+            self.stopped = True
+            self.condition.notify_all()
+
+    def pending(self):
+        return sum(len(lane) for lane in self.lanes) + len(self.in_flight)
+
+    def submit(self, lane, target, method, **kwargs):
+        request = OutboundRequest(lane, target, method, kwargs)
+        with self.condition:
+            self.lanes[lane].append(request)
+            self.condition.notify()
+        return request.future
+
+    def send_message(self, chat_id, text, lane=LANE_DM, **kwargs):
+        return self.submit(lane, chat_id, 'send_message', chat_id=chat_id, text=text, **kwargs)
+
+    def edit_message_text(self, chat_id, message_id, text, lane=LANE_CHANNEL, **kwargs):
+        return self.submit(lane, chat_id, 'edit_message_text', chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+
+    def send_document(self, chat_id, path, filename, lane=LANE_DM, **kwargs):
+        with open(path, 'rb') as f:
+            document = InputFile(f, filename=filename)
+        return self.submit(lane, chat_id, 'send_document', chat_id=chat_id, document=document, **kwargs)
+
+    def get_chat(self, chat_id, lane=LANE_DM):
+        return self.submit(lane, None, 'get_chat', chat_id=chat_id)
+
+    def answer_callback(self, query, text=None, show_alert=False):
+        return self.submit(LANE_CALLBACK, None, 'answer_callback_query', callback_query_id=query.id, text=text, show_alert=show_alert)
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 50000:
+                now = time.monotonic()
+                for key in [key for key, b in self.chat_buckets.items() if b.delay(now) == 0 and b.tokens >= b.capacity]:
+                    del self.chat_buckets[key]
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(self.private_rate if private else self.group_rate, 1.0)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def next_request(self, now):
+        wait = self.global_bucket.delay(now)
+        if wait > 0:
+            return None, wait
+        wait = None
+        for lane in self.lanes:
+            for index, request in enumerate(lane):
+                if index >= 100:
+                    break
+                if request.chat_id is None:
+                    delay = 0.0
+                elif request.chat_id in self.in_flight:
+                    continue
+                else:
+                    delay = self.chat_bucket(request.chat_id).delay(now)
+                if delay == 0:
+                    del lane[index]
+                    self.global_bucket.consume(now)
+                    if request.chat_id is not None:
+                        self.chat_bucket(request.chat_id).consume(now)
+                    return request, 0
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def run(self):
+        while True:
+            with self.condition:
+                request = None
+                while not self.stopped:
+                    request, wait = self.next_request(time.monotonic())
+                    if request is not None:
+                        break
+                    self.condition.wait(wait)
+                if request is None:
+                    return
+                if request.chat_id is not None:
+                    self.in_flight.add(request.chat_id)
+            self.execute(request)
+            with self.condition:
+                self.in_flight.discard(request.chat_id)
+                self.condition.notify_all()
+
+    def execute(self, request):
+        request.attempts += 1
+        try:
+            result = getattr(self.bot, request.method)(**request.kwargs)
+        except RetryAfter as e:
+            self.retried += 1
+            with self.condition:
+                if request.chat_id is not None:
+                    self.chat_bucket(request.chat_id).block(e.retry_after)
+                else:
+                    self.global_bucket.block(e.retry_after)
+                self.lanes[request.lane].appendleft(request)
+            return
+        except NetworkError as e:
+            if request.attempts < OUTBOX_MAX_RETRIES and not isinstance(e, BadRequest):
+                self.retried += 1
+                with self.condition:
+                    if request.chat_id is not None:
+                        self.chat_bucket(request.chat_id).block(request.attempts)
+                    self.lanes[request.lane].append(request)
+                return
+            self.failed += 1
+            logger.warning("Outbound " + request.method + " failed: " + str(e))
+            request.future.set_exception(e)
+            return
+        except Exception as e:
+            self.failed += 1
+            request.future.set_exception(e)
+            return
+        self.sent += 1
+        request.future.set_result(result)
+
+class LivePostUpdater:
+    def __init__(self, database, interval=LIVE_POST_INTERVAL, refresh=LIVE_POST_REFRESH):
+        self.db = database
+        self.interval = interval
+        self.refresh = refresh
+        self.due = {}
+        self.last_edit = {}
+        self.last_text = {}
+        self.in_flight = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.next_refresh = time.monotonic() + refresh
+        self.forward = False
+        self.edits = 0
+        self.skipped = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='live-posts', daemon=True)
+        thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def remember(self, giveaway_id, text):
+        with self.condition:
+            self.last_text[giveaway_id] = text
+            self.last_edit[giveaway_id] = time.monotonic()
+        publish('remember', giveaway_id, text)
+
+    def touch(self, giveaway_id):
+        with self.condition:
+            if giveaway_id in self.due:
+                return
+            self.due[giveaway_id] = max(time.monotonic(), self.last_edit.get(giveaway_id, 0) + self.interval)
+            self.condition.notify()
+
+    def forget(self, giveaway_id):
+        with self.condition:
+            self.due.pop(giveaway_id, None)
+            self.last_edit.pop(giveaway_id, None)
+            self.last_text.pop(giveaway_id, None)
+            self.in_flight.pop(giveaway_id, None)
+        publish('forget', giveaway_id)
+
+    def run(self):
+        while True:
+            with self.condition:
+                ready = []
+                while not self.stopped:
+                    now = time.monotonic()
+                    if now >= self.next_refresh:
+                        break
+                    ready = [gid for gid, at in self.due.items() if at <= now]
+                    if ready:
+                        break
+                    wake = min([self.next_refresh] + list(self.due.values()))
+                    self.condition.wait(wake - now)
+                if self.stopped:
+                    return
+                for giveaway_id in ready:
+                    del self.due[giveaway_id]
+                    self.last_edit[giveaway_id] = now
+            if not ready:
+                self.next_refresh = now + self.refresh
+                if not self.forward:
+                    for giveaway in self.db.get_active_giveaways():
+                        self.touch(giveaway[0])
+                continue
+            for giveaway_id in ready:
+                if self.forward:
+                    publish('touch', giveaway_id)
+                    continue
+                try:
+                    self.render(giveaway_id)
+                except Exception as e:
+                    logger.error("Live post update error: " + str(e))
+
+    def render(self, giveaway_id):
+        pending = self.in_flight.get(giveaway_id)
+        if pending is not None and not pending.done():
+            self.touch(giveaway_id)
+            return
+        giveaway_info = self.db.get_giveaway_info(giveaway_id)
+        if not giveaway_info or giveaway_info[6] == 0 or not giveaway_info[7]:
+            self.forget(giveaway_id)
+            return
+        text = giveaway_post_text(giveaway_info, self.db.get_participants_count(giveaway_id))
+        if self.last_text.get(giveaway_id) == text:
+            self.skipped += 1
+            return
+        self.last_text[giveaway_id] = text
+        self.edits += 1
+        self.in_flight[giveaway_id] = outbox.edit_message_text(giveaway_info[8], giveaway_info[7], text, reply_markup=join_markup(giveaway_id))
+
+class SubscriptionCache:
+    def __init__(self, positive_ttl=SUB_CACHE_POSITIVE_TTL, negative_ttl=SUB_CACHE_NEGATIVE_TTL, max_size=SUB_CACHE_SIZE, workers=SUB_CHECK_WORKERS):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sub-check')
+        self.slots = threading.BoundedSemaphore(workers * 4)
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def cached(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def store(self, key, status):
+        ttl = self.positive_ttl if status else self.negative_ttl
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, status)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.in_flight.pop(key, None)
+
+    def fetch(self, bot, key):
+        channel_id, user_id = key
+        try:
+            member = bot.get_chat_member(channel_id, user_id)
+            status = member.status in ['member', 'administrator', 'creator']
+        except BadRequest:
+            status = False
+        except Exception as e:
+            logger.warning("Subscription check failed for " + str(user_id) + ": " + str(e))
+            with self.lock:
+                self.in_flight.pop(key, None)
+            return False
+        self.store(key, status)
+        return status
+
+    def lookup(self, bot, user_id, channel_id):
+        key = (channel_id, user_id)
+        with self.lock:
+            status = self.cached(key)
+            if status is not None:
+                self.hits += 1
+                future = Future()
+                future.set_result(status)
+                return future
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+                return future
+            self.misses += 1
+            future = self.executor.submit(self.fetch, bot, key)
+            self.in_flight[key] = future
+            return future
+
+    def check(self, bot, user_id, channel_id):
+        try:
+            return self.lookup(bot, user_id, channel_id).result(timeout=SUB_CHECK_TIMEOUT)
+        except Exception:
+            return False
+
+    def prewarm(self, bot, user_ids, channel_id):
+        scheduled = 0
+        for user_id in user_ids:
+            with self.lock:
+                known = self.cached((channel_id, user_id)) is not None or (channel_id, user_id) in self.in_flight
+            if known:
+                continue
+            self.slots.acquire()
+            self.lookup(bot, user_id, channel_id).add_done_callback(lambda f: self.slots.release())
+            scheduled += 1
+        return scheduled
+
+    def invalidate(self, user_id, channel_id):
+        with self.lock:
+            self.entries.pop((channel_id, user_id), None)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'shared': self.shared, 'in_flight': len(self.in_flight)}
+
+class InFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.collapsed = 0
+
+    def claim(self, key):
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.collapsed += 1
+                return future, False
+            future = self.calls[key] = Future()
+        future.add_done_callback(lambda f: self.release(key, f))
+        return future, True
+
+    def release(self, key, future):
+        with self.lock:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+
+    def run(self, key, fn):
+        future, leader = self.claim(key)
+        if leader:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result(), leader
+
+    def size(self):
+        with self.lock:
+            return len(self.calls)
+
+class UpdateRateLimiter:
+    def __init__(self, user_rate=RATE_LIMIT_USER_RATE, user_burst=RATE_LIMIT_USER_BURST, global_rate=RATE_LIMIT_GLOBAL_RATE,
+                 global_burst=RATE_LIMIT_GLOBAL_BURST, max_defer=RATE_LIMIT_MAX_DEFER, max_users=RATE_LIMIT_MAX_USERS):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self.max_defer = max_defer
+        self.max_users = max_users
+        self.next_sweep = max_users
+        self.users = {}
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.dropped = {'user': 0, 'global': 0}
+        self.deferred = 0
+        self.deferred_seconds = 0.0
+
+    def admit(self, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.user_rate > 0:
+                tokens, updated, warned = self.users.get(user_id, (self.user_burst, now, False))
+                tokens = min(self.user_burst, tokens + (now - updated) * self.user_rate)
+                if tokens < 1:
+                    self.users[user_id] = (tokens, now, True)
+                    self.dropped['user'] += 1
+                    return (RATE_DROP if warned else RATE_NOTIFY), 0.0
+                self.users[user_id] = (tokens - 1, now, False)
+                if len(self.users) >= self.next_sweep:
+                    self.sweep(now)
+            delay = 0.0
+            if self.global_bucket is not None:
+                delay = self.global_bucket.delay(now)
+                if delay > self.max_defer:
+                    self.dropped['global'] += 1
+                    return RATE_DROP, delay
+                self.global_bucket.consume(now)
+                if delay > 0:
+                    self.deferred += 1
+                    self.deferred_seconds += delay
+            self.allowed += 1
+            return RATE_OK, delay
+
+    def sweep(self, now):
+        full = [user_id for user_id, (tokens, updated, warned) in self.users.items()
+                if tokens + (now - updated) * self.user_rate >= self.user_burst]
+        for user_id in full:
+            del self.users[user_id]
+        self.next_sweep = max(self.max_users, len(self.users) + self.max_users // 4)
+
+    def size(self):
+        with self.lock:
+            return len(self.users)
+
+class CaptchaStore:
+    def __init__(self, ttl=CAPTCHA_TTL, grace=CAPTCHA_GRACE, max_size=CAPTCHA_MAX):
+        self.ttl = ttl
+        self.grace = grace
+        self.max_size = max_size
+        self.entries = {}
+        self.heap = []
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def sweep(self, now):
+        while self.heap and (self.heap[0][0] <= now or len(self.entries) > self.max_size):
+            _, user_id, sequence = heapq.heappop(self.heap)
+            entry = self.entries.get(user_id)
+            if entry is not None and entry['sequence'] == sequence:
+                del self.entries[user_id]
+                self.evicted += 1
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(entry['expires_at'] + self.grace, user_id, entry['sequence']) for user_id, entry in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def issue(self, user_id, answer, ip_hash=None):
+        now = time.time()
+        with self.lock:
+            self.sequence += 1
+            entry = {'answer': answer, 'attempts': 0, 'ip_hash': ip_hash, 'expires_at': now + self.ttl, 'sequence': self.sequence}
+            self.entries[user_id] = entry
+            heapq.heappush(self.heap, (entry['expires_at'] + self.grace, user_id, self.sequence))
+            self.sweep(now)
+
+    def get(self, user_id):
+        now = time.time()
+        with self.lock:
+            self.sweep(now)
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            return {'answer': entry['answer'], 'attempts': entry['attempts'], 'ip_hash': entry['ip_hash'],
+                    'expired': now > entry['expires_at']}
+
+    def fail(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return CAPTCHA_MAX_ATTEMPTS
+            entry['attempts'] += 1
+            return entry['attempts']
+
+    def discard(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def size(self):
+        with self.lock:
+            return len(self.entries)
+
+class SQLiteCaptchaStore:
+    def __init__(self, database, ttl=CAPTCHA_TTL, grace=CAPTCHA_GRACE, max_size=CAPTCHA_MAX, sweep_interval=1.0):
+        self.db = database
+        self.ttl = ttl
+        self.grace = grace
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self.next_sweep = 0.0
+        self.evicted = 0
+
+    def sweep(self, cursor, now):
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.sweep_interval
+        cursor.execute('DELETE FROM captchas WHERE expires_at <= ?', (now - self.grace,))
+        self.evicted += cursor.rowcount
+        excess = cursor.execute('SELECT COUNT(*) FROM captchas').fetchone()[0] - self.max_size
+        if excess > 0:
+            cursor.execute('DELETE FROM captchas WHERE user_id IN (SELECT user_id FROM captchas ORDER BY expires_at LIMIT ?)', (excess,))
+            self.evicted += cursor.rowcount
+
+    def issue(self, user_id, answer, ip_hash=None):
+        now = time.time()
+        with self.db.transaction() as cursor:
+            cursor.execute('INSERT OR REPLACE INTO captchas (user_id, answer, attempts, ip_hash, expires_at) VALUES (?, ?, 0, ?, ?)',
+                           (user_id, answer, ip_hash, now + self.ttl))
+            self.sweep(cursor, now)
+
+    def get(self, user_id):
+        now = time.time()
+        row = self.db.execute('SELECT answer, attempts, ip_hash, expires_at FROM captchas WHERE user_id = ? AND expires_at > ?',
+                              (user_id, now - self.grace)).fetchone()
+        if not row:
+            return None
+        return {'answer': row[0], 'attempts': row[1], 'ip_hash': row[2], 'expired': now > row[3]}
+
+    def fail(self, user_id):
+        with self.db.transaction() as cursor:
+            row = cursor.execute('UPDATE captchas SET attempts = attempts + 1 WHERE user_id = ? RETURNING attempts', (user_id,)).fetchone()
+        return row[0] if row else CAPTCHA_MAX_ATTEMPTS
+
+    def discard(self, user_id):
+        with self.db.transaction() as cursor:
+            cursor.execute('DELETE FROM captchas WHERE user_id = ?', (user_id,))
+
+    def size(self):
+        with closing(sqlite3.connect(self.db.db_name, timeout=DB_BUSY_TIMEOUT)) as conn:
+            return conn.execute('SELECT COUNT(*) FROM captchas WHERE expires_at > ?', (time.time() - self.grace,)).fetchone()[0]
+
+class InstrumentedRequest(Request):
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return super().post(url, data, timeout=timeout)
+        except RetryAfter:
+            outcome = 'retry_after'
+            raise
+        except BadRequest:
+            outcome = 'bad_request'
+            raise
+        except NetworkError:
+            outcome = 'network_error'
+            raise
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            metrics.observe('telegram_request_seconds', time.perf_counter() - started, method=method)
+            metrics.inc('telegram_requests_total', method=method, outcome=outcome)
+
+def start_metrics_server(port=METRICS_PORT, listen=METRICS_LISTEN):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((listen, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+def start_dispatcher(dispatcher):
+    if dispatcher.running:
+        return
+    ready = threading.Event()
+    threading.Thread(target=dispatcher.start, kwargs={'ready': ready}, name='dispatcher', daemon=True).start()
+    ready.wait()
+
+class WebhookHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class WebhookServer:
+    def __init__(self, bot, overloaded, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=None, queue_size=WEBHOOK_QUEUE_SIZE, batch_size=WEBHOOK_BATCH_SIZE):
+        self.bot = bot
+        self.overloaded = overloaded
+        self.path = path or '/' + hashlib.sha256(bot.token.encode()).hexdigest()[:32]
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.accepted = 0
+        self.rejected = 0
+        self.server = WebhookHTTPServer((listen, port), self.handler_class())
+        self.threads = []
+
+    def handler_class(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                if self.path != webhook.path:
+                    self.reply(404)
+                    return
+                if not webhook.offer(body):
+                    self.reply(503, {'Retry-After': '1'})
+                    return
+                self.reply(200)
+
+        return Handler
+
+    def offer(self, body):
+        if self.overloaded():
+            self.rejected += 1
+            return False
+        try:
+            self.queue.put_nowait(body)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    def next_bodies(self, timeout=None):
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def next_batch(self, timeout=None):
+        updates = []
+        for body in self.next_bodies(timeout):
+            try:
+                updates.append(Update.de_json(json.loads(body), self.bot))
+            except Exception as e:
+                logger.warning("Bad webhook update: " + str(e))
+        return updates
+
+    def consume(self, dispatcher):
+        while True:
+            for update in self.next_batch():
+                try:
+                    dispatcher.process_update(update)
+                except Exception as e:
+                    logger.error("Webhook dispatch error: " + str(e))
+
+    def start(self, dispatcher=None):
+        thread = threading.Thread(target=self.server.serve_forever, name='webhook-http', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        if dispatcher is not None:
+            start_dispatcher(dispatcher)
+            thread = threading.Thread(target=self.consume, args=(dispatcher,), name='webhook-consumer', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def register(self, url):
+        self.bot.set_webhook(url.rstrip('/') + self.path, max_connections=WEBHOOK_MAX_CONNECTIONS)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def write_behind_overloaded():
+    return db.write_behind.size() >= WEBHOOK_MAX_PENDING_WRITES
+
+db = None
+scheduler = None
+live_posts = None
+reconciler = None
+captchas = None
+outbox = Outbox()
+subscriptions = SubscriptionCache()
+joins = InFlight()
+rate_limiter = UpdateRateLimiter()
+
+def setup_database(path=DB_PATH):
+    global db, scheduler, live_posts, reconciler, captchas
+    db = Database(path)
+    scheduler = GiveawayScheduler(db)
+    live_posts = LivePostUpdater(db)
+    reconciler = CounterReconciler(db)
+    captchas = SQLiteCaptchaStore(db) if CAPTCHA_BACKEND == 'sqlite' else CaptchaStore()
+    return db
+
+metrics.gauge('captcha_pending', lambda: captchas.size())
+metrics.gauge('captcha_evicted_total', lambda: captchas.evicted, kind='counter')
+metrics.gauge('write_behind_pending', lambda: db.write_behind.size())
+metrics.gauge('db_lock_waits_total', lambda: db.lock_waits, kind='counter')
+metrics.gauge('user_cache_entries', lambda: db.status_cache.stats()['size'])
+metrics.gauge('user_cache_hits_total', lambda: db.status_cache.stats()['hits'], kind='counter')
+metrics.gauge('user_cache_misses_total', lambda: db.status_cache.stats()['misses'], kind='counter')
+metrics.gauge('subscription_cache_entries', lambda: subscriptions.stats()['size'])
+metrics.gauge('subscription_checks_total', lambda: subscriptions.stats()['misses'], kind='counter')
+metrics.gauge('outbox_pending', lambda: outbox.pending())
+metrics.gauge('outbox_sent_total', lambda: outbox.sent, kind='counter')
+metrics.gauge('outbox_failed_total', lambda: outbox.failed, kind='counter')
+metrics.gauge('outbox_retried_total', lambda: outbox.retried, kind='counter')
+metrics.gauge('scheduled_giveaways', lambda: len(scheduler.deadlines))
+metrics.gauge('account_clusters', lambda: db.clusters.stats()['clusters'])
+metrics.gauge('joins_in_flight', lambda: joins.size())
+metrics.gauge('rate_limit_allowed_total', lambda: rate_limiter.allowed, kind='counter')
+metrics.gauge('rate_limit_dropped_total', lambda: rate_limiter.dropped['user'], kind='counter', reason='user')
+metrics.gauge('rate_limit_dropped_total', lambda: rate_limiter.dropped['global'], kind='counter', reason='global')
+metrics.gauge('rate_limit_deferred_total', lambda: rate_limiter.deferred, kind='counter')
+metrics.gauge('rate_limit_deferred_seconds_total', lambda: rate_limiter.deferred_seconds, kind='counter')
+metrics.gauge('rate_limit_tracked_users', lambda: rate_limiter.size())
+metrics.gauge('participant_count_reconcile_runs_total', lambda: reconciler.runs, kind='counter')
+metrics.gauge('participant_count_drift_total', lambda: reconciler.drift, kind='counter')
+metrics.gauge('joins_collapsed_total', lambda: joins.collapsed, kind='counter')
 
 def generate_captcha():
     a = random.randint(1, 10)
@@ -368,11 +2234,7 @@ def is_admin(user_id):
     return user_id in ADMIN_IDS
 
 def check_subscription(bot, user_id, channel_id):
-    try:
-        member = bot.get_chat_member(channel_id, user_id)
-        return member.status in ['member', 'administrator', 'creator']
-    except:
-        return False
+    return subscriptions.check(bot, user_id, channel_id)
 
 def format_time_left(end_date):
     try:
@@ -408,6 +2270,17 @@ def create_progress_bar(end_date, length=10):
     except:
         return "[░░░░░░░░░░]"
 
+def join_markup(giveaway_id):
+    keyboard = [[InlineKeyboardButton("Участвовать", callback_data="join_" + str(giveaway_id))]]
+    return InlineKeyboardMarkup(keyboard)
+
+def giveaway_post_text(giveaway_info, participants_count=None):
+    name, description, winners, end_date, require_sub = giveaway_info[1], giveaway_info[2], giveaway_info[3], giveaway_info[5], giveaway_info[10]
+    end_time = datetime.fromisoformat(end_date)
+    sub_text = "\n\nТребуется подписка на канал!" if require_sub == 1 else ""
+    count_text = "\nУчастников: " + str(participants_count) if participants_count is not None else ""
+    return "НОВЫЙ РОЗЫГРЫШ!\n\n" + name + "\n" + description + "\n\nПобедителей: " + str(winners) + count_text + "\nЗавершится: " + end_time.strftime('%d.%m.%Y в %H:%M') + "\n\n" + create_progress_bar(end_date) + "\n" + format_time_left(end_date) + sub_text + "\n\nНажмите кнопку!"
+
 def start(update, context):
     user = update.effective_user
     db.add_user(user.id, user.username or "", user.first_name, user.last_name or "")
@@ -462,7 +2335,7 @@ def verify(update, context):
     question, answer = generate_captcha()
     ip = extract_ip_from_request(update)
     ip_hash = hashlib.sha256(ip.encode()).hexdigest()[:32]
-    captcha_storage[user_id] = {'answer': answer, 'attempts': 0, 'time': datetime.now(), 'ip_hash': ip_hash}
+    captchas.issue(user_id, answer, ip_hash)
     update.message.reply_text("Пройдите проверку\n\nРешите: " + question + " = ?\n\nОтправьте ответ числом.")
 
 def handle_text(update, context):
@@ -472,18 +2345,18 @@ def handle_text(update, context):
     text = update.message.text.strip()
     if db.is_banned(user_id):
         return
-    if user_id in captcha_storage:
-        captcha = captcha_storage[user_id]
-        if datetime.now() - captcha['time'] > timedelta(minutes=5):
+    captcha = captchas.get(user_id)
+    if captcha:
+        if captcha['expired']:
             update.message.reply_text("Время вышло. /verify")
             db.record_verification_attempt(user_id, success=False, ip_hash=captcha.get('ip_hash'))
-            del captcha_storage[user_id]
+            captchas.discard(user_id)
             return
         if text == captcha['answer']:
             ip_hash = captcha.get('ip_hash')
             success = db.verify_user(user_id, method="captcha", ip_hash=ip_hash)
             if success:
-                del captcha_storage[user_id]
+                captchas.discard(user_id)
                 multi_accounts = db.check_multiple_accounts(user_id)
                 if multi_accounts:
                     update.message.reply_text("Обнаружены мультиаккаунты.")
@@ -493,13 +2366,13 @@ def handle_text(update, context):
             else:
                 update.message.reply_text("Ошибка! Попробуйте /verify")
         else:
-            captcha['attempts'] += 1
+            attempts = captchas.fail(user_id)
             db.record_verification_attempt(user_id, success=False, ip_hash=captcha.get('ip_hash'))
-            if captcha['attempts'] >= 3:
+            if attempts >= CAPTCHA_MAX_ATTEMPTS:
                 update.message.reply_text("Попытки закончились. /verify")
-                del captcha_storage[user_id]
+                captchas.discard(user_id)
             else:
-                left = 3 - captcha['attempts']
+                left = CAPTCHA_MAX_ATTEMPTS - attempts
                 update.message.reply_text("Неверно. Осталось: " + str(left))
 
 def my_referrals(update, context, message=None):
@@ -522,7 +2395,7 @@ def my_referrals(update, context, message=None):
             update.message.reply_text("Сначала пройдите проверку: /verify", reply_markup=markup)
         return
 
-    active_giveaways = db.get_active_giveaways()
+    active_giveaways = db.get_referral_stats(user_id)
     if not active_giveaways:
         keyboard = [[InlineKeyboardButton("Назад", callback_data="cmd_start")]]
         markup = InlineKeyboardMarkup(keyboard)
@@ -533,11 +2406,9 @@ def my_referrals(update, context, message=None):
         return
 
     text = "Ваши реферальные ссылки:\n\n"
+    bot_username = context.bot.username
     for g in active_giveaways:
-        gid, name, winners, end_date, require_sub = g
-        referral_count = db.get_referral_count(user_id, gid)
-        bonus_entries = db.get_bonus_entries(user_id, gid)
-        bot_username = context.bot.get_me().username
+        gid, name, winners, end_date, require_sub, referral_count, bonus_entries = g
         ref_link = "https://t.me/" + bot_username + "?start=ref_" + str(gid) + "_" + str(user_id)
         time_left = format_time_left(end_date)
         text += name + "\n" + ref_link + "\nПриглашено: " + str(referral_count) + "\nБонусов: " + str(bonus_entries) + "\nОсталось: " + time_left + "\n------\n"
@@ -552,7 +2423,14 @@ def my_referrals(update, context, message=None):
         update.message.reply_text(text, reply_markup=markup)
 
 def top_referrers(update, context, message=None):
-    top = db.get_top_referrers(10)
+    giveaway_id = GLOBAL_LEADERBOARD
+    if message is None and context.args:
+        try:
+            giveaway_id = int(context.args[0])
+        except:
+            update.message.reply_text("Используйте: /top [ID розыгрыша]")
+            return
+    top = db.get_top_referrers(10, giveaway_id)
     if not top:
         keyboard = [[InlineKeyboardButton("Назад", callback_data="cmd_start")]]
         markup = InlineKeyboardMarkup(keyboard)
@@ -563,7 +2441,7 @@ def top_referrers(update, context, message=None):
             update.message.reply_text(text, reply_markup=markup)
         return
 
-    text = "Топ-10 рефереров:\n\n"
+    text = "Топ-10 рефереров:\n\n" if giveaway_id == GLOBAL_LEADERBOARD else "Топ-10 рефереров розыгрыша #" + str(giveaway_id) + ":\n\n"
     medals = ["", "", ""]
     for i, (user_id, username, first_name, ref_count) in enumerate(top, 1):
         medal = medals[i-1] if i <= 3 else str(i) + "."
@@ -582,10 +2460,10 @@ def top_referrers(update, context, message=None):
 def help_cmd(update, context, message=None):
     user_id = update.effective_user.id if update.effective_user else message.from_user.id
 
-    text = "Помощь\n\nПользователь:\n/start - Начать\n/verify - Проверка\n/my_referrals - Рефералы\n/top - Топ рефереров\n/help - Помощь\n"
+    text = "Помощь\n\nПользователь:\n/start - Начать\n/verify - Проверка\n/my_referrals - Рефералы\n/top [ID] - Топ рефереров\n/help - Помощь\n"
 
     if is_admin(user_id):
-        text += "\nАдмин:\n/new - Создать\n/list - Список\n/end - Завершить\n/stats - Статистика\n/participants - Участники\n/remove - Удалить\n/ban - Забанить\n/unban - Разбанить\n/banned - Забаненные\n/check_multi - Мультиаккаунты\n/verify_info - Инфо\n"
+        text += "\nАдмин:\n/new - Создать\n/list - Список\n/end - Завершить\n/stats - Статистика\n/participants - Участники\n/remove - Удалить\n/ban - Забанить\n/unban - Разбанить\n/banned - Забаненные\n/check_multi - Мультиаккаунты\n/clusters - Кластеры аккаунтов\n/verify_info - Инфо\n/cache_stats - Кэш\n/prewarm - Прогрев подписок\n/export - Выгрузка участников\n/reconcile - Сверка счётчиков\n"
 
     keyboard = [[InlineKeyboardButton("Назад", callback_data="cmd_start")]]
     markup = InlineKeyboardMarkup(keyboard)
@@ -645,20 +2523,17 @@ def new_giveaway(update, context):
     if not giveaway_id:
         update.message.reply_text("Ошибка создания")
         return
-
-    end_time = datetime.now() + timedelta(hours=hours)
-    progress = create_progress_bar(end_time.isoformat())
-
-    keyboard = [[InlineKeyboardButton("Участвовать", callback_data="join_" + str(giveaway_id))]]
-    markup = InlineKeyboardMarkup(keyboard)
-
-    sub_text = "\n\nТребуется подписка на канал!" if require_sub == 1 else ""
+    giveaway_info = db.get_giveaway_info(giveaway_id)
+    if not giveaway_info:
+        update.message.reply_text("Ошибка создания")
+        return
+    scheduler.schedule(giveaway_id, giveaway_info[5])
 
     try:
-        message = context.bot.send_message(chat_id=CHANNEL_ID, 
-            text="НОВЫЙ РОЗЫГРЫШ!\n\n" + name + "\n" + description + "\n\nПобедителей: " + str(winners) + "\nЗавершится: " + end_time.strftime('%d.%m.%Y в %H:%M') + "\n\n" + progress + "\n" + format_time_left(end_time.isoformat()) + sub_text + "\n\nНажмите кнопку!",
-            reply_markup=markup)
+        text = giveaway_post_text(giveaway_info)
+        message = outbox.send_message(CHANNEL_ID, text, lane=LANE_CHANNEL, reply_markup=join_markup(giveaway_id)).result(timeout=60)
         db.update_message_id(giveaway_id, message.message_id)
+        live_posts.remember(giveaway_id, text)
         update.message.reply_text("Розыгрыш создан! ID: " + str(giveaway_id) + ("\n\nПроверка подписки: ВКЛ" if require_sub == 1 else ""))
     except Exception as e:
         update.message.reply_text("Ошибка: " + str(e))
@@ -713,57 +2588,86 @@ def end_giveaway(update, context):
     except Exception as e:
         update.message.reply_text("Ошибка: " + str(e))
 
-def finish_giveaway(bot, giveaway_id, message=None):
+def display_name(username, first_name):
+    return "@" + username if username else first_name
+
+def remember_chat_name(user_id, future):
     try:
-        participants = db.get_participants(giveaway_id)
-        if not participants:
-            if message:
-                message.reply_text("Нет участников")
-            return
+        chat = future.result()
+    except Exception:
+        return
+    if chat.username or chat.first_name:
+        db.refresh_user_name(user_id, chat.username or "", chat.first_name or "")
+
+def resolve_winner_names(user_ids, timeout=WINNER_LOOKUP_TIMEOUT):
+    names = {}
+    missing = {}
+    cutoff = (datetime.now() - timedelta(days=USER_NAME_MAX_AGE_DAYS)).isoformat()
+    known = db.get_user_names(user_ids)
+    for user_id in user_ids:
+        row = known.get(user_id)
+        if row and (row[0] or row[1]):
+            names[user_id] = display_name(row[0], row[1])
+            if (row[2] or '') >= cutoff:
+                continue
+        future = outbox.get_chat(user_id)
+        future.add_done_callback(lambda f, user_id=user_id: remember_chat_name(user_id, f))
+        if user_id not in names:
+            missing[user_id] = future
+    deadline = time.monotonic() + timeout
+    for user_id, future in missing.items():
+        try:
+            chat = future.result(timeout=max(0, deadline - time.monotonic()))
+        except Exception:
+            continue
+        if chat.username or chat.first_name:
+            names[user_id] = display_name(chat.username, chat.first_name)
+    return names
 
+def finish_giveaway(bot, giveaway_id, message=None):
+    try:
         giveaway_info = db.get_giveaway_info(giveaway_id)
         if not giveaway_info:
             if message:
                 message.reply_text("Не найден")
             return
 
-        winner_count = min(giveaway_info[3], len(participants))
-        winners = random.sample(participants, winner_count)
+        draw = draw_giveaway(db, giveaway_id, giveaway_info[3])
+        winners = draw['winners']
+        draw_id = db.record_draw(giveaway_id, draw)
+        if draw_id is None:
+            logger.error("Giveaway " + str(giveaway_id) + " not finished: draw was not recorded")
+            if message:
+                message.reply_text("Ошибка: розыгрыш не записан, попробуйте позже")
+            return
+
+        db.end_giveaway(giveaway_id)
+        scheduler.cancel(giveaway_id)
+        live_posts.forget(giveaway_id)
+        lag = (datetime.now() - datetime.fromisoformat(giveaway_info[5])).total_seconds()
+        if message is None and lag >= 0:
+            metrics.observe('giveaway_finish_lag_seconds', lag)
 
+        if not winners:
+            if message:
+                message.reply_text("Нет участников\n\nРозыгрыш #" + str(draw_id) + " завершен без победителей")
+            logger.info("Giveaway " + str(giveaway_id) + " finished without participants")
+            return
+
+        names = resolve_winner_names(winners)
         winners_text = "ПОБЕДИТЕЛИ!\n\n"
         for i, winner_id in enumerate(winners, 1):
-            try:
-                user = bot.get_chat(winner_id)
-                username = "@" + user.username if user.username else user.first_name
-                winners_text += str(i) + ". " + username + "\n"
-            except:
-                winners_text += str(i) + ". ID: " + str(winner_id) + "\n"
-
-        db.end_giveaway(giveaway_id)
+            winners_text += str(i) + ". " + names.get(winner_id, "ID: " + str(winner_id)) + "\n"
 
-        try:
-            bot.send_message(chat_id=CHANNEL_ID, text=winners_text)
-        except:
-            pass
+        outbox.send_message(CHANNEL_ID, winners_text, lane=LANE_CHANNEL)
 
         if message:
-            message.reply_text("Завершен!\n\n" + winners_text)
+            message.reply_text("Завершен!\n\n" + winners_text + "\nРозыгрыш #" + str(draw_id) + "\nУчастников: " + str(draw['count']) + "\nИсключено (мультиаккаунты): " + str(len(draw['excluded'])) + "\nSeed: " + draw['seed'])
 
         logger.info("Giveaway " + str(giveaway_id) + " finished automatically")
     except Exception as e:
         logger.error("Error finishing giveaway " + str(giveaway_id) + ": " + str(e))
 
-def auto_finish_thread(bot):
-    while True:
-        try:
-            giveaways_to_finish = db.get_giveaways_to_finish()
-            for gid in giveaways_to_finish:
-                finish_giveaway(bot, gid)
-            time.sleep(60)
-        except Exception as e:
-            logger.error("Auto-finish error: " + str(e))
-            time.sleep(60)
-
 def stats(update, context):
     if not is_admin(update.effective_user.id):
         update.message.reply_text("Нет прав")
@@ -778,7 +2682,7 @@ def stats(update, context):
             update.message.reply_text("Не найден")
             return
         participants_count = db.get_participants_count(giveaway_id)
-        _, name, description, winners, start_date, end_date, is_active, _, _, _, require_sub = giveaway_info
+        _, name, description, winners, start_date, end_date, is_active, _, _, _, require_sub = giveaway_info[:11]
         start = datetime.fromisoformat(start_date)
         end = datetime.fromisoformat(end_date)
         status = "Активен" if is_active == 1 else "Завершен"
@@ -790,6 +2694,32 @@ def stats(update, context):
     except Exception as e:
         update.message.reply_text("Ошибка: " + str(e))
 
+def page_markup(prefix, scope, page):
+    buttons = []
+    if page['has_prev'] and page['first']:
+        buttons.append(InlineKeyboardButton("« Назад", callback_data=prefix + "_" + str(scope) + "_p_" + "_".join(str(value) for value in page['first'])))
+    if page['has_next'] and page['last']:
+        buttons.append(InlineKeyboardButton("Далее »", callback_data=prefix + "_" + str(scope) + "_n_" + "_".join(str(value) for value in page['last'])))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def parse_page_callback(data, first_type, second_type):
+    prefix, scope, direction, first, second = data.split('_', 4)
+    cursor = (first_type(first), second_type(second))
+    return int(scope), (cursor if direction == 'n' else None), (cursor if direction == 'p' else None)
+
+def participants_view(giveaway_id, after=None, before=None):
+    page = db.get_participants_page(giveaway_id, after, before)
+    if not page['rows']:
+        return "Нет участников", None
+    giveaway_info = db.get_giveaway_info(giveaway_id)
+    name = giveaway_info[1] if giveaway_info else "#" + str(giveaway_id)
+    text = "Участники '" + name + "'\nВсего: " + str(db.get_participants_count(giveaway_id)) + "\n\n"
+    for user_id, username, first_name, is_banned, join_date in page['rows']:
+        status = "BAN" if is_banned == 1 else "OK"
+        username_str = "@" + username if username else "нет"
+        text += status + " " + (first_name or "?") + " (" + username_str + ") - " + str(user_id) + "\n"
+    return text, page_markup('pp', giveaway_id, page)
+
 def participants_cmd(update, context):
     if not is_admin(update.effective_user.id):
         update.message.reply_text("Нет прав")
@@ -798,21 +2728,8 @@ def participants_cmd(update, context):
         update.message.reply_text("Использование: /participants <id>")
         return
     try:
-        giveaway_id = int(context.args[0])
-        participants = db.get_participants_with_info(giveaway_id)
-        if not participants:
-            update.message.reply_text("Нет участников")
-            return
-        giveaway_info = db.get_giveaway_info(giveaway_id)
-        name = giveaway_info[1] if giveaway_info else "#" + str(giveaway_id)
-        text = "Участники '" + name + "'\nВсего: " + str(len(participants)) + "\n\n"
-        for i, (user_id, username, first_name, is_banned, join_date) in enumerate(participants[:50], 1):
-            status = "BAN" if is_banned == 1 else "OK"
-            username_str = "@" + username if username else "нет"
-            text += str(i) + ". " + status + " " + first_name + " (" + username_str + ") - " + str(user_id) + "\n"
-        if len(participants) > 50:
-            text += "\n...и еще " + str(len(participants) - 50)
-        update.message.reply_text(text)
+        text, markup = participants_view(int(context.args[0]))
+        update.message.reply_text(text, reply_markup=markup)
     except Exception as e:
         update.message.reply_text("Ошибка: " + str(e))
 
@@ -827,6 +2744,7 @@ def remove_participant(update, context):
         giveaway_id = int(context.args[0])
         user_id = int(context.args[1])
         if db.remove_participant(giveaway_id, user_id):
+            live_posts.touch(giveaway_id)
             update.message.reply_text("Участник " + str(user_id) + " удален из " + str(giveaway_id))
         else:
             update.message.reply_text("Не найден")
@@ -850,10 +2768,7 @@ def ban_user(update, context):
             reason = ' '.join(context.args[1:])
         admin_id = update.effective_user.id
         if db.ban_user(user_id, admin_id, reason, days):
-            try:
-                context.bot.send_message(chat_id=user_id, text="ВЫ ЗАБАНЕНЫ!\n\nПричина: " + reason + "\nСрок: " + str(days) + " дней")
-            except:
-                pass
+            outbox.send_message(user_id, "ВЫ ЗАБАНЕНЫ!\n\nПричина: " + reason + "\nСрок: " + str(days) + " дней")
             update.message.reply_text("Пользователь " + str(user_id) + " забанен\nПричина: " + reason + "\nСрок: " + str(days) + " дней")
         else:
             update.message.reply_text("Ошибка")
@@ -870,57 +2785,96 @@ def unban_user(update, context):
     try:
         user_id = int(context.args[0])
         if db.unban_user(user_id):
-            try:
-                context.bot.send_message(chat_id=user_id, text="Вы разбанены!")
-            except:
-                pass
+            outbox.send_message(user_id, "Вы разбанены!")
             update.message.reply_text("Пользователь " + str(user_id) + " разбанен")
         else:
             update.message.reply_text("Ошибка")
     except Exception as e:
         update.message.reply_text("Ошибка: " + str(e))
 
-def banned_list(update, context):
-    if not is_admin(update.effective_user.id):
-        update.message.reply_text("Нет прав")
-        return
-    banned_users = db.get_banned_users()
-    if not banned_users:
-        update.message.reply_text("Нет забаненных")
-        return
-    text = "Забаненные (" + str(len(banned_users)) + ")\n\n"
-    for user in banned_users[:30]:
-        user_id, username, first_name, reason, ban_date = user
+def banned_view(after=None, before=None):
+    page = db.get_banned_page(after, before, limit=30)
+    if not page['rows']:
+        return "Нет забаненных", None
+    text = "Забаненные\n\n"
+    for user_id, username, first_name, reason, ban_date in page['rows']:
         ban_dt = datetime.fromisoformat(ban_date) if ban_date else None
         date_str = ban_dt.strftime('%d.%m.%Y') if ban_dt else 'неизвестно'
         username_str = "@" + username if username else "нет"
-        text += first_name + " (" + username_str + ") - " + str(user_id) + "\n" + reason + "\nДата: " + date_str + "\n------\n"
-    if len(banned_users) > 30:
-        text += "\n...и еще " + str(len(banned_users) - 30)
-    update.message.reply_text(text)
+        text += (first_name or "?") + " (" + username_str + ") - " + str(user_id) + "\n" + (reason or "") + "\nДата: " + date_str + "\n------\n"
+    return text, page_markup('pb', 0, page)
 
-def check_multi(update, context):
+def banned_list(update, context):
     if not is_admin(update.effective_user.id):
         update.message.reply_text("Нет прав")
         return
-    threshold = int(context.args[0]) if context.args and context.args[0].isdigit() else 2
-    suspicious_ips = db.get_suspicious_ips(threshold)
-    if not suspicious_ips:
-        update.message.reply_text("Не найдено IP с " + str(threshold) + "+ аккаунтами")
-        return
+    text, markup = banned_view()
+    update.message.reply_text(text, reply_markup=markup)
+
+def suspicious_view(threshold, after=None, before=None):
+    page = db.get_suspicious_ips_page(threshold, after, before, limit=10)
+    if not page['rows']:
+        return "Не найдено IP с " + str(threshold) + "+ аккаунтами", None
     text = "Подозрительные IP (" + str(threshold) + "+):\n\n"
-    for ip_hash, user_count, last_seen in suspicious_ips[:10]:
-        users = db.get_users_by_ip(ip_hash)
+    users_by_ip = db.get_users_by_ips(ip_hash for ip_hash, _, _ in page['rows'])
+    for ip_hash, user_count, last_seen in page['rows']:
+        users = users_by_ip.get(ip_hash, [])
         text += "IP: " + ip_hash[:16] + "...\nАккаунтов: " + str(user_count) + "\n"
         for user in users[:5]:
             user_id, username, first_name, joined_date = user
             username_str = "@" + username if username else "нет"
-            text += "  " + first_name + " (" + username_str + ") - " + str(user_id) + "\n"
+            text += "  " + (first_name or "?") + " (" + username_str + ") - " + str(user_id) + "\n"
         if len(users) > 5:
             text += "  ...и еще " + str(len(users) - 5) + "\n"
         text += "------\n"
-    if len(suspicious_ips) > 10:
-        text += "\n...и еще " + str(len(suspicious_ips) - 10)
+    return text, page_markup('ps', threshold, page)
+
+def check_multi(update, context):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("Нет прав")
+        return
+    threshold = int(context.args[0]) if context.args and context.args[0].isdigit() else 2
+    text, markup = suspicious_view(threshold)
+    update.message.reply_text(text, reply_markup=markup)
+
+def page_callback(query):
+    data = query.data
+    if data.startswith('pp_'):
+        giveaway_id, after, before = parse_page_callback(data, str, int)
+        text, markup = participants_view(giveaway_id, after, before)
+    elif data.startswith('pb_'):
+        _, after, before = parse_page_callback(data, str, int)
+        text, markup = banned_view(after, before)
+    else:
+        threshold, after, before = parse_page_callback(data, int, str)
+        text, markup = suspicious_view(threshold, after, before)
+    query.message.edit_text(text, reply_markup=markup)
+
+def clusters_cmd(update, context):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("Нет прав")
+        return
+    min_size = int(context.args[0]) if context.args and context.args[0].isdigit() else 2
+    top = db.clusters.top(10, min_size)
+    if not top:
+        update.message.reply_text("Не найдено кластеров из " + str(min_size) + "+ аккаунтов")
+        return
+    summary = db.clusters.stats()
+    names = db.get_user_names(user_id for _, _, members, _ in top for user_id in members[:5])
+    text = "Кластеры мультиаккаунтов (" + str(min_size) + "+)\n"
+    text += "По общему IP: " + str(summary['clusters']) + " кластеров, " + str(summary['users']) + " аккаунтов\n"
+    text += "С рефералами и совместными входами: " + str(summary['linked_clusters']) + " кластеров, " + str(summary['linked_users']) + " аккаунтов\n"
+    text += "[IP] - общий IP, остальные связи только для ручной проверки\n\n"
+    for root, size, members, by_ip in top:
+        text += "Кластер " + str(root) + ": " + str(size) + " аккаунтов, по IP: " + str(len(by_ip)) + "\n"
+        for user_id in members[:5]:
+            row = names.get(user_id)
+            text += "  " + (display_name(row[0], row[1]) if row and (row[0] or row[1]) else "?") + " - " + str(user_id) + (" [IP]" if user_id in by_ip else "") + "\n"
+        if size > 5:
+            text += "  ...и еще " + str(size - 5) + "\n"
+        text += "------\n"
+    if CLUSTER_EXCLUDE_SIZE:
+        text += "\nИз розыгрышей исключаются IP-кластеры от " + str(CLUSTER_EXCLUDE_SIZE) + " аккаунтов"
     update.message.reply_text(text)
 
 def verify_info(update, context):
@@ -956,14 +2910,115 @@ def verify_info(update, context):
     except Exception as e:
         update.message.reply_text("Ошибка: " + str(e))
 
+def cache_stats(update, context):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("Нет прав")
+        return
+    cache = db.status_cache.stats()
+    text = "Кэш статусов\n\n"
+    text += "Записей: " + str(cache['size']) + "\n"
+    text += "Попаданий: " + str(cache['hits']) + "\n"
+    text += "Промахов: " + str(cache['misses']) + "\n"
+    text += "Hit rate: " + str(round(cache['hit_rate'] * 100, 1)) + "%\n"
+    subs = subscriptions.stats()
+    text += "\nКэш подписок\n\n"
+    text += "Записей: " + str(subs['size']) + "\n"
+    text += "Попаданий: " + str(subs['hits']) + "\n"
+    text += "Запросов: " + str(subs['misses']) + "\n"
+    text += "Объединено: " + str(subs['shared']) + "\n"
+    text += "В процессе: " + str(subs['in_flight']) + "\n"
+    update.message.reply_text(text)
+
+def prewarm_cmd(update, context):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("Нет прав")
+        return
+    if not context.args:
+        update.message.reply_text("Использование: /prewarm <id>")
+        return
+    try:
+        giveaway_id = int(context.args[0])
+        if not db.get_giveaway_info(giveaway_id):
+            update.message.reply_text("Не найден")
+            return
+        chat_id = update.effective_chat.id
+
+        def run():
+            user_ids = (user_id for user_id, weight in db.iter_participant_weights(giveaway_id))
+            scheduled = subscriptions.prewarm(context.bot, user_ids, CHANNEL_ID)
+            outbox.send_message(chat_id, "Проверка подписок #" + str(giveaway_id) + ": запрошено " + str(scheduled))
+
+        threading.Thread(target=run, name='sub-prewarm', daemon=True).start()
+        update.message.reply_text("Прогрев кэша подписок запущен")
+    except Exception as e:
+        update.message.reply_text("Ошибка: " + str(e))
+
+def export_cmd(update, context):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("Нет прав")
+        return
+    if not context.args:
+        update.message.reply_text("Использование: /export <id> [csv|jsonl]")
+        return
+    try:
+        giveaway_id = int(context.args[0])
+        fmt = context.args[1].lower() if len(context.args) > 1 else 'csv'
+        if fmt not in EXPORT_FORMATS:
+            update.message.reply_text("Формат: csv или jsonl")
+            return
+        if not db.get_giveaway_info(giveaway_id):
+            update.message.reply_text("Не найден")
+            return
+        chat_id = update.effective_chat.id
+
+        def run():
+            fd, path = tempfile.mkstemp(prefix='export_', suffix='.' + fmt + '.gz', dir=EXPORT_DIR)
+            os.close(fd)
+            try:
+                count = export_giveaway(db, giveaway_id, path, fmt)
+                size = os.path.getsize(path)
+                caption = "Экспорт #" + str(giveaway_id) + ": " + str(count) + " строк"
+                if size > EXPORT_DOCUMENT_LIMIT:
+                    outbox.send_message(chat_id, caption + ", " + str(size // (1024 * 1024)) + " МБ - больше лимита Telegram.\n"
+                                        "Выгрузите на сервере: python GSMgiveaway_bot.py export " + str(giveaway_id) + " --format " + fmt)
+                    return
+                outbox.send_document(chat_id, path, 'giveaway_' + str(giveaway_id) + '.' + fmt + '.gz', caption=caption)
+            except Exception as e:
+                logger.error("Ошибка экспорта #" + str(giveaway_id) + ": " + str(e))
+                outbox.send_message(chat_id, "Ошибка экспорта: " + str(e))
+            finally:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        threading.Thread(target=run, name='export', daemon=True).start()
+        update.message.reply_text("Экспорт #" + str(giveaway_id) + " запущен")
+    except Exception as e:
+        update.message.reply_text("Ошибка: " + str(e))
+
+def reconcile_cmd(update, context):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("Нет прав")
+        return
+    chat_id = update.effective_chat.id
+
+    def run():
+        checked, drift = reconciler.check(active_only=False)
+        text = "Сверка счётчиков: " + str(checked) + " розыгрышей, расхождений: " + str(len(drift))
+        for giveaway_id, stored, actual in drift[:20]:
+            text += "\n#" + str(giveaway_id) + ": " + str(stored) + " -> " + str(actual)
+        outbox.send_message(chat_id, text)
+
+    threading.Thread(target=run, name='reconcile-cmd', daemon=True).start()
+    update.message.reply_text("Сверка счётчиков запущена")
+
 def button_handler(update, context):
     query = update.callback_query
     user_id = query.from_user.id
 
-    try:
-        query.answer()
-    except:
-        pass
+    if not query.data.startswith('join_'):
+        outbox.answer_callback(query)
 
     if query.data == "cmd_start":
         user = query.from_user
@@ -1004,58 +3059,491 @@ def button_handler(update, context):
         list_giveaways_cmd(update, context, query.message)
 
     elif query.data.startswith('join_'):
-        giveaway_id = int(query.data.split('_')[1])
+        join_callback(update, context)
 
-        if db.is_banned(user_id):
-            query.answer("Вы забанены", show_alert=True)
-            return
+    elif query.data.startswith(('pp_', 'pb_', 'ps_')) and is_admin(user_id):
+        page_callback(query)
 
-        if not db.is_verified(user_id):
-            try:
-                context.bot.send_message(chat_id=user_id, text="Необходима верификация!\n\nНапишите /verify")
-                query.answer("Пройдите проверку!", show_alert=True)
-            except:
-                query.answer("Напишите боту /verify", show_alert=True)
-            return
+def subscription_required(giveaway_info):
+    if not giveaway_info or giveaway_info[6] == 0 or giveaway_info[10] != 1:
+        return False
+    return datetime.now() <= datetime.fromisoformat(giveaway_info[5])
+
+def join_attempt(bot, giveaway_id, user_id, referred_by):
+    giveaway_info = db.get_giveaway_info(giveaway_id)
+    if subscription_required(giveaway_info) and not db.is_banned(user_id) and db.is_verified(user_id):
+        if not check_subscription(bot, user_id, CHANNEL_ID):
+            return JOIN_SUBSCRIBE, 0, giveaway_info
+    return db.join_giveaway(giveaway_id, user_id, referred_by=referred_by)
+
+async def join_attempt_async(bot, adb, giveaway_id, user_id, referred_by):
+    giveaway_info = await adb.get_giveaway_info(giveaway_id)
+    if subscription_required(giveaway_info) and not await adb.is_banned(user_id) and await adb.is_verified(user_id):
+        try:
+            subscribed = await asyncio.wait_for(asyncio.wrap_future(subscriptions.lookup(bot, user_id, CHANNEL_ID)), SUB_CHECK_TIMEOUT)
+        except Exception:
+            subscribed = False
+        if not subscribed:
+            return JOIN_SUBSCRIBE, 0, giveaway_info
+    return await adb.join_giveaway(giveaway_id, user_id, referred_by=referred_by)
+
+def answer_join(query, context, giveaway_id, result, leader, multi_accounts):
+    status, participants_count, giveaway_info = result
+    user_id = query.from_user.id
 
-        giveaway_info = db.get_giveaway_info(giveaway_id)
-        if not giveaway_info or giveaway_info[6] == 0:
-            query.answer("Розыгрыш завершен", show_alert=True)
+    if status == JOIN_BANNED:
+        outbox.answer_callback(query, "Вы забанены", show_alert=True)
+    elif status == JOIN_UNVERIFIED:
+        if not leader:
+            outbox.answer_callback(query, "Пройдите проверку!", show_alert=True)
             return
+        dm = outbox.send_message(user_id, "Необходима верификация!\n\nНапишите /verify")
+        dm.add_done_callback(lambda f: outbox.answer_callback(query, "Напишите боту /verify" if f.exception() else "Пройдите проверку!", show_alert=True))
+    elif status == JOIN_CLOSED:
+        outbox.answer_callback(query, "Розыгрыш завершен", show_alert=True)
+    elif status == JOIN_SUBSCRIBE:
+        outbox.answer_callback(query, "Подпишитесь на канал: " + CHANNEL_ID, show_alert=True)
+    elif status == JOIN_EXPIRED:
+        outbox.answer_callback(query, "Время истекло", show_alert=True)
+    elif status == JOIN_ERROR:
+        outbox.answer_callback(query, "Ошибка, попробуйте позже", show_alert=True)
+    else:
+        warning = ""
+        if multi_accounts and len(multi_accounts) >= 2:
+            warning = "Обнаружены мультиаккаунты!\n\n"
 
-        require_sub = giveaway_info[10]
-        if require_sub == 1:
-            if not check_subscription(context.bot, user_id, CHANNEL_ID):
-                query.answer("Подпишитесь на канал: " + CHANNEL_ID, show_alert=True)
-                return
+        if status == JOIN_OK:
+            if leader:
+                if 'referrer' in context.user_data:
+                    del context.user_data['referrer']
+                if 'giveaway' in context.user_data:
+                    del context.user_data['giveaway']
 
-        end_time = datetime.fromisoformat(giveaway_info[5])
-        if datetime.now() > end_time:
-            query.answer("Время истекло", show_alert=True)
-            return
+                outbox.send_message(user_id, "Вы участвуете!\n\n" + giveaway_info[1] + "\nПобедителей: " + str(giveaway_info[3]) + "\nУчастников: " + str(participants_count) + "\n\nИспользуйте /my_referrals")
+                live_posts.touch(giveaway_id)
 
-        multi_accounts = db.check_multiple_accounts(user_id)
-        if multi_accounts and len(multi_accounts) >= 2:
-            query.answer("Обнаружены мультиаккаунты!", show_alert=True)
+            outbox.answer_callback(query, warning + "Вы участвуете! Всего: " + str(participants_count), show_alert=True)
+        else:
+            outbox.answer_callback(query, warning + "Вы уже участвуете", show_alert=True)
+
+def join_callback(update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    giveaway_id = int(query.data.split('_')[1])
+    referrer_id = context.user_data.get('referrer') if context.user_data.get('giveaway') == giveaway_id else None
+
+    result, leader = joins.run((user_id, giveaway_id), lambda: join_attempt(context.bot, giveaway_id, user_id, referrer_id))
+    multi_accounts = db.check_multiple_accounts(user_id) if result[0] in (JOIN_OK, JOIN_ALREADY) else None
+    answer_join(query, context, giveaway_id, result, leader, multi_accounts)
 
-        referrer_id = context.user_data.get('referrer') if context.user_data.get('giveaway') == giveaway_id else None
+async def join_callback_async(update, context, adb):
+    query = update.callback_query
+    user_id = query.from_user.id
+    giveaway_id = int(query.data.split('_')[1])
+    referrer_id = context.user_data.get('referrer') if context.user_data.get('giveaway') == giveaway_id else None
 
-        if db.add_participant(giveaway_id, user_id, referred_by=referrer_id):
-            participants_count = db.get_participants_count(giveaway_id)
+    future, leader = joins.claim((user_id, giveaway_id))
+    if leader:
+        try:
+            future.set_result(await join_attempt_async(context.bot, adb, giveaway_id, user_id, referrer_id))
+        except Exception as e:
+            future.set_exception(e)
+    result = await asyncio.wrap_future(future)
+    multi_accounts = await adb.check_multiple_accounts(user_id) if result[0] in (JOIN_OK, JOIN_ALREADY) else None
+    answer_join(query, context, giveaway_id, result, leader, multi_accounts)
 
-            if 'referrer' in context.user_data:
-                del context.user_data['referrer']
-            if 'giveaway' in context.user_data:
-                del context.user_data['giveaway']
+def is_join_callback(update):
+    return update.callback_query is not None and (update.callback_query.data or '').startswith('join_')
 
+async def dispatch_async(update, dp, adb):
+    started = time.perf_counter()
+    try:
+        context = CallbackContext.from_update(update, dp)
+        await join_callback_async(update, context, adb)
+    except Exception as e:
+        metrics.inc('handler_errors_total', kind='callback', handler='join')
+        logger.error("Async handler error: " + str(e))
+    finally:
+        metrics.observe('handler_seconds', time.perf_counter() - started, kind='callback', handler='join')
+
+async def run_async_runtime(updater, webhook=None):
+    loop = asyncio.get_running_loop()
+    dp = updater.dispatcher
+    bot = updater.bot
+    adb = AsyncDatabase(db)
+    tasks = set()
+    finisher = loop.create_task(scheduler.run_async(lambda giveaway_id: finish_giveaway(bot, giveaway_id), adb.executor))
+    poller = ThreadPoolExecutor(max_workers=1, thread_name_prefix='poller')
+    start_dispatcher(dp)
+    if webhook is None:
+        bot.delete_webhook()
+    stopping = asyncio.Event()
+    signals = []
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stopping.set)
+            signals.append(signum)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass
+    stopper = loop.create_task(stopping.wait())
+    offset = None
+    try:
+        while True:
+            if webhook is not None:
+                fetch = loop.run_in_executor(poller, webhook.next_batch, 1.0)
+            else:
+                fetch = loop.run_in_executor(poller, functools.partial(bot.get_updates, offset=offset, timeout=POLL_TIMEOUT))
+            await asyncio.wait([fetch, stopper], return_when=asyncio.FIRST_COMPLETED)
+            if stopping.is_set():
+                logger.info("Received stop signal, shutting down")
+                break
             try:
-                context.bot.send_message(chat_id=user_id, text="Вы участвуете!\n\n" + giveaway_info[1] + "\nПобедителей: " + str(giveaway_info[3]) + "\nУчастников: " + str(participants_count) + "\n\nИспользуйте /my_referrals")
-            except:
+                updates = fetch.result()
+            except NetworkError as e:
+                logger.warning("Polling error: " + str(e))
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                delay = throttle(update)
+                if delay is None:
+                    continue
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if is_join_callback(update):
+                    task = loop.create_task(dispatch_async(update, dp, adb))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    dp.process_update(update)
+    finally:
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+        stopper.cancel()
+        scheduler.stop()
+        finisher.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        poller.shutdown(wait=False)
+        dp.stop()
+        adb.close()
+
+def throttle(update):
+    user = update.effective_user
+    if user is None or is_admin(user.id):
+        return 0.0
+    verdict, delay = rate_limiter.admit(user.id)
+    if verdict == RATE_OK:
+        return delay
+    if verdict == RATE_NOTIFY and update.callback_query is not None:
+        outbox.answer_callback(update.callback_query, "Слишком много запросов, подождите немного")
+    return None
+
+def rate_limit_handler(update, context):
+    delay = throttle(update)
+    if delay is None:
+        raise DispatcherHandlerStop()
+    if delay > 0:
+        time.sleep(delay)
+
+def callback_label(data):
+    parts = []
+    for part in (data or '').split('_'):
+        if part.lstrip('-').isdigit():
+            break
+        parts.append(part)
+    return '_'.join(parts) or 'unknown'
+
+def instrumented_handler(callback, kind, name=None):
+    def wrapper(update, context):
+        handler = name or callback_label(update.callback_query.data)
+        started = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            metrics.inc('handler_errors_total', kind=kind, handler=handler)
+            raise
+        finally:
+            metrics.observe('handler_seconds', time.perf_counter() - started, kind=kind, handler=handler)
+    return wrapper
+
+COMMANDS = [
+    ("start", start),
+    ("verify", verify),
+    ("my_referrals", lambda u, c: my_referrals(u, c)),
+    ("top", lambda u, c: top_referrers(u, c)),
+    ("help", lambda u, c: help_cmd(u, c)),
+    ("new", new_giveaway),
+    ("list", lambda u, c: list_giveaways_cmd(u, c)),
+    ("end", end_giveaway),
+    ("stats", stats),
+    ("participants", participants_cmd),
+    ("remove", remove_participant),
+    ("ban", ban_user),
+    ("unban", unban_user),
+    ("banned", banned_list),
+    ("check_multi", check_multi),
+    ("clusters", clusters_cmd),
+    ("verify_info", verify_info),
+    ("cache_stats", cache_stats),
+    ("prewarm", prewarm_cmd),
+    ("export", export_cmd),
+    ("reconcile", reconcile_cmd),
+]
+
+def setup_dispatcher(dp, rate_limit=True):
+    if rate_limit:
+        dp.add_handler(TypeHandler(Update, rate_limit_handler), group=-1)
+    for command, callback in COMMANDS:
+        dp.add_handler(CommandHandler(command, instrumented_handler(callback, 'command', command), run_async=True))
+    dp.add_handler(CallbackQueryHandler(instrumented_handler(button_handler, 'callback'), run_async=True))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, instrumented_handler(handle_text, 'message', 'text'), run_async=True))
+
+class LeaderLock:
+    def __init__(self, path=LEADER_LOCK_PATH):
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking=True):
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            f.close()
+            return False
+        self.file = f
+        return True
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+class ShardWorker:
+    def __init__(self, index, count, updates, events, backlog):
+        self.index = index
+        self.count = count
+        self.updates = updates
+        self.events = events
+        self.backlog = backlog
+        self.local = threading.local()
+        self.leader = False
+        self.leader_lock = LeaderLock()
+        self.bot = None
+        self.applied = 0
+
+    def apply(self, event, args):
+        self.local.replaying = True
+        try:
+            if event == 'user':
+                db.status_cache.invalidate(args[0])
+            elif event == 'ip':
+                db.status_cache.set_ip_hash(args[0], args[1])
+                db.clusters.link_ip(args[0], args[1])
+            elif event == 'joined':
+                db.joined(*args)
+            elif event == 'giveaways':
+                db.referral_cache.clear()
+            elif event == 'schedule':
+                scheduler.schedule(args[0], datetime.fromtimestamp(args[1]))
+            elif event == 'cancel':
+                scheduler.cancel(args[0])
+            elif event == 'touch':
+                if self.leader:
+                    live_posts.touch(args[0])
+            elif event == 'remember':
+                live_posts.remember(args[0], args[1])
+            elif event == 'forget':
+                live_posts.forget(args[0])
+            self.applied += 1
+        except Exception as e:
+            logger.error("Shard event " + event + " failed: " + str(e))
+        finally:
+            self.local.replaying = False
+
+    def elect(self):
+        self.leader_lock.acquire()
+        self.leader = True
+        logger.info("Shard " + str(self.index) + " is the leader")
+        scheduler.start(lambda giveaway_id: finish_giveaway(self.bot, giveaway_id))
+        live_posts.forward = False
+        reconciler.start()
+
+    def run(self):
+        request = InstrumentedRequest(con_pool_size=WORKERS + OUTBOX_SENDERS + SUB_CHECK_WORKERS + 4)
+        updater = Updater(bot=Bot(BOT_TOKEN, base_url=BOT_API_URL, request=request), workers=WORKERS)
+        self.bot = updater.bot
+        dispatcher = updater.dispatcher
+        setup_dispatcher(dispatcher)
+        outbox.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE / self.count, 1.0)
+        if rate_limiter.global_bucket is not None:
+            rate_limiter.global_bucket = TokenBucket(RATE_LIMIT_GLOBAL_RATE / self.count, RATE_LIMIT_GLOBAL_BURST / self.count)
+        db.load_clusters()
+        outbox.start(self.bot)
+        start_dispatcher(dispatcher)
+        metrics.gauge('shard_leader', lambda: int(self.leader))
+        metrics.gauge('shard_events_applied_total', lambda: self.applied, kind='counter')
+        metrics_server = start_metrics_server(METRICS_PORT + 1 + self.index) if METRICS_PORT else None
+        live_posts.forward = True
+        live_posts.start()
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        threading.Thread(target=self.elect, name='leader-election', daemon=True).start()
+        try:
+            while True:
+                self.backlog[self.index] = db.write_behind.size()
+                try:
+                    item = self.updates.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                kind, payload = item
+                if kind == 'event':
+                    self.apply(*payload)
+                    continue
+                try:
+                    dispatcher.process_update(Update.de_json(payload, self.bot))
+                except Exception as e:
+                    logger.error("Shard " + str(self.index) + " dispatch error: " + str(e))
+        except KeyboardInterrupt:
+            pass
+        scheduler.stop()
+        reconciler.stop()
+        live_posts.stop()
+        dispatcher.stop()
+        outbox.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        db.close()
+        self.leader_lock.release()
+
+def run_shard_worker(index, count, updates, events, backlog):
+    global shard
+    setup_database()
+    shard = ShardWorker(index, count, updates, events, backlog)
+    shard.run()
+
+def shard_key(data):
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ('from', 'user', 'chat'):
+            owner = value.get(field)
+            if isinstance(owner, dict) and 'id' in owner:
+                return owner['id']
+    return data.get('update_id', 0)
+
+def run_sharded(count):
+    if fcntl is None:
+        logger.error("SHARD_WORKERS needs fcntl (Linux/Unix)")
+        return
+    context = multiprocessing.get_context('spawn')
+    events = context.Queue()
+    queues = [context.Queue(SHARD_QUEUE_SIZE) for _ in range(count)]
+    backlog = context.Array('i', count, lock=False)
+    processes = [None] * count
+
+    def spawn(index):
+        backlog[index] = 0
+        process = context.Process(target=run_shard_worker, args=(index, count, queues[index], events, backlog), name='shard-' + str(index), daemon=True)
+        process.start()
+        processes[index] = process
+
+    def relay():
+        while True:
+            item = events.get()
+            if item is None:
+                return
+            origin, event, args = item
+            for index, target in enumerate(queues):
+                if index != origin:
+                    target.put(('event', (event, args)))
+
+    def overloaded():
+        for index, target in enumerate(queues):
+            if backlog[index] >= WEBHOOK_MAX_PENDING_WRITES:
+                return True
+            try:
+                if target.qsize() >= SHARD_QUEUE_SIZE:
+                    return True
+            except NotImplementedError:
                 pass
+        return False
 
-            query.answer("Вы участвуете! Всего: " + str(participants_count), show_alert=True)
-        else:
-            query.answer("Вы уже участвуете", show_alert=True)
+    for index in range(count):
+        spawn(index)
+    threading.Thread(target=relay, name='shard-relay', daemon=True).start()
+    metrics.gauge('shard_write_behind_pending', lambda: sum(backlog))
+
+    bot = Bot(BOT_TOKEN, base_url=BOT_API_URL, request=InstrumentedRequest(con_pool_size=4))
+    webhook = None
+    if UPDATE_MODE == 'webhook':
+        webhook = WebhookServer(bot, overloaded).start()
+        webhook.register(WEBHOOK_URL)
+        print("Webhook: " + WEBHOOK_LISTEN + ":" + str(WEBHOOK_PORT))
+    else:
+        bot.delete_webhook()
+    metrics_server = start_metrics_server() if METRICS_PORT else None
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print("="*70)
+    print("БОТ ЗАПУЩЕН! (" + str(count) + " процессов)")
+    print("="*70)
+
+    offset = None
+    try:
+        while True:
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error("Shard " + str(index) + " exited with code " + str(process.exitcode) + ", restarting")
+                    metrics.inc('shard_restarts_total', shard=index)
+                    spawn(index)
+            batch = []
+            try:
+                if webhook is not None:
+                    for body in webhook.next_bodies(1.0):
+                        try:
+                            batch.append(json.loads(body))
+                        except ValueError as e:
+                            logger.warning("Bad webhook update: " + str(e))
+                elif overloaded():
+                    metrics.inc('shard_backpressure_waits_total')
+                    time.sleep(0.1)
+                else:
+                    updates = bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+                    if updates:
+                        offset = updates[-1].update_id + 1
+                    batch = [update.to_dict() for update in updates]
+            except NetworkError as e:
+                logger.warning("Polling error: " + str(e))
+                time.sleep(1)
+                continue
+            for data in batch:
+                index = abs(shard_key(data)) % count
+                queues[index].put(('update', data))
+                metrics.inc('shard_routed_total', shard=index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for target in queues:
+            target.put(None)
+        events.put(None)
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+        if webhook is not None:
+            webhook.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+def wait_for_stop_signal():
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopped.set())
+    while not stopped.wait(1.0):
+        pass
+    logger.info("Received stop signal, shutting down")
 
 def main():
     print("="*70)
@@ -1074,42 +3562,167 @@ def main():
     print("="*70)
 
     try:
-        updater = Updater(BOT_TOKEN, use_context=True)
-        dp = updater.dispatcher
-
-        dp.add_handler(CommandHandler("start", start))
-        dp.add_handler(CommandHandler("verify", verify))
-        dp.add_handler(CommandHandler("my_referrals", lambda u, c: my_referrals(u, c)))
-        dp.add_handler(CommandHandler("top", lambda u, c: top_referrers(u, c)))
-        dp.add_handler(CommandHandler("help", lambda u, c: help_cmd(u, c)))
-        dp.add_handler(CommandHandler("new", new_giveaway))
-        dp.add_handler(CommandHandler("list", lambda u, c: list_giveaways_cmd(u, c)))
-        dp.add_handler(CommandHandler("end", end_giveaway))
-        dp.add_handler(CommandHandler("stats", stats))
-        dp.add_handler(CommandHandler("participants", participants_cmd))
-        dp.add_handler(CommandHandler("remove", remove_participant))
-        dp.add_handler(CommandHandler("ban", ban_user))
-        dp.add_handler(CommandHandler("unban", unban_user))
-        dp.add_handler(CommandHandler("banned", banned_list))
-        dp.add_handler(CommandHandler("check_multi", check_multi))
-        dp.add_handler(CommandHandler("verify_info", verify_info))
-        dp.add_handler(CallbackQueryHandler(button_handler))
-        dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text))
-
-        auto_finish = threading.Thread(target=auto_finish_thread, args=(updater.bot,), daemon=True)
-        auto_finish.start()
-
-        updater.start_polling()
-        print("="*70)
-        print("БОТ ЗАПУЩЕН!")
-        print("Автозавершение: АКТИВНО")
-        print("="*70)
-
-        updater.idle()
+        if SHARD_WORKERS > 0:
+            run_sharded(SHARD_WORKERS)
+            return
+
+        setup_database()
+
+        request = InstrumentedRequest(con_pool_size=WORKERS + OUTBOX_SENDERS + SUB_CHECK_WORKERS + 4)
+        updater = Updater(bot=Bot(BOT_TOKEN, base_url=BOT_API_URL, request=request), use_context=True, workers=WORKERS)
+        try:
+            print("Бот: @" + updater.bot.username)
+        except TelegramError as e:
+            logger.warning("getMe failed: " + str(e))
+        setup_dispatcher(updater.dispatcher, rate_limit=RUNTIME != 'asyncio')
+
+        summary = db.load_clusters()
+        print("Кластеры: " + str(summary['clusters']) + " (" + str(summary['users']) + " аккаунтов)")
+
+        outbox.start(updater.bot)
+        live_posts.start()
+        reconciler.start()
+
+        metrics_server = None
+        if METRICS_PORT:
+            metrics_server = start_metrics_server()
+            print("Metrics: http://" + METRICS_LISTEN + ":" + str(METRICS_PORT) + "/metrics")
+
+        webhook = None
+        if UPDATE_MODE == 'webhook':
+            webhook = WebhookServer(updater.bot, write_behind_overloaded)
+            webhook.start(None if RUNTIME == 'asyncio' else updater.dispatcher)
+            webhook.register(WEBHOOK_URL)
+            metrics.gauge('webhook_queue', webhook.queue.qsize)
+            metrics.gauge('webhook_rejected_total', lambda: webhook.rejected, kind='counter')
+            print("Webhook: " + WEBHOOK_LISTEN + ":" + str(WEBHOOK_PORT))
+
+        if RUNTIME == 'asyncio':
+            print("="*70)
+            print("БОТ ЗАПУЩЕН! (asyncio)")
+            print("="*70)
+            try:
+                asyncio.run(run_async_runtime(updater, webhook))
+            except KeyboardInterrupt:
+                pass
+        else:
+            scheduler.start(lambda giveaway_id: finish_giveaway(updater.bot, giveaway_id))
+            if webhook is None:
+                updater.start_polling()
+            print("="*70)
+            print("БОТ ЗАПУЩЕН!")
+            print("Автозавершение: АКТИВНО")
+            print("="*70)
+            if webhook is None:
+                updater.idle()
+            else:
+                wait_for_stop_signal()
+            scheduler.stop()
+            if webhook is not None:
+                updater.dispatcher.stop()
+
+        if webhook is not None:
+            webhook.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+        reconciler.stop()
+        live_posts.stop()
+        outbox.stop()
+        db.close()
 
     except Exception as e:
         logger.error("Ошибка: " + str(e))
         print("Ошибка: " + str(e))
 
+def open_snapshot_file(path):
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    if compressed:
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+def read_snapshot_file(path):
+    with open_snapshot_file(path) as f:
+        header = f.readline()
+        if header.startswith('{'):
+            f.seek(0)
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f, fieldnames=next(csv.reader([header])))
+        for row in rows:
+            if int(row['is_valid']) == 1:
+                yield int(row['user_id']), 1 + int(row['bonus_entries'])
+
+def verify_draw_cli(args):
+    database = Database(args.db)
+    row = database.get_draw(args.draw_id)
+    if not row:
+        print("Draw " + str(args.draw_id) + " not found")
+        return 1
+    draw_id, giveaway_id, draw_date, algorithm, nonce, digest, count, total_weight, seed, winner_count, winners, excluded = row
+    winners = json.loads(winners)
+    excluded = json.loads(excluded or '[]')
+    print("Draw #" + str(draw_id) + " giveaway " + str(giveaway_id) + " at " + draw_date)
+    print("Algorithm: " + algorithm)
+    print("Stored digest: " + digest + " (" + str(count) + " participants, weight " + str(total_weight) + ")")
+    if excluded:
+        print("Excluded as multi-account clusters: " + str(len(excluded)))
+    if algorithm != DRAW_ALGORITHM:
+        print("Unsupported algorithm, this build implements " + DRAW_ALGORITHM)
+        return 1
+    if args.snapshot:
+        rows_factory = lambda: read_snapshot_file(args.snapshot)
+    else:
+        rows_factory = lambda: database.iter_participant_weights(giveaway_id)
+    with database.snapshot():
+        replay = run_draw(rows_factory, winner_count, nonce, excluded)
+    print("Replayed digest: " + replay['digest'] + " (" + str(replay['count']) + " participants, weight " + str(replay['total_weight']) + ")")
+    print("Stored seed:   " + seed)
+    print("Replayed seed: " + replay['seed'])
+    print("Stored winners:   " + str(winners))
+    print("Replayed winners: " + str(replay['winners']))
+    if replay['digest'] != digest:
+        print("MISMATCH: participant set changed since the draw")
+        return 1
+    if replay['seed'] != seed or replay['winners'] != winners:
+        print("MISMATCH: draw is not reproducible")
+        return 1
+    print("OK: draw reproduced")
+    return 0
+
+def export_cli(args):
+    database = Database(args.db)
+    if not database.get_giveaway_info(args.giveaway_id):
+        print("Giveaway " + str(args.giveaway_id) + " not found")
+        return 1
+    path = args.output or 'giveaway_' + str(args.giveaway_id) + '.' + args.format + '.gz'
+    started = time.perf_counter()
+    count = export_giveaway(database, args.giveaway_id, path, args.format)
+    print("Exported " + str(count) + " rows to " + path + " (" + str(os.path.getsize(path)) + " bytes, "
+          + str(round(time.perf_counter() - started, 2)) + " s)")
+    return 0
+
+def run_cli(argv):
+    parser = argparse.ArgumentParser(prog='GSMgiveaway_bot.py')
+    parser.add_argument('--db', default=DB_PATH)
+    commands = parser.add_subparsers(dest='command')
+    verify_parser = commands.add_parser('verify-draw', help='re-run a recorded draw offline')
+    verify_parser.add_argument('draw_id', type=int)
+    verify_parser.add_argument('--snapshot', help='participants file written by the export command (CSV or JSONL, gzipped or not) instead of the live table')
+    export_parser = commands.add_parser('export', help='stream giveaway participants to a gzip CSV/JSONL file')
+    export_parser.add_argument('giveaway_id', type=int)
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    export_parser.add_argument('--output', help='output path, default giveaway_<id>.<format>.gz')
+    args = parser.parse_args(argv)
+    if args.command == 'verify-draw':
+        return verify_draw_cli(args)
+    if args.command == 'export':
+        return export_cli(args)
+    parser.print_help()
+    return 1
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import heapq
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+parser = argparse.ArgumentParser(description="Weighted winner draw: statistical check and throughput")
+parser.add_argument('--sizes', default='1000000,10000000')
+parser.add_argument('--winners', type=int, default=100)
+parser.add_argument('--trials', type=int, default=200000)
+parser.add_argument('--db-size', type=int, default=1000000)
+args = parser.parse_args()
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench_draw.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import GSMgiveaway_bot as bot
+
+def synthetic(n, seed=1):
+    rng = random.Random(seed)
+    for user_id in range(1, n + 1):
+        yield user_id, 1 + (rng.randrange(20) if user_id % 10 == 0 else 0)
+
+def a_res_sample(rows, k, rng):
+    keys = [(rng.random() ** (1.0 / weight), user_id) for user_id, weight in rows]
+    return [user_id for key, user_id in heapq.nlargest(k, keys)]
+
+def inclusion_probabilities(weights):
+    total = float(sum(weights))
+    return [w / total + sum(v / total * w / (total - v) for j, v in enumerate(weights) if j != i)
+            for i, w in enumerate(weights)]
+
+def chi_square(counts, expected):
+    return sum((counts[n] - e) ** 2 / e for n, e in enumerate(expected))
+
+CHI2_CRITICAL_DF5 = 15.086
+
+def chi_square_check():
+    weights = [1, 1, 2, 3, 5, 8]
+    rows = list(enumerate(weights))
+    rng = random.Random(7)
+    counts = Counter(bot.weighted_sample(rows, 1, rng)[0] for _ in range(args.trials))
+    total = float(sum(weights))
+    expected = [args.trials * weight / total for weight in weights]
+    chi2 = chi_square(counts, expected)
+    print("user  weight  observed  expected")
+    for user_id, weight in rows:
+        print("%4d  %6d  %8d  %8.0f" % (user_id, weight, counts[user_id], expected[user_id]))
+    failures = []
+    print("k=1 A-ExpJ chi2 = %.3f (df=%d, critical 1%% = %.3f)" % (chi2, len(rows) - 1, CHI2_CRITICAL_DF5))
+    if chi2 >= CHI2_CRITICAL_DF5:
+        failures.append("k=1 A-ExpJ")
+
+    pair_trials = args.trials // 4
+    expected = [pair_trials * p for p in inclusion_probabilities(weights)]
+    for name, sampler in (("A-ExpJ", bot.weighted_sample), ("A-Res", a_res_sample)):
+        counts = Counter()
+        for _ in range(pair_trials):
+            counts.update(sampler(rows, 2, rng))
+        chi2 = chi_square(counts, expected)
+        print("k=2 %-6s inclusion " % name + ", ".join(str(user_id) + ":" + str(round(counts[user_id] / float(pair_trials), 3)) for user_id, _ in rows) +
+              "  chi2 = %.3f" % chi2)
+        if chi2 >= CHI2_CRITICAL_DF5:
+            failures.append("k=2 " + name)
+    print("exact k=2 inclusion  " + ", ".join(str(user_id) + ":" + str(round(e / pair_trials, 3)) for user_id, e in enumerate(expected)))
+    return failures
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def bench_engine(n):
+    start = time.perf_counter()
+    winners = bot.weighted_sample(synthetic(n), args.winners, random.Random(3))
+    elapsed = time.perf_counter() - start
+    print("engine  n=%-10d k=%-5d %8.3f s  %6.2f M rows/s  peak RSS %.1f MB" % (n, len(winners), elapsed, n / elapsed / 1e6, peak_rss_mb()))
+
+def bench_database(n):
+    database = bot.Database(os.environ['DB_PATH'])
+    conn = sqlite3.connect(os.environ['DB_PATH'])
+    conn.execute("INSERT INTO giveaways (name, winner_count, start_date, end_date, channel_id) VALUES ('bench', ?, '', '', '')", (args.winners,))
+    gid = conn.execute('SELECT MAX(id) FROM giveaways').fetchone()[0]
+    conn.executemany("INSERT INTO participants (giveaway_id, user_id, join_date, bonus_entries) VALUES (?, ?, '', ?)",
+        ((gid, user_id, weight - 1) for user_id, weight in synthetic(n)))
+    conn.commit()
+    conn.close()
+    start = time.perf_counter()
+    winners = bot.weighted_sample(database.iter_participant_weights(gid), args.winners)
+    elapsed = time.perf_counter() - start
+    print("sqlite  n=%-10d k=%-5d %8.3f s  %6.2f M rows/s  peak RSS %.1f MB" % (n, len(winners), elapsed, n / elapsed / 1e6, peak_rss_mb()))
+
+failures = chi_square_check()
+print("FAIL: " + ", ".join(failures) if failures else "PASS: draw frequencies match the weights")
+print("")
+for size in args.sizes.split(','):
+    bench_engine(int(size))
+if args.db_size:
+    bench_database(args.db_size)
+sys.exit(1 if failures else 0)
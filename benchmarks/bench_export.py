@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import gzip
+import json
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description="Stream a large giveaway to gzip CSV/JSONL under a fixed memory ceiling")
+parser.add_argument('--rows', type=int, default=5000000)
+parser.add_argument('--ceiling-mb', type=int, default=64, help="address space the export may add on top of the loaded bot")
+parser.add_argument('--formats', default='csv,jsonl')
+parser.add_argument('--db', default=None, help="reuse a populated database instead of building one")
+parser.add_argument('--child', nargs=3, metavar=('GIVEAWAY', 'FORMAT', 'OUTPUT'), help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+db_path = args.db or os.path.join(tempfile.mkdtemp(), 'bench_export.db')
+os.environ['DB_PATH'] = db_path
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import GSMgiveaway_bot as bot
+
+bot.setup_database()
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def address_space():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[0]) * resource.getpagesize()
+
+def child(giveaway_id, fmt, output):
+    bot.db.get_giveaway_info(giveaway_id)
+    baseline = rss_mb()
+    limit = address_space() + args.ceiling_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    started = time.perf_counter()
+    count = bot.export_giveaway(bot.db, giveaway_id, output, fmt)
+    print(json.dumps({'rows': count, 'seconds': time.perf_counter() - started, 'baseline_mb': baseline, 'peak_mb': rss_mb()}))
+
+def populate():
+    giveaway_id = bot.db.create_giveaway('Export benchmark', '', 10, 1, '@bench', 1)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('BEGIN')
+    conn.executemany('INSERT OR IGNORE INTO users (user_id, username, first_name, joined_date) VALUES (?, ?, ?, ?)',
+                     ((1000000 + n, 'user' + str(n), 'Участник ' + str(n), '2024-01-01T00:00:00') for n in range(args.rows)))
+    conn.executemany('INSERT INTO participants (giveaway_id, user_id, join_date, referred_by, bonus_entries) VALUES (?, ?, ?, ?, ?)',
+                     ((giveaway_id, 1000000 + n, '2024-01-01T00:00:00', 1000000 + n // 7 if n % 3 == 0 else None, n % 3)
+                      for n in range(args.rows)))
+    conn.execute('COMMIT')
+    conn.execute('BEGIN')
+    bot.rebuild_referral_counts(conn.cursor())
+    conn.execute('COMMIT')
+    conn.close()
+    draw = bot.draw_giveaway(bot.db, giveaway_id, 10, exclude_size=0)
+    bot.db.record_draw(giveaway_id, draw)
+    return giveaway_id
+
+if args.child:
+    child(int(args.child[0]), args.child[1], args.child[2])
+    sys.exit(0)
+
+if args.db:
+    giveaway_id = bot.db.execute('SELECT MAX(id) FROM giveaways').fetchone()[0]
+else:
+    print("populating %d participants..." % args.rows)
+    started = time.perf_counter()
+    giveaway_id = populate()
+    print("populated in %.1f s" % (time.perf_counter() - started))
+bot.db.close()
+
+ok = True
+out_dir = tempfile.mkdtemp()
+for fmt in args.formats.split(','):
+    output = os.path.join(out_dir, 'export.' + fmt + '.gz')
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--db', db_path, '--ceiling-mb', str(args.ceiling_mb),
+                             '--child', str(giveaway_id), fmt, output], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        ok = False
+        print("FAIL %-5s export died under a %d MB ceiling: %s" % (fmt, args.ceiling_mb, result.stderr.decode().strip().splitlines()[-1:]))
+        continue
+    report = json.loads(result.stdout.decode().strip().splitlines()[-1])
+    with gzip.open(output, 'rt', encoding='utf-8') as f:
+        lines = sum(1 for _ in f)
+    expected = report['rows'] + (1 if fmt == 'csv' else 0)
+    passed = report['rows'] == args.rows and lines == expected
+    ok = ok and passed
+    print("%s %-5s %d rows in %.1f s (%.0f rows/s), %.1f MB gzip, RSS %.1f -> %.1f MB (+%.1f MB, ceiling +%d MB)" % (
+        "PASS" if passed else "FAIL", fmt, report['rows'], report['seconds'], report['rows'] / report['seconds'],
+        os.path.getsize(output) / 1048576.0, report['baseline_mb'], report['peak_mb'],
+        report['peak_mb'] - report['baseline_mb'], args.ceiling_mb))
+    os.remove(output)
+sys.exit(0 if ok else 1)
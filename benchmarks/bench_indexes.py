@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+parser = argparse.ArgumentParser(description="Query plans and timings with and without the migration indexes")
+parser.add_argument('--participants', type=int, default=1000000)
+parser.add_argument('--users', type=int, default=250000)
+parser.add_argument('--giveaways', type=int, default=200)
+parser.add_argument('--repeat', type=int, default=20)
+parser.add_argument('--db', default=None)
+args = parser.parse_args()
+
+db_path = args.db or os.path.join(tempfile.mkdtemp(), 'bench_indexes.db')
+os.environ['DB_PATH'] = db_path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import GSMgiveaway_bot as bot
+
+def populate(path):
+    rng = random.Random(42)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous=OFF')
+    now = datetime.now()
+    if conn.execute('SELECT COUNT(*) FROM participants').fetchone()[0] >= args.participants:
+        conn.close()
+        return
+    print("Populating " + path + " ...")
+    ip_pool = [('%032x' % rng.getrandbits(128)) for _ in range(args.users // 3)]
+    conn.executemany("INSERT OR IGNORE INTO users (user_id, username, first_name, joined_date, is_verified, is_banned, banned_date, ip_hash, last_activity) VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)",
+        ((uid, 'user' + str(uid), 'User', (now - timedelta(minutes=uid)).isoformat(), 1 if uid % 500 == 0 else 0,
+          now.isoformat() if uid % 500 == 0 else None, rng.choice(ip_pool), now.isoformat())
+         for uid in range(1, args.users + 1)))
+    conn.executemany("INSERT OR IGNORE INTO ip_addresses (ip_hash, user_count, first_seen, last_seen) VALUES (?, ?, ?, ?)",
+        ((ip, rng.randint(1, 5), now.isoformat(), now.isoformat()) for ip in ip_pool))
+    conn.executemany("INSERT INTO giveaways (name, description, winner_count, start_date, end_date, is_active, channel_id, auto_finish) VALUES (?, '', 3, ?, ?, ?, '@bench', 1)",
+        (('g' + str(g), now.isoformat(), (now + timedelta(hours=g - args.giveaways // 2)).isoformat(), 1 if g % 4 else 0)
+         for g in range(1, args.giveaways + 1)))
+    per_giveaway = args.participants // args.giveaways
+    for gid in range(1, args.giveaways + 1):
+        users = rng.sample(range(1, args.users + 1), min(per_giveaway, args.users))
+        conn.executemany("INSERT OR IGNORE INTO participants (giveaway_id, user_id, join_date, is_valid, referred_by, bonus_entries) VALUES (?, ?, ?, 1, ?, ?)",
+            ((gid, uid, now.isoformat(), None, 0) for uid in users))
+        conn.executemany("INSERT OR IGNORE INTO referrals (referrer_id, referred_id, giveaway_id, referral_date) VALUES (?, ?, ?, ?)",
+            ((users[rng.randrange(len(users))], uid, gid, now.isoformat()) for uid in users[:len(users) // 3]))
+    bot.rebuild_referral_counts(conn.cursor())
+    conn.commit()
+    conn.close()
+
+def drop_indexes(conn):
+    names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall()]
+    for name in names:
+        conn.execute('DROP INDEX ' + name)
+
+def create_indexes(conn):
+    for version, name, steps in bot.MIGRATIONS:
+        for step in steps:
+            if isinstance(step, str) and step.startswith(('CREATE INDEX', 'DROP INDEX')):
+                conn.execute(step)
+
+QUERIES = [
+    ("check_multiple_accounts", 'SELECT user_id FROM users WHERE ip_hash = (SELECT ip_hash FROM users WHERE user_id = ?) AND user_id != ?',
+        lambda: (sample_user, sample_user)),
+    ("ban_user (participants by user_id)", 'SELECT COUNT(*) FROM participants WHERE user_id = ?',
+        lambda: (sample_user,)),
+    ("top referrers (GROUP BY referrals)", """SELECT r.referrer_id, u.username, u.first_name, COUNT(r.referred_id) as ref_count
+        FROM referrals r LEFT JOIN users u ON r.referrer_id = u.user_id
+        GROUP BY r.referrer_id ORDER BY ref_count DESC LIMIT ?""", lambda: (10,)),
+    ("get_top_referrers (global)", """SELECT c.referrer_id, u.username, u.first_name, c.ref_count
+        FROM referral_counts c LEFT JOIN users u ON c.referrer_id = u.user_id
+        WHERE c.giveaway_id = ? ORDER BY c.ref_count DESC, c.referrer_id LIMIT ?""", lambda: (bot.GLOBAL_LEADERBOARD, 10)),
+    ("get_top_referrers (giveaway)", """SELECT c.referrer_id, u.username, u.first_name, c.ref_count
+        FROM referral_counts c LEFT JOIN users u ON c.referrer_id = u.user_id
+        WHERE c.giveaway_id = ? ORDER BY c.ref_count DESC, c.referrer_id LIMIT ?""", lambda: (1, 10)),
+    ("get_referral_count", 'SELECT ref_count FROM referral_counts WHERE giveaway_id = ? AND referrer_id = ?',
+        lambda: (1, sample_user)),
+    ("get_participants_count", 'SELECT participant_count FROM giveaways WHERE id = ?',
+        lambda: (1,)),
+    ("reconcile_participant_counts", """SELECT g.id, g.participant_count,
+        (SELECT COUNT(*) FROM participants p WHERE p.giveaway_id = g.id AND p.is_valid = 1)
+        FROM giveaways g WHERE g.is_active = 1""", lambda: ()),
+]
+
+def measure(conn, label):
+    print("\n=== " + label + " ===")
+    for name, sql, params in QUERIES:
+        plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, params()).fetchall()
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            conn.execute(sql, params()).fetchall()
+        elapsed = (time.perf_counter() - start) / args.repeat * 1000
+        print("%-38s %10.3f ms" % (name, elapsed))
+        for row in plan:
+            print("    " + row[-1])
+
+bot.Database(db_path).close()
+populate(db_path)
+conn = sqlite3.connect(db_path, isolation_level=None)
+sample_user = conn.execute('SELECT user_id FROM participants LIMIT 1 OFFSET 1000').fetchone()[0]
+print("participants: " + str(conn.execute('SELECT COUNT(*) FROM participants').fetchone()[0]))
+
+drop_indexes(conn)
+conn.execute('ANALYZE')
+measure(conn, "without indexes")
+
+create_indexes(conn)
+print("\nschema_version: " + str(bot.Database(db_path).schema_version()))
+conn.execute('ANALYZE')
+measure(conn, "with migration indexes")
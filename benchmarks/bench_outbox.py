@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+parser = argparse.ArgumentParser(description="Outbound queue against a local fake Bot API")
+parser.add_argument('--users', type=int, default=60)
+parser.add_argument('--dms', type=int, default=3)
+parser.add_argument('--callbacks', type=int, default=100)
+parser.add_argument('--posts', type=int, default=3)
+parser.add_argument('--latency', type=float, default=0.02)
+args = parser.parse_args()
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench_outbox.db')
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+import GSMgiveaway_bot as bot
+from fake_bot_api import FakeBotApi, TOKEN
+
+class FakeQuery:
+    def __init__(self, query_id):
+        self.id = str(query_id)
+
+failures = []
+
+def check(name, ok, detail=""):
+    print(("PASS " if ok else "FAIL ") + name + (" (" + detail + ")" if detail else ""))
+    if not ok:
+        failures.append(name)
+    return ok
+
+api = FakeBotApi(latency=args.latency).start()
+outbox = bot.Outbox()
+outbox.start(Bot(TOKEN, base_url=api.base_url, request=Request(con_pool_size=bot.OUTBOX_SENDERS + 2)))
+
+flooded_user = 1
+api.flood_chat(flooded_user, times=1, retry_after=2)
+
+start = time.monotonic()
+futures = []
+enqueue_start = time.perf_counter()
+for round_no in range(args.dms):
+    for user_id in range(1, args.users + 1):
+        futures.append(('dm', outbox.send_message(user_id, "dm " + str(round_no))))
+for post in range(args.posts):
+    futures.append(('post', outbox.send_message('@channel', "post " + str(post), lane=bot.LANE_CHANNEL)))
+for query_id in range(args.callbacks):
+    futures.append(('callback', outbox.answer_callback(FakeQuery(query_id), "ok")))
+enqueue_time = time.perf_counter() - enqueue_start
+
+finished = defaultdict(list)
+for kind, future in futures:
+    future.add_done_callback(lambda f, kind=kind: finished[kind].append(time.monotonic() - start))
+for kind, future in futures:
+    future.result(timeout=600)
+total = time.monotonic() - start
+
+sends = [(t, m, p) for t, m, p in api.calls if m in ('sendMessage', 'answerCallbackQuery')]
+per_chat = defaultdict(list)
+for t, m, p in sends:
+    if m == 'sendMessage':
+        per_chat[str(p['chat_id'])].append(t)
+min_private_gap = min(b - a for times in per_chat.values() if len(times) > 1 for a, b in zip(times, times[1:]))
+window_max = 0
+times = sorted(t for t, _, _ in sends)
+j = 0
+for i in range(len(times)):
+    while times[i] - times[j] > 1.0:
+        j += 1
+    window_max = max(window_max, i - j + 1)
+flood_hits = [c for c in api.calls if c[1].endswith(':429')]
+flooded_sends = per_chat[str(flooded_user)]
+
+print("enqueued %d requests in %.2f ms, drained in %.2f s (%.1f req/s)" % (len(futures), enqueue_time * 1000, total, len(futures) / total))
+print("callbacks done by %.2f s, DMs by %.2f s, posts by %.2f s" % (max(finished['callback']), max(finished['dm']), max(finished['post'])))
+check("enqueue does not block", enqueue_time < 0.5, "%.1f ms" % (enqueue_time * 1000))
+check("global rate", window_max <= outbox.global_bucket.rate + outbox.global_bucket.capacity, str(window_max) + " calls in busiest second")
+check("per-chat rate", min_private_gap >= 1.0 / bot.OUTBOX_PRIVATE_RATE * 0.9, "min gap %.3f s" % min_private_gap)
+check("callback lane first", max(finished['callback']) < max(finished['dm']))
+check("retry-after honoured", len(flood_hits) == 1 and len(flooded_sends) == args.dms and flooded_sends[0] - flood_hits[0][0] >= 1.9,
+      "%d 429s, retried after %.2f s" % (len(flood_hits), (flooded_sends[0] - flood_hits[0][0]) if flooded_sends and flood_hits else -1))
+check("nothing lost", outbox.sent == len(futures) and outbox.failed == 0, "sent %d failed %d" % (outbox.sent, outbox.failed))
+outbox.stop()
+api.stop()
+sys.exit(1 if failures else 0)
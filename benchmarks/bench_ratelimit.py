@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description="Reply latency for ordinary users while one account floods /start, with and without the rate limiter")
+parser.add_argument('--flood', type=int, default=3000, help="updates sent by the flooding account")
+parser.add_argument('--users', type=int, default=200, help="ordinary users, one /start each, spread through the flood")
+parser.add_argument('--latency', type=float, default=0.01, help="fake Bot API latency per call, seconds")
+args = parser.parse_args()
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench_ratelimit.db')
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+
+from telegram.ext import Updater
+
+import GSMgiveaway_bot as bot
+from fake_bot_api import FakeBotApi, TOKEN
+
+bot.setup_database()
+
+FLOODER = 777
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def start_update(user_id, n):
+    return {'message': {'message_id': n, 'date': int(time.time()), 'text': '/start',
+                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+                        'chat': {'id': user_id, 'type': 'private', 'first_name': 'User' + str(user_id)},
+                        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User' + str(user_id)}}}
+
+def run(label, limiter):
+    bot.rate_limiter = limiter
+    api = FakeBotApi(latency=args.latency).start()
+    replies = {}
+    flood_replies = [0]
+    done = threading.Event()
+
+    def on_call(now, method, params):
+        if method != 'sendMessage':
+            return
+        chat_id = int(params['chat_id'])
+        if chat_id == FLOODER:
+            flood_replies[0] += 1
+        elif chat_id not in replies:
+            replies[chat_id] = now
+            if len(replies) >= args.users:
+                done.set()
+
+    api.listeners.append(on_call)
+    updater = Updater(TOKEN, base_url=api.base_url, workers=bot.WORKERS,
+                      request_kwargs={'con_pool_size': bot.WORKERS + 4, 'read_timeout': 30})
+    bot.setup_dispatcher(updater.dispatcher)
+    every = max(1, args.flood // args.users)
+    user_id = 100000
+    for n in range(args.flood):
+        api.push_update(start_update(FLOODER, n))
+        if n % every == 0 and user_id < 100000 + args.users:
+            api.push_update(start_update(user_id, n))
+            user_id += 1
+    while user_id < 100000 + args.users:
+        api.push_update(start_update(user_id, 0))
+        user_id += 1
+    start = time.monotonic()
+    updater.start_polling(poll_interval=0, timeout=1)
+    done.wait(600)
+    latencies = [t - start for t in replies.values()]
+    print("%-8s ordinary users answered p50 %7.1f ms  p99 %7.1f ms  last %7.1f ms   flood replies %5d   dropped %d" % (
+        label, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, max(latencies) * 1000,
+        flood_replies[0], limiter.dropped['user'] + limiter.dropped['global']))
+    updater.stop()
+    api.stop()
+
+print("%d flood updates from one account, %d ordinary users, API latency %.0f ms" % (args.flood, args.users, args.latency * 1000))
+run("off", bot.UpdateRateLimiter(user_rate=0, global_rate=0))
+bot.db.flush()
+run("on", bot.UpdateRateLimiter())
+bot.db.close()
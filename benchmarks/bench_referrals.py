@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description="my_referrals rendering: per-giveaway queries vs one aggregate and a memo")
+parser.add_argument('--giveaways', type=int, default=50)
+parser.add_argument('--referrals', type=int, default=20000)
+parser.add_argument('--presses', type=int, default=200)
+parser.add_argument('--latency', type=float, default=0.02, help="fake Bot API latency per call, seconds")
+args = parser.parse_args()
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench_referrals.db')
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+import GSMgiveaway_bot as bot
+from fake_bot_api import FakeBotApi, TOKEN
+
+bot.setup_database()
+
+USER_ID = 42
+
+class FakeMessage:
+    def __init__(self):
+        self.from_user = None
+        self.text = None
+
+    def edit_text(self, text, reply_markup=None):
+        self.text = text
+
+class FakeUser:
+    id = USER_ID
+
+class FakeUpdate:
+    effective_user = FakeUser()
+
+class FakeContext:
+    def __init__(self, telegram_bot):
+        self.bot = telegram_bot
+
+def populate():
+    database = bot.db
+    database.add_user(USER_ID, 'referrer', 'Referrer')
+    database.flush()
+    database.verify_user(USER_ID)
+    giveaway_ids = [database.create_giveaway('giveaway ' + str(n), '', 3, 24 + n, '@bench') for n in range(args.giveaways)]
+    for gid in giveaway_ids:
+        database.add_participant(gid, USER_ID)
+    with database.transaction() as cursor:
+        for n in range(args.referrals):
+            gid = giveaway_ids[n % len(giveaway_ids)]
+            referrer = USER_ID if n % 4 == 0 else 1000 + n % 5000
+            cursor.execute('INSERT OR IGNORE INTO participants (giveaway_id, user_id, join_date) VALUES (?, ?, ?)', (gid, 100000 + n, ''))
+            cursor.execute('INSERT INTO referrals (referrer_id, referred_id, giveaway_id, referral_date) VALUES (?, ?, ?, ?)', (referrer, 100000 + n, gid, ''))
+        bot.rebuild_referral_counts(cursor)
+    return giveaway_ids
+
+def old_render(telegram_bot):
+    text = ""
+    for gid, name, winners, end_date, require_sub in bot.db.get_active_giveaways():
+        referral_count = bot.db.execute('SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND giveaway_id = ?', (USER_ID, gid)).fetchone()[0]
+        bonus_entries = bot.db.get_bonus_entries(USER_ID, gid)
+        bot_username = telegram_bot.get_me().username
+        text += name + " https://t.me/" + bot_username + "?start=ref_" + str(gid) + "_" + str(USER_ID) + " " + str(referral_count) + " " + str(bonus_entries) + "\n"
+    return text
+
+def statements():
+    for (name, labels), value in bot.metrics.counters.items():
+        if name == 'db_statements_total':
+            return value
+    return 0
+
+def measure(label, render, presses):
+    api.calls[:] = []
+    before = statements()
+    start = time.perf_counter()
+    for _ in range(presses):
+        render()
+    elapsed = (time.perf_counter() - start) / presses
+    print("%-28s %9.2f ms/press  %6.1f SQL statements/press  %5.1f getMe/press" % (
+        label, elapsed * 1000, (statements() - before) / float(presses), len(api.calls_for('getMe')) / float(presses)))
+
+api = FakeBotApi(latency=args.latency).start()
+telegram_bot = Bot(TOKEN, base_url=api.base_url, request=Request(con_pool_size=4))
+giveaway_ids = populate()
+print("%d active giveaways, %d referrals, API latency %.0f ms" % (args.giveaways, args.referrals, args.latency * 1000))
+
+update, context, message = FakeUpdate(), FakeContext(telegram_bot), FakeMessage()
+measure("before (N+1, getMe per row)", lambda: old_render(telegram_bot), max(1, args.presses // 20))
+
+def uncached():
+    bot.db.referral_cache.clear()
+    bot.my_referrals(update, context, message)
+
+measure("aggregate query", uncached, args.presses)
+measure("aggregate query + memo", lambda: bot.my_referrals(update, context, message), args.presses)
+
+bot.db.add_participant(giveaway_ids[0], 999999, referred_by=USER_ID)
+stale = bot.db.referral_cache.get(USER_ID) is not None
+bot.my_referrals(update, context, message)
+expected = bot.db.get_referral_count(USER_ID, giveaway_ids[0])
+print("memo invalidated on new referral: " + ("yes" if not stale and ("Приглашено: " + str(expected)) in message.text else "NO"))
+api.stop()
+bot.db.close()
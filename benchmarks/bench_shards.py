@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+parser = argparse.ArgumentParser(description="Update throughput of the bot process against SHARD_WORKERS worker processes")
+parser.add_argument('--workers', default='0,1,2,4', help="comma separated SHARD_WORKERS values, 0 = single process")
+parser.add_argument('--updates', type=int, default=4000)
+parser.add_argument('--latency', type=float, default=0.0, help="fake Bot API latency per call, seconds")
+parser.add_argument('--timeout', type=float, default=300)
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+from fake_bot_api import TOKEN
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def call(base_url, method, params=None):
+    request = urllib.request.Request(base_url + TOKEN + '/' + method, json.dumps(params or {}).encode(),
+                                     {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())['result']
+
+def start_update(user_id):
+    return {'message': {'message_id': 1, 'date': int(time.time()), 'text': '/start',
+                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+                        'chat': {'id': user_id, 'type': 'private', 'first_name': 'User' + str(user_id)},
+                        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User' + str(user_id)}}}
+
+def replies(base_url):
+    return call(base_url, 'getCallCounts').get('sendMessage', 0)
+
+def run(workers, base_url):
+    baseline = replies(base_url)
+    first_user = 1000000 * (workers + 1)
+    for chunk in range(0, args.updates, 500):
+        call(base_url, 'pushUpdates', {'updates': [start_update(first_user + n) for n in range(chunk, min(args.updates, chunk + 500))]})
+    env = dict(os.environ, DB_PATH=os.path.join(tempfile.mkdtemp(), 'bench_shards.db'), BOT_TOKEN=TOKEN, BOT_API_URL=base_url,
+               SHARD_WORKERS=str(workers), POLL_TIMEOUT='1', RECONCILE_INTERVAL='0', RATE_LIMIT_GLOBAL_RATE='0',
+               OUTBOX_GLOBAL_RATE='100000', OUTBOX_PRIVATE_RATE='100000', OUTBOX_GROUP_RATE='100000')
+    process = subprocess.Popen([sys.executable, os.path.join(here, '..', 'GSMgiveaway_bot.py')], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    started = time.monotonic()
+    warm = None
+    done = 0
+    while time.monotonic() - started < args.timeout:
+        done = replies(base_url) - baseline
+        if warm is None and done >= args.updates // 10:
+            warm = (time.monotonic(), done)
+        if done >= args.updates:
+            break
+        time.sleep(0.05)
+    finished = time.monotonic()
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    if warm is None or done < args.updates:
+        print("%-12s timed out with %d/%d replies" % (label(workers), done, args.updates))
+        return None
+    rate = (done - warm[1]) / max(finished - warm[0], 1e-9)
+    print("%-12s %6d updates  %7.1f upd/s after warm-up  (%.1f s incl. start-up)" % (label(workers), done, rate, finished - started))
+    return rate
+
+def label(workers):
+    return "single" if workers == 0 else str(workers) + " worker" + ("s" if workers > 1 else "")
+
+port = free_port()
+api = subprocess.Popen([sys.executable, os.path.join(here, 'fake_bot_api.py'), '--port', str(port), '--latency', str(args.latency)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+base_url = 'http://127.0.0.1:%d/bot' % port
+for _ in range(100):
+    try:
+        call(base_url, 'getMe')
+        break
+    except OSError:
+        time.sleep(0.1)
+
+print("%d /start updates per run, API latency %.0f ms, %d CPUs" % (args.updates, args.latency * 1000, os.cpu_count() or 1))
+results = {}
+for workers in [int(w) for w in args.workers.split(',')]:
+    results[workers] = run(workers, base_url)
+base = results.get(0) or results.get(1)
+if base:
+    print("\nscaling vs " + ("single process" if results.get(0) else "1 worker") + ": " +
+          ", ".join(label(w) + " x%.2f" % (rate / base) for w, rate in results.items() if rate))
+api.terminate()
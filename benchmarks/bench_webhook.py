@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description="Replay /start updates through long polling and through the webhook server")
+parser.add_argument('--updates', type=int, default=2000)
+parser.add_argument('--clients', type=int, default=40)
+parser.add_argument('--latency', type=float, default=0.0)
+parser.add_argument('--replay', default=None, help="JSONL file with recorded updates (one update per line)")
+args = parser.parse_args()
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench_webhook.db')
+os.environ.setdefault('RATE_LIMIT_GLOBAL_RATE', '0')
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+
+from telegram.ext import Updater
+
+import GSMgiveaway_bot as bot
+from fake_bot_api import FakeBotApi, TOKEN
+
+bot.setup_database()
+
+def recorded_updates():
+    if args.replay:
+        with open(args.replay) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    updates = []
+    for n in range(args.updates):
+        user_id = 100000 + n
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'User' + str(user_id), 'username': 'user' + str(user_id)}
+        updates.append({'message': {'message_id': n + 1, 'date': int(time.time()), 'text': '/start',
+                                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+                                    'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name']},
+                                    'from': user}})
+    return updates
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+class Replies:
+    def __init__(self, api, expected):
+        self.expected = expected
+        self.sent = {}
+        self.done = {}
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        api.listeners.append(self.on_call)
+
+    def on_call(self, now, method, params):
+        if method != 'sendMessage':
+            return
+        with self.lock:
+            self.done.setdefault(int(params['chat_id']), now)
+            if len(self.done) >= self.expected:
+                self.finished.set()
+
+    def report(self, label, start):
+        self.finished.wait(600)
+        end = max(self.done.values())
+        latencies = [self.done[chat] - self.sent[chat] for chat in self.done if chat in self.sent]
+        print("%-8s %6d updates in %6.2f s  %8.1f upd/s  reply latency p50 %7.1f ms  p99 %7.1f ms" % (
+            label, len(self.done), end - start, len(self.done) / (end - start),
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+
+def make_updater(api):
+    updater = Updater(TOKEN, base_url=api.base_url, workers=bot.WORKERS,
+                      request_kwargs={'con_pool_size': bot.WORKERS + 4, 'read_timeout': 30})
+    bot.setup_dispatcher(updater.dispatcher)
+    return updater
+
+def chat_of(update):
+    return update['message']['chat']['id']
+
+def bench_polling(updates):
+    api = FakeBotApi(latency=args.latency).start()
+    replies = Replies(api, len(updates))
+    updater = make_updater(api)
+    start = time.monotonic()
+    for update in updates:
+        replies.sent[chat_of(update)] = time.monotonic()
+        api.push_update(dict(update))
+    updater.start_polling(poll_interval=0, timeout=1)
+    replies.report("polling", start)
+    updater.stop()
+    api.stop()
+
+def bench_webhook(updates):
+    api = FakeBotApi(latency=args.latency).start()
+    replies = Replies(api, len(updates))
+    updater = make_updater(api)
+    webhook = bot.WebhookServer(updater.bot, bot.write_behind_overloaded, listen='127.0.0.1', port=0).start(updater.dispatcher)
+    host, port = webhook.server.server_address[:2]
+    acks = []
+    retries = [0]
+    lock = threading.Lock()
+
+    def client(chunk):
+        conn = http.client.HTTPConnection(host, port)
+        for n, update in enumerate(chunk):
+            update = dict(update, update_id=n + 1)
+            body = json.dumps(update).encode()
+            while True:
+                sent = time.monotonic()
+                replies.sent[chat_of(update)] = sent
+                conn.request('POST', webhook.path, body, {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                response.read()
+                if response.status == 200:
+                    break
+                with lock:
+                    retries[0] += 1
+                time.sleep(float(response.getheader('Retry-After') or 1) / 10)
+            with lock:
+                acks.append(time.monotonic() - sent)
+        conn.close()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=client, args=(updates[i::args.clients],)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ingest = time.monotonic() - start
+    replies.report("webhook", start)
+    print("         ack p50 %.2f ms  p99 %.2f ms  ingested in %.2f s  503 retries %d  rejected %d" % (
+        percentile(acks, 0.5) * 1000, percentile(acks, 0.99) * 1000, ingest, retries[0], webhook.rejected))
+    webhook.stop()
+    updater.stop()
+    api.stop()
+
+updates = recorded_updates()
+print("replaying %d updates (latency %.0f ms, %d webhook connections)" % (len(updates), args.latency * 1000, args.clients))
+bench_polling(updates)
+bot.db.flush()
+bench_webhook(updates)
+bot.db.close()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+TOKEN = '123456:FAKE-TOKEN'
+
+def chat_type(chat_id):
+    if isinstance(chat_id, str) and chat_id.startswith('@'):
+        return 'channel'
+    return 'private' if int(chat_id) > 0 else 'supergroup'
+
+def chat_json(chat_id):
+    kind = chat_type(chat_id)
+    if kind == 'private':
+        return {'id': int(chat_id), 'type': kind, 'first_name': 'User' + str(chat_id), 'username': 'user' + str(chat_id)}
+    if kind == 'channel':
+        return {'id': -1000000000001, 'type': kind, 'title': chat_id[1:], 'username': chat_id[1:]}
+    return {'id': int(chat_id), 'type': kind, 'title': 'Group ' + str(chat_id)}
+
+class FakeBotApi:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Condition()
+        self.calls = []
+        self.listeners = []
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.flood = {}
+        self.non_members = set()
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d/bot' % self.server.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_update(self, update):
+        with self.lock:
+            update['update_id'] = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.lock.notify_all()
+            return update['update_id']
+
+    def flood_chat(self, chat_id, times=1, retry_after=1):
+        with self.lock:
+            self.flood[str(chat_id)] = (times, retry_after)
+
+    def calls_for(self, method):
+        with self.lock:
+            return [call for call in self.calls if call[1] == method]
+
+    def handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type') or ''
+                if 'json' in content_type:
+                    params = json.loads(body or b'{}')
+                elif 'multipart' in content_type:
+                    params = {'multipart_bytes': len(body)}
+                    for part in body.split(b'\r\n--'):
+                        if b'name="chat_id"' in part:
+                            params['chat_id'] = part.split(b'\r\n\r\n', 1)[1].decode().strip()
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                status, payload = api.dispatch(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def message(self, chat_id, **extra):
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        result = {'message_id': message_id, 'date': int(time.time()), 'chat': chat_json(chat_id)}
+        result.update(extra)
+        return result
+
+    def dispatch(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        now = time.monotonic()
+        chat_id = params.get('chat_id')
+        with self.lock:
+            flood = self.flood.get(str(chat_id)) if chat_id is not None else None
+            if flood and flood[0] > 0 and method in ('sendMessage', 'editMessageText'):
+                self.flood[str(chat_id)] = (flood[0] - 1, flood[1])
+                self.calls.append((now, method + ':429', params))
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after ' + str(flood[1]),
+                             'parameters': {'retry_after': flood[1]}}
+            if method != 'getUpdates':
+                self.calls.append((now, method, params))
+        for listener in list(self.listeners):
+            listener(now, method, params)
+
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self.message(chat_id, text=params.get('text', ''))
+        elif method == 'sendDocument':
+            result = self.message(chat_id, document={'file_id': 'fake', 'file_unique_id': 'fake'})
+        elif method == 'getChat':
+            result = chat_json(chat_id)
+        elif method == 'getChatMember':
+            user_id = int(params.get('user_id'))
+            status = 'left' if user_id in self.non_members else 'member'
+            result = {'user': {'id': user_id, 'is_bot': False, 'first_name': 'User' + str(user_id)}, 'status': status}
+        elif method == 'getUpdates':
+            result = self.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0), int(params.get('limit') or 100))
+        elif method == 'pushUpdates':
+            result = [self.push_update(update) for update in params.get('updates', [])]
+        elif method == 'getCallCounts':
+            with self.lock:
+                result = {}
+                for _, name, _ in self.calls:
+                    result[name] = result.get(name, 0) + 1
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    def get_updates(self, offset, timeout, limit):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            if offset:
+                self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    api = FakeBotApi(port=args.port, latency=args.latency).start()
+    print("Fake Bot API listening on " + api.base_url + " (token " + TOKEN + ")")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        api.stop()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+parser = argparse.ArgumentParser(description="Synthetic users against the bot and a local fake Bot API")
+parser.add_argument('--users', type=int, default=500)
+parser.add_argument('--arrival-rate', type=float, default=0, help="new users per second, 0 = all at once")
+parser.add_argument('--winners', type=int, default=10)
+parser.add_argument('--latency', type=float, default=0.01, help="fake Bot API latency per call, seconds")
+parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+parser.add_argument('--clients', type=int, default=20, help="webhook delivery connections")
+parser.add_argument('--real-limits', action='store_true', help="keep the production outbound rate limits")
+parser.add_argument('--timeout', type=float, default=600)
+parser.add_argument('--dump-metrics', action='store_true', help="print the /metrics exposition at the end")
+args = parser.parse_args()
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'loadtest.db')
+if not args.real_limits:
+    os.environ.setdefault('OUTBOX_GLOBAL_RATE', '100000')
+    os.environ.setdefault('OUTBOX_PRIVATE_RATE', '100000')
+    os.environ.setdefault('OUTBOX_GROUP_RATE', '100000')
+    os.environ.setdefault('RATE_LIMIT_GLOBAL_RATE', '0')
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+
+from telegram import Bot
+from telegram.ext import Updater
+
+import GSMgiveaway_bot as bot
+from fake_bot_api import FakeBotApi, TOKEN
+
+bot.setup_database()
+
+CAPTCHA = re.compile(r'Решите: (-?\d+) ([+x-]) (-?\d+) =')
+STEPS = ['start', 'verify', 'captcha', 'join']
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def user_json(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'User' + str(user_id), 'username': 'user' + str(user_id)}
+
+def text_update(user_id, text):
+    message = {'message_id': 1, 'date': int(time.time()), 'text': text,
+               'chat': {'id': user_id, 'type': 'private', 'first_name': 'User' + str(user_id)}, 'from': user_json(user_id)}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+def join_update(user_id, giveaway_id):
+    return {'callback_query': {'id': 'cq' + str(user_id), 'from': user_json(user_id), 'chat_instance': 'load',
+                               'data': 'join_' + str(giveaway_id),
+                               'message': {'message_id': 1, 'date': int(time.time()), 'text': 'post',
+                                           'chat': {'id': user_id, 'type': 'private', 'first_name': 'User' + str(user_id)}}}}
+
+def solve(match):
+    a, op, b = int(match.group(1)), match.group(2), int(match.group(3))
+    return str(a + b if op == '+' else a - b if op == '-' else a * b)
+
+class Population:
+    def __init__(self, api, deliver, giveaway_id, total):
+        self.deliver = deliver
+        self.giveaway_id = giveaway_id
+        self.total = total
+        self.lock = threading.Lock()
+        self.state = {}
+        self.pushed = {}
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.done = 0
+        self.updates = 0
+        self.finished = threading.Event()
+        api.listeners.append(self.on_call)
+
+    def send(self, user_id, step, update):
+        with self.lock:
+            self.state[user_id] = step
+            self.pushed[user_id] = time.monotonic()
+            self.updates += 1
+        self.deliver(update)
+
+    def arrive(self, user_id):
+        self.send(user_id, 'start', text_update(user_id, '/start'))
+
+    def complete(self, user_id, error=None):
+        with self.lock:
+            self.state[user_id] = 'done'
+            self.done += 1
+            if error:
+                self.errors[error] += 1
+            if self.done >= self.total:
+                self.finished.set()
+
+    def on_call(self, now, method, params):
+        if method == 'answerCallbackQuery':
+            user_id = int(str(params.get('callback_query_id', 'cq0'))[2:])
+        elif method == 'sendMessage' and str(params.get('chat_id', '')).lstrip('-').isdigit():
+            user_id = int(params['chat_id'])
+        else:
+            return
+        with self.lock:
+            step = self.state.get(user_id)
+            if step is None or step == 'done':
+                return
+            if step == 'join' and method != 'answerCallbackQuery':
+                return
+            self.latency[step].append(now - self.pushed[user_id])
+        text = params.get('text', '')
+        if step == 'start':
+            self.send(user_id, 'verify', text_update(user_id, '/verify'))
+        elif step == 'verify':
+            match = CAPTCHA.search(text)
+            if match:
+                self.send(user_id, 'captcha', text_update(user_id, solve(match)))
+            else:
+                self.complete(user_id, 'verify: ' + text[:40])
+        elif step == 'captcha':
+            if 'Проверка пройдена' in text:
+                self.send(user_id, 'join', join_update(user_id, self.giveaway_id))
+            elif 'мультиаккаунты' not in text:
+                self.complete(user_id, 'captcha: ' + text[:40])
+        elif step == 'join':
+            self.complete(user_id, None if 'Вы участвуете' in text else 'join: ' + text[:40])
+
+def webhook_deliverer(webhook):
+    pending = queue.Queue()
+    host, port = webhook.server.server_address[:2]
+
+    def client():
+        conn = http.client.HTTPConnection(host, port)
+        update_id = 0
+        while True:
+            update = pending.get()
+            update_id += 1
+            body = json.dumps(dict(update, update_id=update_id)).encode()
+            while True:
+                try:
+                    conn.request('POST', webhook.path, body, {'Content-Type': 'application/json'})
+                    response = conn.getresponse()
+                    response.read()
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    conn = http.client.HTTPConnection(host, port)
+                    continue
+                if response.status == 200:
+                    break
+                time.sleep(float(response.getheader('Retry-After') or 1))
+
+    for _ in range(args.clients):
+        threading.Thread(target=client, daemon=True).start()
+    return pending.put
+
+api = FakeBotApi(latency=args.latency).start()
+request = bot.InstrumentedRequest(con_pool_size=bot.WORKERS + bot.OUTBOX_SENDERS + bot.SUB_CHECK_WORKERS + 4, read_timeout=30)
+updater = Updater(bot=Bot(TOKEN, base_url=api.base_url, request=request), workers=bot.WORKERS)
+bot.setup_dispatcher(updater.dispatcher)
+bot.outbox.start(updater.bot)
+bot.live_posts.start()
+
+giveaway_id = bot.db.create_giveaway('Load test', 'synthetic users', args.winners, 1, bot.CHANNEL_ID, 1)
+webhook = None
+if args.mode == 'webhook':
+    webhook = bot.WebhookServer(updater.bot, bot.write_behind_overloaded, listen='127.0.0.1', port=0).start(updater.dispatcher)
+    deliver = webhook_deliverer(webhook)
+else:
+    deliver = api.push_update
+    updater.start_polling(poll_interval=0, timeout=1)
+
+population = Population(api, deliver, giveaway_id, args.users)
+print("%d users, mode %s, API latency %.0f ms, %s outbound limits" % (
+    args.users, args.mode, args.latency * 1000, "production" if args.real_limits else "no"))
+start = time.monotonic()
+for n in range(args.users):
+    population.arrive(1000000 + n)
+    if args.arrival_rate:
+        time.sleep(1.0 / args.arrival_rate)
+if not population.finished.wait(args.timeout):
+    print("timed out with %d/%d users done" % (population.done, args.users))
+elapsed = time.monotonic() - start
+
+print("\nthroughput: %d users in %.2f s = %.1f users/s, %.1f updates/s" % (
+    population.done, elapsed, population.done / elapsed, population.updates / elapsed))
+print("\n%-8s %7s %10s %10s %10s" % ("step", "count", "p50 ms", "p99 ms", "max ms"))
+for step in STEPS:
+    values = population.latency[step]
+    print("%-8s %7d %10.1f %10.1f %10.1f" % (step, len(values), percentile(values, 0.5) * 1000,
+                                            percentile(values, 0.99) * 1000, max(values or [0]) * 1000))
+for error, count in sorted(population.errors.items()):
+    print("error    %7d  %s" % (count, error))
+
+bot.db.flush()
+finish_start = time.perf_counter()
+bot.finish_giveaway(updater.bot, giveaway_id)
+print("\nfinish_giveaway with %d participants: %.1f ms" % (bot.db.get_participants_count(giveaway_id), (time.perf_counter() - finish_start) * 1000))
+
+locks = bot.db.lock_stats()
+print("\nDB write lock: %d acquisitions, wait total %.1f ms, p50 %.3f ms, p99 %.3f ms, max %.1f ms" % (
+    locks['waits'], locks['total'] * 1000, percentile(locks['samples'], 0.5) * 1000,
+    percentile(locks['samples'], 0.99) * 1000, locks['max'] * 1000))
+calls = defaultdict(int)
+for _, method, _ in api.calls:
+    calls[method] += 1
+print("Bot API calls: " + ", ".join(method + "=" + str(count) for method, count in sorted(calls.items())))
+if args.dump_metrics:
+    print("")
+    print(bot.metrics.render())
+
+if webhook is not None:
+    webhook.stop()
+    updater.dispatcher.stop()
+else:
+    updater.stop()
+bot.live_posts.stop()
+bot.outbox.stop()
+bot.db.close()
+api.stop()
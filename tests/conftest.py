@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(), 'tests.db'))
+os.environ.setdefault('POLL_TIMEOUT', '1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
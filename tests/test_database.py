@@ -0,0 +1,89 @@
+import os
+import sqlite3
+
+import pytest
+
+import GSMgiveaway_bot as bot
+
+class FlakyConnection(sqlite3.Connection):
+    failing_commits = 0
+
+    def execute(self, sql, *args):
+        if sql == 'COMMIT' and FlakyConnection.failing_commits:
+            FlakyConnection.failing_commits -= 1
+            raise sqlite3.OperationalError('disk I/O error')
+        return super().execute(sql, *args)
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    connect = sqlite3.connect
+    monkeypatch.setattr(bot.sqlite3, 'connect', lambda *args, **kwargs: connect(*args, factory=FlakyConnection, **kwargs))
+    database = bot.Database(os.path.join(str(tmp_path), 'test.db'))
+    yield database
+    FlakyConnection.failing_commits = 0
+    database.close()
+
+def test_write_behind_survives_a_failed_commit(database):
+    database.add_user(1, 'alice', 'Alice', None)
+    database.add_user(2, 'bob', 'Bob', None)
+    assert database.write_behind.size() == 2
+    FlakyConnection.failing_commits = 1
+    with pytest.raises(sqlite3.OperationalError):
+        with database.transaction() as cursor:
+            cursor.execute("INSERT INTO giveaways (name, winner_count, start_date, end_date, channel_id) VALUES ('g', 1, '', '', '')")
+    assert database.write_behind.size() == 2
+    assert database.execute('SELECT COUNT(*) FROM giveaways').fetchone()[0] == 0
+    database.flush()
+    assert database.write_behind.size() == 0
+    assert [row[0] for row in database.execute('SELECT user_id FROM users ORDER BY user_id')] == [1, 2]
+
+def test_requeue_keeps_newer_writes_for_the_same_key(database):
+    database.write_behind.put('UPDATE users SET username = ? WHERE user_id = ?', ('old', 1), key=('name', 1))
+    drained = database.write_behind.drain()
+    database.write_behind.put('UPDATE users SET username = ? WHERE user_id = ?', ('new', 1), key=('name', 1))
+    database.write_behind.requeue(drained)
+    assert [params for sql, params in database.write_behind.pending.values()] == [('new', 1)]
+
+class Message:
+    def __init__(self):
+        self.replies = []
+
+    def reply_text(self, text):
+        self.replies.append(text)
+
+def test_unrecorded_draw_leaves_the_giveaway_running(database, monkeypatch):
+    giveaway_id = database.create_giveaway('g', 'unrecorded draw', 1, 1, bot.CHANNEL_ID, 0)
+    monkeypatch.setattr(bot, 'db', database)
+    monkeypatch.setattr(bot, 'scheduler', bot.GiveawayScheduler(database))
+    monkeypatch.setattr(database, 'record_draw', lambda giveaway_id, draw: None)
+    message = Message()
+    bot.finish_giveaway(None, giveaway_id, message)
+    assert message.replies == ["Ошибка: розыгрыш не записан, попробуйте позже"]
+    assert database.get_giveaway_info(giveaway_id)[6] == 1
+
+def test_closed_giveaway_is_reported_before_the_subscription_check(database, monkeypatch):
+    monkeypatch.setattr(bot, 'db', database)
+    monkeypatch.setattr(bot, 'check_subscription', lambda *args: pytest.fail('subscription checked'))
+    database.add_user(1, 'alice', 'Alice', None)
+    database.verify_user(1)
+    ended_id = database.create_giveaway('ended', 'subscription order', 1, 1, bot.CHANNEL_ID, 1)
+    database.end_giveaway(ended_id)
+    expired_id = database.create_giveaway('expired', 'subscription order', 1, -1, bot.CHANNEL_ID, 1)
+    assert bot.join_attempt(None, ended_id, 1, None)[0] == bot.JOIN_CLOSED
+    assert bot.join_attempt(None, expired_id, 1, None)[0] == bot.JOIN_EXPIRED
+
+def test_verify_draw_replays_an_export_snapshot(database, tmp_path):
+    giveaway_id = database.create_giveaway('g', 'snapshot', 2, 1, bot.CHANNEL_ID, 0)
+    for user_id in range(1, 7):
+        database.add_participant(giveaway_id, user_id)
+    with database.transaction() as cursor:
+        cursor.execute('UPDATE participants SET bonus_entries = user_id WHERE giveaway_id = ?', (giveaway_id,))
+        cursor.execute('UPDATE participants SET is_valid = 0 WHERE giveaway_id = ? AND user_id = 3', (giveaway_id,))
+    draw_id = database.record_draw(giveaway_id, bot.draw_giveaway(database, giveaway_id, 2, exclude_size=0))
+    exports = [os.path.join(str(tmp_path), 'export.' + fmt + '.gz') for fmt in bot.EXPORT_FORMATS]
+    for fmt, path in zip(bot.EXPORT_FORMATS, exports):
+        assert bot.run_cli(['--db', database.db_name, 'export', str(giveaway_id), '--format', fmt, '--output', path]) == 0
+    database.add_participant(giveaway_id, 7)
+    assert bot.run_cli(['--db', database.db_name, 'verify-draw', str(draw_id)]) == 1
+    for path in exports:
+        assert bot.run_cli(['--db', database.db_name, 'verify-draw', str(draw_id), '--snapshot', path]) == 0
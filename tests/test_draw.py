@@ -0,0 +1,61 @@
+import random
+from collections import Counter
+
+import GSMgiveaway_bot as bot
+
+CHI2_CRITICAL_DF5 = 15.086
+WEIGHTS = [1, 1, 2, 3, 5, 8]
+ROWS = [(1000 + n, 1 + n % 4) for n in range(50)]
+NONCE = 'a1b2c3d4'
+
+def inclusion_probabilities(weights):
+    total = float(sum(weights))
+    return [w / total + sum(v / total * w / (total - v) for j, v in enumerate(weights) if j != i)
+            for i, w in enumerate(weights)]
+
+def chi_square(counts, expected):
+    return sum((counts[n] - e) ** 2 / e for n, e in enumerate(expected))
+
+def test_single_winner_frequencies_follow_weights():
+    rows = list(enumerate(WEIGHTS))
+    rng = random.Random(11)
+    trials = 60000
+    counts = Counter(bot.weighted_sample(rows, 1, rng)[0] for _ in range(trials))
+    expected = [trials * w / float(sum(WEIGHTS)) for w in WEIGHTS]
+    assert chi_square(counts, expected) < CHI2_CRITICAL_DF5
+
+def test_two_winner_inclusion_matches_successive_sampling():
+    rows = list(enumerate(WEIGHTS))
+    rng = random.Random(12)
+    trials = 30000
+    counts = Counter()
+    for _ in range(trials):
+        winners = bot.weighted_sample(rows, 2, rng)
+        assert len(set(winners)) == 2
+        counts.update(winners)
+    expected = [trials * p for p in inclusion_probabilities(WEIGHTS)]
+    assert chi_square(counts, expected) < CHI2_CRITICAL_DF5
+
+def test_zero_weight_never_wins():
+    rows = [(1, 0), (2, 1), (3, 0), (4, 1)]
+    for seed in range(200):
+        assert set(bot.weighted_sample(rows, 2, random.Random(seed))) == {2, 4}
+
+def test_fixed_digest_and_nonce_give_the_same_winners():
+    draw = bot.run_draw(lambda: iter(ROWS), 5, NONCE)
+    assert draw['digest'] == '550eb4d627566fce7d4ef138d34afb79fa7fe77ef823fbd6e60983181b3e7be5'
+    assert draw['seed'] == bot.draw_seed(draw['digest'], NONCE)
+    assert draw['winners'] == [1017, 1011, 1049, 1047, 1013]
+    assert bot.run_draw(lambda: iter(ROWS), 5, NONCE)['winners'] == draw['winners']
+    replay = bot.weighted_sample(ROWS, 5, random.Random(int(bot.draw_seed(draw['digest'], NONCE), 16)))
+    assert replay == draw['winners']
+
+def test_other_nonce_changes_the_seed():
+    assert bot.run_draw(lambda: iter(ROWS), 5, 'ffff')['seed'] != bot.run_draw(lambda: iter(ROWS), 5, NONCE)['seed']
+
+def test_exclusions_are_part_of_the_reproducible_draw():
+    draw = bot.run_draw(lambda: iter(ROWS), 5, NONCE, exclude=[1003, 1010])
+    assert draw['excluded'] == [1003, 1010]
+    assert draw['count'] == len(ROWS) - 2
+    assert draw['winners'] == [1037, 1042, 1043, 1047, 1041]
+    assert bot.run_draw(lambda: iter(ROWS), 5, NONCE, exclude=[1010, 1003])['winners'] == draw['winners']
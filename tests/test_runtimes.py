@@ -0,0 +1,168 @@
+import asyncio
+import os
+import re
+import sys
+import threading
+import time
+
+import pytest
+from telegram.ext import Updater
+
+import GSMgiveaway_bot as bot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from fake_bot_api import FakeBotApi, TOKEN
+
+ADMIN = bot.ADMIN_IDS[0]
+ALICE = 1001
+BOB = 1002
+CAROL = 1003
+CAPTCHA = re.compile(r'Решите: (-?\d+) ([+x*-]) (-?\d+) =')
+
+def user_json(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'User' + str(user_id), 'username': 'user' + str(user_id)}
+
+def text_update(user_id, text):
+    message = {'message_id': 1, 'date': int(time.time()), 'text': text,
+               'chat': {'id': user_id, 'type': 'private', 'first_name': 'User' + str(user_id)}, 'from': user_json(user_id)}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+def join_update(user_id, giveaway_id, tap):
+    return {'callback_query': {'id': 'cq' + str(user_id) + '_' + str(tap), 'from': user_json(user_id), 'chat_instance': 'test',
+                               'data': 'join_' + str(giveaway_id),
+                               'message': {'message_id': 1, 'date': int(time.time()), 'text': 'post',
+                                           'chat': {'id': user_id, 'type': 'private', 'first_name': 'User' + str(user_id)}}}}
+
+def solve(text):
+    a, op, b = CAPTCHA.search(text).groups()
+    a, b = int(a), int(b)
+    return str(a + b if op == '+' else a - b if op == '-' else a * b)
+
+class Scenario:
+    def __init__(self, api):
+        self.api = api
+        self.seen = 0
+
+    def step(self, update, quiet=0.4, timeout=10):
+        self.api.push_update(update)
+        deadline = time.monotonic() + timeout
+        last = None
+        changed = time.monotonic()
+        while time.monotonic() < deadline:
+            calls = self.replies()
+            if len(calls) > self.seen:
+                if last == len(calls) and time.monotonic() - changed >= quiet:
+                    break
+                if last != len(calls):
+                    last = len(calls)
+                    changed = time.monotonic()
+            time.sleep(0.02)
+        calls = self.replies()
+        new, self.seen = calls[self.seen:], len(calls)
+        return sorted(new)
+
+    def replies(self):
+        with self.api.lock:
+            calls = list(self.api.calls)
+        result = []
+        for _, method, params in calls:
+            if method == 'sendMessage':
+                result.append((method, str(params['chat_id']), params.get('text', '')))
+            elif method == 'answerCallbackQuery':
+                result.append((method, str(params['callback_query_id']).split('_')[0], params.get('text', '')))
+        return result
+
+def run_threaded(updater):
+    bot.setup_dispatcher(updater.dispatcher)
+    updater.start_polling(poll_interval=0, timeout=1)
+
+    def stop():
+        updater.stop()
+    return stop
+
+def run_asyncio(updater):
+    bot.setup_dispatcher(updater.dispatcher, rate_limit=False)
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(bot.run_async_runtime(updater))
+
+    def run():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def stop():
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join(10)
+        loop.close()
+    return stop
+
+def play(tmp_path, runtime):
+    database = bot.setup_database(os.path.join(str(tmp_path), runtime + '.db'))
+    bot.outbox = bot.Outbox()
+    bot.joins = bot.InFlight()
+    bot.rate_limiter = bot.UpdateRateLimiter(user_rate=0, global_rate=0)
+    api = FakeBotApi().start()
+    updater = Updater(TOKEN, base_url=api.base_url, workers=4)
+    bot.outbox.start(updater.bot)
+    giveaway_id = database.create_giveaway('Scenario', 'shared runtime test', 1, 1, bot.CHANNEL_ID, 0)
+    with database.transaction() as cursor:
+        cursor.execute('UPDATE giveaways SET draw_nonce = ? WHERE id = ?', ('scenario-nonce', giveaway_id))
+    stop = run_threaded(updater) if runtime == 'threaded' else run_asyncio(updater)
+    scenario = Scenario(api)
+    steps = []
+    try:
+        for user_id in (ALICE, BOB):
+            steps.append(scenario.step(text_update(user_id, '/start')))
+            verify = scenario.step(text_update(user_id, '/verify'))
+            steps.append([(method, chat, CAPTCHA.sub('Решите: ? =', text)) for method, chat, text in verify])
+            steps.append(scenario.step(text_update(user_id, solve(verify[0][2]))))
+            steps.append(scenario.step(join_update(user_id, giveaway_id, 1)))
+        steps.append(scenario.step(join_update(ALICE, giveaway_id, 2)))
+        steps.append(scenario.step(join_update(CAROL, giveaway_id, 1)))
+        steps.append(scenario.step(text_update(ADMIN, '/ban ' + str(BOB) + ' spam')))
+        steps.append(scenario.step(join_update(BOB, giveaway_id, 2)))
+        steps.append(scenario.step(text_update(ADMIN, '/end ' + str(giveaway_id))))
+    finally:
+        stop()
+        bot.outbox.stop()
+        api.stop()
+    database.flush()
+    state = {
+        'users': database.execute('SELECT user_id, is_verified, is_banned FROM users ORDER BY user_id').fetchall(),
+        'participants': database.execute('SELECT user_id, is_valid, bonus_entries FROM participants ORDER BY user_id').fetchall(),
+        'giveaway': database.execute('SELECT is_active, participant_count FROM giveaways WHERE id = ?', (giveaway_id,)).fetchone(),
+        'draws': database.execute('SELECT participant_count, total_weight, winners, seed FROM draws').fetchall(),
+    }
+    database.close()
+    return steps, state
+
+@pytest.fixture(scope='module')
+def runs(tmp_path_factory):
+    return dict((runtime, play(tmp_path_factory.mktemp(runtime), runtime)) for runtime in ('threaded', 'asyncio'))
+
+def test_scenario_outcome(runs):
+    steps, state = runs['threaded']
+    assert state['users'] == [(ALICE, 1, 0), (BOB, 1, 1)]
+    assert [row[0] for row in state['participants'] if row[1]] == [ALICE]
+    assert state['giveaway'] == (0, 1)
+    assert len(state['draws']) == 1 and state['draws'][0][2] == '[' + str(ALICE) + ']'
+    assert ('answerCallbackQuery', 'cq' + str(ALICE), 'Вы участвуете! Всего: 1') in steps[3]
+    assert ('answerCallbackQuery', 'cq' + str(BOB), 'Вы участвуете! Всего: 2') in steps[7]
+    assert steps[8] == [('answerCallbackQuery', 'cq' + str(ALICE), 'Вы уже участвуете')]
+    assert ('answerCallbackQuery', 'cq' + str(CAROL), 'Пройдите проверку!') in steps[9]
+    assert steps[11] == [('answerCallbackQuery', 'cq' + str(BOB), 'Вы забанены')]
+    assert ('sendMessage', bot.CHANNEL_ID, 'ПОБЕДИТЕЛИ!\n\n1. @user' + str(ALICE) + '\n') in steps[12]
+
+def test_runtimes_agree(runs):
+    threaded_steps, threaded_state = runs['threaded']
+    asyncio_steps, asyncio_state = runs['asyncio']
+    assert asyncio_state == threaded_state
+    assert len(asyncio_steps) == len(threaded_steps)
+    for threaded, asynchronous in zip(threaded_steps, asyncio_steps):
+        assert asynchronous == threaded
@@ -0,0 +1,30 @@
+import os
+import threading
+from datetime import datetime
+
+import GSMgiveaway_bot as bot
+
+def test_failed_finish_is_retried_while_the_giveaway_is_active(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'FINISH_RETRY_DELAY', 0.1)
+    database = bot.Database(os.path.join(str(tmp_path), 'test.db'))
+    scheduler = bot.GiveawayScheduler(database)
+    giveaway_id = database.create_giveaway('Retry', 'scheduler test', 1, 1, bot.CHANNEL_ID, 0)
+    calls = []
+    done = threading.Event()
+
+    def finish(gid):
+        calls.append(gid)
+        if len(calls) < 3:
+            raise RuntimeError('network down')
+        database.end_giveaway(gid)
+        done.set()
+    scheduler.start(finish)
+    scheduler.schedule(giveaway_id, datetime.now())
+    try:
+        assert done.wait(5)
+    finally:
+        scheduler.stop()
+        scheduler.thread.join(5)
+    assert calls == [giveaway_id] * 3
+    assert scheduler.deadlines == {}
+    database.close()